@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+""" Runs all bot tasks in one process, sharing the reddit session, caches and databases """
+
+import sys
+
+import metrics
+from log_conf import LoggerManager
+from common import SubRedditMod
+from scheduler import Scheduler, parse_schedule
+import flair
+import heatware
+import post_check
+import monthly_trade_post
+import monthly_price_post
+
+# Configure logging
+LOGGER = LoggerManager().getLogger("bot_daemon")
+
+
+class BotDaemon(object):
+    """ Schedules the bot tasks configured in the daemon section of config.cfg """
+
+    def __init__(self, subreddit):
+        self._subreddit = subreddit
+        self._post_check = None
+        self.scheduler = Scheduler(LOGGER)
+
+    def post_check(self):
+        if self._post_check is None:
+            self._post_check = post_check.PostCheckRunner(self._subreddit)
+        self._post_check.poll()
+
+    def flair(self):
+        flair.run(self._subreddit)
+
+    def heatware(self):
+        heatware.run(self._subreddit)
+
+    def monthly_trade_post(self):
+        monthly_trade_post.run(self._subreddit.praw_h)
+        self._subreddit.reload_config()
+
+    def monthly_price_post(self):
+        monthly_price_post.run(self._subreddit.praw_h)
+        self._subreddit.reload_config()
+
+    def schedule(self):
+        """ Add the configured jobs, returns the number of jobs """
+        config = self._subreddit.config
+        jobs = 0
+        for name in ("post_check", "flair", "heatware", "monthly_trade_post", "monthly_price_post"):
+            schedule = config.get("daemon", name, fallback="")
+            if not schedule:
+                continue
+            # The other jobs walk whole threads or rewrite config.cfg, they run one at a time next to post_check
+            self.scheduler.add(name, metrics.staged(name)(getattr(self, name)), parse_schedule(schedule),
+                               exclusive=name != "post_check", run_now=name == "post_check")
+            jobs += 1
+        return jobs
+
+    def run(self):
+        self._subreddit.mod_roster.start()
+        try:
+            self.scheduler.run()
+        finally:
+            self.scheduler.stop()
+            self._subreddit.mod_roster.stop()
+            self._subreddit.user_db.flush()
+            self._subreddit.flush_usernotes()
+
+
+def main():
+    """ Main function, schedules the configured jobs and runs them until interrupted """
+    try:
+        subreddit = SubRedditMod(LOGGER)
+        metrics.setup(subreddit.config, "bot_daemon")
+        daemon = BotDaemon(subreddit)
+        if not daemon.schedule():
+            LOGGER.error("No jobs configured in the daemon section of config.cfg")
+            sys.exit(1)
+        daemon.run()
+    except KeyboardInterrupt:
+        print("\nCtrl-C pressed, exiting gracefully")
+        sys.exit(0)
+    except Exception as exception:
+        LOGGER.error(exception)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+""" Submission title classification """
+
+import re
+import os
+import json
+import threading
+import unicodedata
+from collections import namedtuple
+
+
+PERSONAL = "personal"
+NONPERSONAL = "nonpersonal"
+INVALID = "invalid"
+
+Verdict = namedtuple("Verdict", ["kind", "location", "category", "css_class", "bad_part",
+                                 "timestamp_check", "category_prop"])
+
+
+def clean_text(text):
+    """ Normalize text to plain ascii """
+    return unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode()
+
+
+class TitleClassifier(object):
+    """ Classifies submission titles according to the post_check config, categories and locations """
+
+    def __init__(self, config, post_categories, locations):
+        self._trade_format = re.compile(config["trade_post_format"])
+        self._trade_format_strict = None
+        if config.get("trade_post_format_strict"):
+            self._trade_format_strict = re.compile(config["trade_post_format_strict"])
+        self._informational_format = re.compile(config["informational_post_format"])
+        self.timestamp_regex = re.compile(config["timestamp_regex"], re.IGNORECASE)
+
+        self._locations = {primary: frozenset(secondaries) for primary, secondaries in locations.items()}
+
+        personal_categories = post_categories["personal"]
+        self._default_category = config["default_category"]
+        self._default_category_prop = personal_categories[self._default_category]
+        # The last matching category wins, so check them in reverse order and stop at the first match
+        self._personal_rules = []
+        for category, category_prop in reversed(list(personal_categories.items())):
+            assert not ("have" in category_prop and "want" in category_prop), "Limitation of script"
+            for part in ("have", "want"):
+                if part in category_prop:
+                    regex = re.compile(category_prop[part].replace("\\\\", "\\"), re.IGNORECASE)
+                    self._personal_rules.append((part == "have", regex, category, category_prop))
+
+        self._tags = {}
+        for category, category_prop in post_categories["nonpersonal"].items():
+            self._tags.setdefault(category_prop["tag"], (category, category_prop))
+
+    def _personal_category(self, have, want):
+        """ Get (category, category properties, timestamp check) of personal post """
+        for is_have, regex, category, category_prop in self._personal_rules:
+            if regex.search(have if is_have else want):
+                return category, category_prop, category_prop["timestamp_check"]
+        # Titles not matching any category are not checked for a timestamp, whatever the default category is
+        return self._default_category, self._default_category_prop, False
+
+    def _check_location(self, location):
+        if "-" in location:
+            primary, secondary = location.split("-", 1)
+        else:
+            primary = "OTHER"
+            secondary = location
+        return secondary in self._locations.get(primary, ())
+
+    def classify(self, title):
+        """ Classify an already cleaned title, see clean_text """
+        personal = self._trade_format.search(title)
+        if personal:
+            if self._trade_format_strict is not None and not self._trade_format_strict.match(title):
+                return Verdict(INVALID, None, None, None, "title", False, None)
+            location, have, want = personal.groups()
+            if not self._check_location(location):
+                return Verdict(INVALID, location, None, None, "location", False, None)
+            category, category_prop, timestamp_check = self._personal_category(have, want)
+            return Verdict(PERSONAL, location, category, category_prop["class"], None, timestamp_check, category_prop)
+
+        nonpersonal = self._informational_format.search(title)
+        if nonpersonal:
+            tag = nonpersonal.group(1)
+            if tag not in self._tags:
+                return Verdict(INVALID, None, None, None, "tag", False, None)
+            category, category_prop = self._tags[tag]
+            return Verdict(NONPERSONAL, None, category, category_prop["class"], None, False, category_prop)
+
+        return Verdict(INVALID, None, None, None, "title", False, None)
+
+
+class ClassifierLoader(object):
+    """ Builds a TitleClassifier from its source files and rebuilds it when any of them change """
+
+    def __init__(self, logger, load_config, categories_path, locations_path, config_path=None):
+        self._logger = logger
+        self._load_config = load_config
+        self._paths = [path for path in (config_path, categories_path, locations_path) if path]
+        self._categories_path = categories_path
+        self._locations_path = locations_path
+        self._mtimes = None
+        self._classifier = None
+        self._lock = threading.Lock()
+
+    def _get_mtimes(self):
+        return [os.stat(path).st_mtime for path in self._paths]
+
+    def _build(self):
+        with open(self._categories_path) as category_file:
+            post_categories = json.load(category_file)
+        with open(self._locations_path) as locations_file:
+            locations = json.load(locations_file)
+        return TitleClassifier(self._load_config()["post_check"], post_categories, locations)
+
+    def get(self):
+        """ Get classifier, rebuilding it first if the config has changed, called by all post_check workers """
+        with self._lock:
+            mtimes = self._get_mtimes()
+            if mtimes != self._mtimes:
+                try:
+                    self._classifier = self._build()
+                    self._logger.info("Loaded title classification config")
+                except (IOError, ValueError, KeyError, re.error) as exception:
+                    if self._classifier is None:
+                        raise
+                    self._logger.error("Invalid title classification config, keeping previous: {}".format(exception))
+                self._mtimes = mtimes
+            return self._classifier
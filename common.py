@@ -1,13 +1,23 @@
-""" Common stuff """
+""" Common stuff
+
+praw and prawcore are imported where they are first needed, importing them takes longer than
+a cron run with nothing to do.
+"""
 
 import sys
 import os
+import json
+import time
 import urllib
+import threading
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 
 from configparser import SafeConfigParser
 
-import praw
-import puni
+import metrics
+from user_db import UserDB, parse_trade_count
+from usernotes import UsernoteCache, UsernoteWriter
 
 
 class DictConfigParser(SafeConfigParser):
@@ -29,20 +39,391 @@ class DictConfigParser(SafeConfigParser):
             return config_dict
 
 
+# Max number of flair changes per request to the bulk flair endpoint
+FLAIR_BATCH_SIZE = 100
+# Flair changes reddit refuses are sent again by this many flushes before they are dropped
+FLAIR_MAX_ATTEMPTS = 5
+# Max number of items per request to the info endpoint
+INFO_BATCH_SIZE = 100
+
+
+Profile = namedtuple("Profile", ["name", "link_karma", "comment_karma", "created_utc", "suspended"])
+
+
+class ProfileCache(object):
+    """ Cache of redditor profiles with TTL and LRU eviction, optionally persisted in the user db """
+
+    def __init__(self, ttl=3600, max_size=10000, user_db=None):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._user_db = user_db
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        total = self.hits + self.misses
+        return "{} profiles cached, {} hits, {} misses ({:.0%} hit rate)".format(
+            len(self._entries), self.hits, self.misses, float(self.hits) / total if total else 0)
+
+    @staticmethod
+    def _fetch(redditor):
+        """ Fetch profile of redditor, suspended and shadowbanned users are marked as suspended """
+        import prawcore
+        try:
+            if getattr(redditor, "is_suspended", False) or not hasattr(redditor, "fullname"):
+                return Profile(redditor.name, 0, 0, None, True)
+        except prawcore.exceptions.NotFound:
+            return Profile(redditor.name, 0, 0, None, True)
+        return Profile(redditor.name, redditor.link_karma, redditor.comment_karma, redditor.created_utc, False)
+
+    def _put(self, key, fetched_utc, profile):
+        self._entries[key] = (fetched_utc, profile)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, redditor):
+        """ Get profile of redditor """
+        key = redditor.name.lower()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < self._ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if self._user_db is not None:
+                row = self._user_db.get_profile(redditor.name)
+                if row is not None and now - row[5] < self._ttl:
+                    profile = Profile(row[0], row[1], row[2], row[3], bool(row[4]))
+                    self._put(key, row[5], profile)
+                    self.hits += 1
+                    return profile
+            self.misses += 1
+
+        profile = self._fetch(redditor)
+        with self._lock:
+            self._put(key, now, profile)
+        if self._user_db is not None:
+            self._user_db.set_profile(profile.name, profile.link_karma, profile.comment_karma,
+                                      profile.created_utc, profile.suspended, now)
+        return profile
+
+
+class RemovalStatus(object):
+    """ Cache of submission removal status with TTL and size cap, looked up in batches through the info endpoint """
+
+    def __init__(self, praw_h, ttl=300, max_size=10000):
+        self._praw_h = praw_h
+        self._ttl = ttl
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _is_removed(submission):
+        # Only look at fetched attributes, a missing attribute would otherwise trigger a fetch per submission
+        attributes = vars(submission)
+        return bool(attributes.get("removed") or attributes.get("banned_by") or submission.author is None)
+
+    def _get_fresh(self, submission_id, now):
+        entry = self._entries.get(submission_id)
+        if entry is not None and now - entry[0] < self._ttl:
+            return entry[1]
+        return None
+
+    @metrics.staged("removal_status")
+    def prefetch(self, submission_ids):
+        """ Look up removal status of all submissions not cached yet, up to 100 per request """
+        now = time.time()
+        with self._lock:
+            missing = [submission_id for submission_id in set(submission_ids)
+                       if self._get_fresh(submission_id, now) is None]
+        for start in range(0, len(missing), INFO_BATCH_SIZE):
+            batch = missing[start:start + INFO_BATCH_SIZE]
+            # Submissions not returned at all are gone
+            status = dict.fromkeys(batch, True)
+            for submission in self._praw_h.info(["t3_" + submission_id for submission_id in batch]):
+                status[submission.id] = self._is_removed(submission)
+            with self._lock:
+                for submission_id, removed in status.items():
+                    self._entries[submission_id] = (now, removed)
+                    self._entries.move_to_end(submission_id)
+                while len(self._entries) > self._max_size:
+                    self._entries.popitem(last=False)
+
+    def is_removed(self, submission_id):
+        """ Returns if the submission with submission_id is removed (by mod or user) """
+        with self._lock:
+            removed = self._get_fresh(submission_id, time.time())
+        if removed is None:
+            self.prefetch([submission_id])
+            with self._lock:
+                removed = self._entries[submission_id][1]
+        return removed
+
+
+class ModRoster(object):
+    """
+    Lowercase names of the subreddit moderators
+
+    The names are kept in a snapshot file, a snapshot younger than refresh_interval is used
+    without asking reddit. Long running scripts can refresh the roster in a background thread.
+    """
+
+    def __init__(self, fetch, snapshot_path=None, refresh_interval=3600, logger=None):
+        self._fetch = fetch
+        self._snapshot_path = snapshot_path
+        self._refresh_interval = refresh_interval
+        self._logger = logger
+        self._names = None
+        self._fetched_utc = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._load_snapshot()
+
+    def _load_snapshot(self):
+        if not self._snapshot_path or not os.path.exists(self._snapshot_path):
+            return
+        try:
+            with open(self._snapshot_path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            self._names = frozenset(snapshot["names"])
+            self._fetched_utc = snapshot["fetched_utc"]
+        except (ValueError, KeyError) as exception:
+            if self._logger:
+                self._logger.warning("Ignoring invalid mod roster snapshot: {}".format(exception))
+
+    def _save_snapshot(self):
+        if not self._snapshot_path:
+            return
+        tmp_path = self._snapshot_path + ".tmp"
+        with open(tmp_path, "w") as snapshot_file:
+            json.dump({"fetched_utc": self._fetched_utc, "names": sorted(self._names)}, snapshot_file)
+        os.replace(tmp_path, self._snapshot_path)
+
+    def refresh(self):
+        """ Fetch the moderator list and update the snapshot """
+        names = frozenset(name.lower() for name in self._fetch())
+        with self._lock:
+            self._names = names
+            self._fetched_utc = time.time()
+            self._save_snapshot()
+
+    @property
+    def stale(self):
+        return time.time() - self._fetched_utc >= self._refresh_interval
+
+    @property
+    def names(self):
+        """ Set of lowercase moderator names, fetched first if missing or stale and not refreshed in the background """
+        if self._names is None or (self.stale and self._thread is None):
+            try:
+                self.refresh()
+            except Exception as exception:
+                # A stale roster is better than none
+                if self._names is None:
+                    raise
+                if self._logger:
+                    self._logger.warning("Could not refresh mod roster: {}".format(exception))
+        return self._names
+
+    def is_mod(self, user):
+        """ Check if user (Redditor or name) is a moderator """
+        if user is None:
+            return False
+        name = user if isinstance(user, str) else user.name
+        return name.lower() in self.names
+
+    def start(self):
+        """ Refresh the roster every refresh_interval in a background thread """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="mod-roster")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while True:
+            wait = max(self._refresh_interval - (time.time() - self._fetched_utc), 0)
+            if self._stop.wait(wait):
+                return
+            try:
+                self.refresh()
+            except Exception as exception:
+                if self._logger:
+                    self._logger.warning("Could not refresh mod roster: {}".format(exception))
+                if self._stop.wait(60):
+                    return
+
+
+class ReplyIndex(object):
+    """ Replies in loaded comment trees, grouped by parent and author class (bot, mod, other, or all) """
+
+    def __init__(self, username, mod_names):
+        self._username = username.lower()
+        self._mod_names = mod_names
+        self._covered = set()
+        self._replies = {}
+
+    def add(self, parent, comments):
+        """
+        Add a fully loaded tree of comments below parent (submission or comment)
+
+        With parent None comments are complete subtrees including their roots, like returned by morechildren.
+        """
+        from praw.models import MoreComments
+        if parent is not None:
+            self._covered.add(parent.fullname)
+        incomplete = set()
+        for comment in comments:
+            if isinstance(comment, MoreComments):
+                # Not all replies to its parent are loaded
+                incomplete.add(comment.parent_id)
+                continue
+            self._covered.add(comment.fullname)
+            author = comment.author.name.lower() if comment.author else ""
+            classes = self._replies.setdefault(comment.parent_id, {"bot": [], "mod": [], "other": [], "all": []})
+            classes["all"].append(comment)
+            if author == self._username:
+                classes["bot"].append(comment)
+            if author in self._mod_names:
+                classes["mod"].append(comment)
+            elif author != self._username:
+                classes["other"].append(comment)
+        self._covered -= incomplete
+
+    def covers(self, item):
+        """ Check if all replies to item are indexed """
+        return item.fullname in self._covered
+
+    def get(self, item, author_class):
+        """ Get replies to item by authors of author_class """
+        return self._replies.get(item.fullname, {}).get(author_class, [])
+
+
 class SubRedditMod(object):
     """ Helper class to mod a subreddit """
 
-    _mods = None
-    _suspended = {}
-    _removed = {}
-
-    def __init__(self, logger):
+    def __init__(self, logger, config_file=None):
         self.logger = logger
-        self.config = self._load_config()
-        self._sub_config = self.config["subreddit"]
-        self.praw_h = self.login()
-        self.subreddit = self.praw_h.subreddit(self._sub_config["uri"])
-        self.puni_h = puni.UserNotes(self.praw_h, self.subreddit)
+        self.config_file = config_file or self.config_path()
+        self._config = None
+        self.rate_limiter = None
+        self._praw_h = None
+        self._subreddit = None
+        self._usernote_cache = None
+        self._usernotes = None
+        self._login_lock = threading.Lock()
+        # Jobs in bot_daemon.py share the SubRedditMod from their own threads, each walks its own comment trees
+        self._local = threading.local()
+        self._flair_lock = threading.Lock()
+        self._user_db = None
+        self._profiles = None
+        self._mod_roster = None
+        self._removal_status = None
+
+    @property
+    def config(self):
+        """ Config, loaded from config.cfg on first use """
+        if self._config is None:
+            self._config = self.load_config(self.config_file)
+        return self._config
+
+    @property
+    def _sub_config(self):
+        return self.config["subreddit"]
+
+    @property
+    def praw_h(self):
+        """ praw Reddit instance, logged in on first use """
+        with self._login_lock:
+            if self._praw_h is None:
+                self._praw_h = self.login()
+        return self._praw_h
+
+    @property
+    def subreddit(self):
+        if self._subreddit is None:
+            self._subreddit = self.praw_h.subreddit(self._sub_config["uri"])
+        return self._subreddit
+
+    @property
+    def usernote_cache(self):
+        """ Usernotes page, downloaded when it has a new revision """
+        if self._usernote_cache is None:
+            self._usernote_cache = UsernoteCache(lambda: self.subreddit, self.logger,
+                                                 int(self._sub_config.get("usernotes_check_interval") or 60),
+                                                 self.user_db)
+        return self._usernote_cache
+
+    @property
+    def usernotes(self):
+        """ Buffered usernote writer, the notes are written to the wiki by flush_usernotes """
+        if self._usernotes is None:
+            self._usernotes = UsernoteWriter(lambda: self.subreddit, self.logger, self.usernote_cache)
+        return self._usernotes
+
+    @property
+    def removal_status(self):
+        if self._removal_status is None:
+            self._removal_status = RemovalStatus(self.praw_h, int(self._sub_config.get("removal_ttl") or 300))
+        return self._removal_status
+
+    @property
+    def reply_index(self):
+        """ Replies in the comment trees loaded by the current thread """
+        return getattr(self._local, "reply_index", None)
+
+    @reply_index.setter
+    def reply_index(self, reply_index):
+        self._local.reply_index = reply_index
+
+    def reload_config(self):
+        """ Load config.cfg again, for settings changed by other scripts (like the monthly thread ids) """
+        self._config = self.load_config(self.config_file)
+
+    @property
+    def user_db(self):
+        """ User db, opened on first use """
+        if self._user_db is None:
+            self._user_db = UserDB(self.config["trade"]["user_db"])
+        return self._user_db
+
+    @property
+    def profiles(self):
+        """ Redditor profile cache """
+        if self._profiles is None:
+            sub_config = self._sub_config
+            self._profiles = ProfileCache(int(sub_config.get("profile_ttl") or 3600),
+                                          int(sub_config.get("profile_cache_size") or 10000),
+                                          self.user_db if sub_config.get("persist_profiles", True) else None)
+        return self._profiles
+
+    @property
+    def mod_roster(self):
+        """ Moderator roster, loaded from the snapshot file on first use """
+        if self._mod_roster is None:
+            sub_config = self._sub_config
+            self._mod_roster = ModRoster(lambda: [mod.name for mod in self.subreddit.moderator()],
+                                         sub_config.get("mod_roster_file") or None,
+                                         int(sub_config.get("mod_refresh_interval") or 3600),
+                                         self.logger)
+        return self._mod_roster
+
+    def is_mod(self, user):
+        """ Check if user (Redditor or name) is a moderator of the subreddit """
+        return self.mod_roster.is_mod(user)
+
+    def get_profile(self, user):
+        """ Get cached profile (karma, creation time and suspension status) of a redditor """
+        return self.profiles.get(user)
 
     @property
     def subreddit_uri(self):
@@ -53,11 +434,19 @@ class SubRedditMod(object):
         return self.config["login"]["username"]
 
     def get_usernotes(self, username):
-        return self.puni_h.get_notes(username)
+        """ Get usernotes (usernotes.Note) on username, newest first, including notes not written yet """
+        username = str(username)
+        pending = self._usernotes.pending(username) if self._usernotes is not None else []
+        return pending + self.usernote_cache.get(username)
 
     def set_usernote(self, user, reason, link='', warning='none'):
-        note = puni.Note(user, reason, self._sub_config["uri"], self.username, link, warning)
-        self.puni_h.add_note(note)
+        """ Queue a usernote on user, written together with other queued notes by flush_usernotes """
+        self.usernotes.add(str(user), reason, self.username, link, warning)
+
+    def flush_usernotes(self):
+        """ Write queued usernotes to the wiki as one revision """
+        if self._usernotes is not None:
+            self._usernotes.flush()
 
     def get_rules_link(self, title="RULES"):
         return "[{title}]({uri})".format(
@@ -68,19 +457,41 @@ class SubRedditMod(object):
             title=title, uri=self.subreddit_uri + self._sub_config["wiki"])
 
     @staticmethod
-    def _load_config():
-        """ Load config from config.cfg """
+    def config_path():
+        """ Path to config.cfg """
         containing_dir = os.path.abspath(os.path.dirname(sys.argv[0]))
-        path_to_cfg = os.path.join(containing_dir, 'config.cfg')
+        return os.path.join(containing_dir, 'config.cfg')
+
+    @staticmethod
+    def load_config(path=None):
+        """ Load config from path, config.cfg next to the script by default """
         config = DictConfigParser()
-        config.read(path_to_cfg)
+        config.read(path or SubRedditMod.config_path())
         return config
 
     def login(self):
         """ Login in praw """
+        import praw
+        import rate_budget
         login_info = self.config["login"]
         self.logger.info('Logging in as /u/' + login_info["username"])
-        return praw.Reddit(**login_info)
+        praw_h = praw.Reddit(**login_info)
+        metrics.instrument_session(praw_h._core)
+        rate_budget_file = self._sub_config.get("rate_budget_file")
+        if rate_budget_file:
+            self.rate_limiter = rate_budget.install(praw_h, rate_budget_file)
+        return praw_h
+
+    @contextmanager
+    def priority(self, priority):
+        """ Make API requests of the current thread with priority (see rate_budget) """
+        # Log in first, the rate limiter is installed on login
+        self.praw_h
+        if self.rate_limiter is None:
+            yield
+        else:
+            with self.rate_limiter.priority(priority):
+                yield
 
     def get_modmail_link(self, title="modmail", subject=None, content=None):
         """ Get link to modmail """
@@ -92,78 +503,251 @@ class SubRedditMod(object):
             link += "&message=" + urllib.parse.quote_plus(content)
         return "[{title}]({link})".format(title=title, link=link)
 
-    def get_unread_messages(self):
-        """ Get unread messages (not comment replies) """
-        return [msg for msg in self.praw_h.inbox.unread(limit=100) if not msg.was_comment]
+    def get_unread_messages(self, limit=None):
+        """ Get unread messages (not comment replies), all of them unless limit is given """
+        return [msg for msg in self.praw_h.inbox.unread(limit=limit) if not msg.was_comment]
+
+    def mark_read(self, messages):
+        """ Mark messages as read, praw sends them in batches of 25 """
+        if messages:
+            self.praw_h.inbox.mark_read(list(messages))
 
     def get_unread_mod_messages(self):
         """ Get undread messages from mods """
-        return [msg for msg in self.get_unread_messages() if msg.author in self.get_mods()]
+        return [msg for msg in self.get_unread_messages() if self.is_mod(msg.author)]
 
     def is_removed(self, submission_id):
         """ Returns if the submission with submission_id is removed (by mod or user) """
-        if submission_id in self._removed:
-            return self._removed[submission_id]
-
-        submission = self.praw_h.submission(id=submission_id)
-        removed = submission.removed or (submission.author is None)
-        self._removed[submission_id] = removed
-        return removed
+        return self.removal_status.is_removed(submission_id)
+
+    def wait_for_rate_limit(self, min_remaining=10):
+        """ Sleep until the rate limit resets if less than min_remaining requests are left """
+        if self.rate_limiter is not None:
+            self.rate_limiter.budget.wait_for_window(min_remaining, self.logger)
+            return
+        rate_limiter = self.praw_h._core._rate_limiter
+        if rate_limiter.remaining is None or rate_limiter.remaining >= min_remaining:
+            return
+        sleep_seconds = rate_limiter.reset_timestamp - time.time()
+        if sleep_seconds > 0:
+            self.logger.info("Rate limit almost used up, sleeping for {:.0f}s".format(sleep_seconds))
+            time.sleep(sleep_seconds)
 
     def get_top_level_comments(self, link_id):
         """ Get all top level comments on a submission with specified link_id """
         submission = self.praw_h.submission(id=link_id)
-        submission.comments.replace_more(limit=None, threshold=0)
+        with metrics.stage("replace_more"):
+            submission.comments.replace_more(limit=None, threshold=0)
+        self.reply_index = self._new_reply_index()
+        self.reply_index.add(submission, submission.comments.list())
         return submission.comments
 
+    def _new_reply_index(self):
+        return ReplyIndex(self.username, self.mod_roster.names)
+
+    @metrics.staged("new_thread_comments")
+    def get_new_thread_comments(self, link_id, since_utc, limit=1000):
+        """
+        Get comments on submission link_id created after since_utc, newest first
+
+        Uses the subreddit comment listing instead of the submission comment tree.
+        Returns None if the listing does not reach back to since_utc.
+        """
+        link_fullname = "t3_" + link_id
+        comments = []
+        for comment in self.subreddit.comments(limit=limit):
+            if comment.created_utc <= since_utc:
+                return comments
+            if comment.link_id == link_fullname:
+                comments.append(comment)
+        return None
+
+    @metrics.staged("get_comments")
+    def get_comments(self, comment_ids):
+        """ Get comments without their replies by id, up to 100 per request, unknown ids are left out """
+        fullnames = ["t1_" + comment_id for comment_id in set(comment_ids)]
+        if not fullnames:
+            return {}
+        return {comment.id: comment for comment in self.praw_h.info(fullnames)}
+
+    def get_comment(self, comment_id):
+        """ Get comment with its replies """
+        return self.load_replies(self.praw_h.comment(id=comment_id))
+
+    def load_replies(self, comment):
+        """ Load replies of comment and add them to the reply index """
+        comment.refresh()
+        if self.reply_index is None:
+            self.reply_index = self._new_reply_index()
+        self.reply_index.add(comment, comment.replies.list())
+        return comment
+
+    @metrics.staged("load_reply_trees")
+    def load_reply_trees(self, link_id, comments, chunk_size=25):
+        """
+        Load the replies of comments on submission link_id into a new reply index
+
+        Uses morechildren, which returns the subtrees of several comments in one request. Its responses are
+        capped at about 100 comments, so the comments are requested in chunks. Replies left out of a response
+        are not covered by the index, get_replies loads those one comment at a time.
+        """
+        from praw.const import API_PATH
+        self.reply_index = self._new_reply_index()
+        comment_ids = [comment.id for comment in comments]
+        for start in range(0, len(comment_ids), chunk_size):
+            things = self.praw_h.post(API_PATH["morechildren"],
+                                      data={"children": ",".join(comment_ids[start:start + chunk_size]),
+                                            "link_id": "t3_" + link_id})
+            self.reply_index.add(None, things)
+
+    def get_replies(self, comment):
+        """ Get replies of comment from the reply index, loading them if the index does not cover them """
+        if self.reply_index is None or not self.reply_index.covers(comment):
+            return list(self.load_replies(comment).replies)
+        return self.reply_index.get(comment, "all")
+
     def get_all_comments(self, link_id):
         """ Get all comments on a submission with specified link_id """
         return self.get_top_level_comments(link_id).list()
 
+    def _get_author_flair(self, item):
+        """
+        Get (trade_count, css_class, text) of the user flair of the author of item
+
+        A flair change queued by the bot wins over the flair on item until it has been sent, the flair on item
+        wins otherwise, so flair set by mods or other tools is not overwritten. The ledger is updated to match.
+        """
+        username = item.author.name
+        css_class, text = item.author_flair_css_class or None, item.author_flair_text or None
+        flair = self.user_db.get_flair(username)
+        if flair is None:
+            return parse_trade_count(css_class), css_class, text
+        if (flair[1] or None, flair[2] or None) == (css_class, text) or self.user_db.is_flair_queued(username):
+            return flair
+        self.logger.info("Flair of {} changed outside the bot from {} to {}".format(
+            username, (flair[1], flair[2]), (css_class, text)))
+        self.user_db.set_flair(username, css_class, text)
+        return parse_trade_count(css_class), css_class, text
+
+    def get_user_flair(self, item):
+        """ Get (css_class, text) of the user flair of the author of item """
+        return self._get_author_flair(item)[1:]
+
+    def get_user_trade_count(self, item):
+        """ Get trade count of the author of item, None if the user has a special flair class """
+        return self._get_author_flair(item)[0]
+
+    @metrics.staged("sync_flair_ledger")
+    def sync_flair_ledger(self):
+        """ Store the flair of every user with flair on the subreddit in the user db """
+        self.logger.info("Syncing flair ledger")
+        self.user_db.import_flairs({"user": flair["user"].name,
+                                    "flair_text": flair["flair_text"],
+                                    "flair_css_class": flair["flair_css_class"]}
+                                   for flair in self.subreddit.flair(limit=None))
+        self.user_db.set_meta("flair_synced_utc", time.time())
+
     def update_comment_user_flair(self, comment, css_class=None, text=None):
-        """ Update the user flair of an author of a comment """
+        """ Update the user flair of an author of a comment, sent to the subreddit by flush_flair """
+        current_css_class, current_text = self.get_user_flair(comment)
         if css_class is None:
-            css_class = comment.author_flair_css_class
+            css_class = current_css_class
         else:
             self.logger.info("Set {}'s flair class to {}".format(comment.author.name, css_class))
         if text is None:
-            text = comment.author_flair_text
+            text = current_text
         else:
             self.logger.info("Set {}'s flair text to {}".format(comment.author.name, text))
-        self.subreddit.flair.set(comment.author, text, css_class)
+        self.user_db.queue_flair(comment.author.name, css_class, text)
+
+    @metrics.staged("flush_flair")
+    def flush_flair(self):
+        """
+        Send queued flair changes to the subreddit in batches
+
+        The changes are journaled in the user db, so changes left by a failed run are sent by the
+        next flush. The journal holds the resulting flair, so sending it again never changes trade counts twice.
+        Changes reddit refuses stay in the journal, they are dropped after FLAIR_MAX_ATTEMPTS flushes.
+        """
+        with self._flair_lock:
+            journal = self.user_db.get_flair_journal()
+            refused = []
+            for start in range(0, len(journal), FLAIR_BATCH_SIZE):
+                batch = journal[start:start + FLAIR_BATCH_SIZE]
+                results = self.subreddit.flair.update([{"user": username,
+                                                        "flair_text": text or "",
+                                                        "flair_css_class": css_class or ""}
+                                                       for username, css_class, text, _, _ in batch])
+                done = []
+                failed = []
+                for (username, css_class, text, queued_utc, attempts), result in zip(batch, results):
+                    if result.get("ok", False):
+                        done.append((username, queued_utc))
+                    elif attempts + 1 >= FLAIR_MAX_ATTEMPTS:
+                        self.logger.error("Giving up on setting flair of {} to class {}, text {} after {} attempts: {}"
+                                          .format(username, css_class, text, attempts + 1, result))
+                        done.append((username, queued_utc))
+                    else:
+                        failed.append((username, queued_utc))
+                        refused.append(username)
+                with self.user_db.transaction():
+                    self.user_db.remove_flair_journal(done)
+                    self.user_db.add_flair_journal_attempt(failed)
+            if refused:
+                self.logger.warning("Reddit refused the flair of {}, sending it again with the next flush"
+                                    .format(", ".join(refused)))
+            if journal:
+                self.logger.info("Sent {} flair changes".format(len(journal) - len(refused)))
 
     def get_new(self, limit=20):
         """ Get new posts """
         return self.subreddit.new(limit=limit)
 
-    @staticmethod
-    def _get_replies(item):
-        """ Get replies to submission or comment """
-        if isinstance(item, praw.models.reddit.submission.Submission):
+    @metrics.staged("get_new_since")
+    def get_new_since(self, fullname=None, created_utc=0, limit=None):
+        """ Page back through new posts until the post with fullname is reached, returns oldest first """
+        posts = []
+        for post in self.subreddit.new(limit=limit):
+            if post.fullname == fullname or post.created_utc < created_utc:
+                break
+            posts.append(post)
+        posts.reverse()
+        return posts
+
+    def stream_new(self, pause_after=0):
+        """ Stream new posts, yields None whenever a poll returns nothing new """
+        return self.subreddit.stream.submissions(pause_after=pause_after)
+
+    def _get_replies(self, item):
+        """ Get replies to submission or comment, replies of comments not covered by the reply index are loaded """
+        from praw.models import Comment, Submission
+        if isinstance(item, Submission):
             comments = item.comments
-        elif isinstance(item, praw.models.reddit.comment.Comment):
-            comments = item.replies
+        elif isinstance(item, Comment):
+            # Comments from listings have no replies until they are refreshed
+            comments = self.get_replies(item)
         else:
             raise TypeError("Unknown item type {}".format(type(item)))
         return comments
 
-    def get_mods(self):
-        """ Cache mods """
-        if self._mods is None:
-            self._mods = self.subreddit.moderator()
-        return self._mods
-
     def check_mod_reply(self, item):
         """ Check if mod already has replied """
+        if self.reply_index is not None and self.reply_index.covers(item):
+            return bool(self.reply_index.get(item, "mod"))
+
         comments = self._get_replies(item)
 
         for comment in comments:
-            if comment.author in self.get_mods():
+            if self.is_mod(comment.author):
                 return True
         return False
 
     def check_bot_reply(self, item):
         """ Check if bot has replied, if so return comment """
+        if self.reply_index is not None and self.reply_index.covers(item):
+            bot_replies = self.reply_index.get(item, "bot")
+            return bot_replies[0] if bot_replies else None
+
         comments = self._get_replies(item)
 
         for comment in comments:
@@ -173,12 +757,4 @@ class SubRedditMod(object):
 
     def check_user_suspended(self, user):
         """ Check if user is suspended/shadowbanned """
-        if user.name in self._suspended:
-            return self._suspended[user.name]
-
-        if hasattr(user, 'fullname'):
-            self._suspended[user.name] = False
-            return False
-
-        self._suspended[user.name] = True
-        return True
+        return self.get_profile(user).suspended
@@ -0,0 +1,146 @@
+""" Near-duplicate detection of submission texts using MinHash and locality sensitive hashing """
+
+import re
+import time
+import array
+import random
+import struct
+import sqlite3
+import hashlib
+import threading
+from collections import namedtuple
+
+
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS = NUM_PERMUTATIONS // BANDS
+SHINGLE_WORDS = 3
+# Texts with fewer shingles than this are too short to say anything about
+MIN_SHINGLES = 8
+
+_PRIME = (1 << 61) - 1
+_MASK = (1 << 32) - 1
+_WORD_PATTERN = re.compile(r"\w+")
+
+DuplicateMatch = namedtuple("DuplicateMatch", ["post_id", "author", "created_utc", "similarity"])
+
+
+def _hash64(data):
+    return struct.unpack("<q", hashlib.blake2b(data, digest_size=8).digest())[0]
+
+
+# Fixed seed, signatures are stored and have to stay comparable between runs
+_rng = random.Random(0x5ca1ab1e)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERMUTATIONS)]
+
+
+def shingles(text):
+    """ Get the set of word shingles of text """
+    words = _WORD_PATTERN.findall(text.lower())
+    return {" ".join(words[index:index + SHINGLE_WORDS]) for index in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def signature(text):
+    """ Get MinHash signature of text, None if the text is too short """
+    shingle_set = shingles(text)
+    if len(shingle_set) < MIN_SHINGLES:
+        return None
+    hashes = [_hash64(shingle.encode()) & ((1 << 61) - 1) for shingle in shingle_set]
+    return array.array("I", (min([(a * value + b) % _PRIME for value in hashes]) & _MASK
+                             for a, b in _PERMUTATIONS))
+
+
+def _band_buckets(sig):
+    """ Get the LSH bucket of each band, the band number is hashed in so buckets of different bands never collide """
+    return [_hash64(struct.pack("<B", band) + sig[band * ROWS:(band + 1) * ROWS].tobytes())
+            for band in range(BANDS)]
+
+
+def similarity(sig_a, sig_b):
+    """ Estimated Jaccard similarity of the texts of two signatures """
+    return sum(1 for value_a, value_b in zip(sig_a, sig_b) if value_a == value_b) / float(NUM_PERMUTATIONS)
+
+
+class DupeIndex(object):
+    """ Persistent LSH index of recent submission texts """
+
+    def __init__(self, path, threshold=0.7, window=30 * 24 * 3600):
+        self._threshold = threshold
+        self._window = window
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path, check_same_thread=False)
+        self._con.execute('PRAGMA journal_mode=WAL')
+        self._con.execute('PRAGMA synchronous=NORMAL')
+        self._con.execute('CREATE TABLE IF NOT EXISTS post ('
+                          'post_id TEXT PRIMARY KEY NOT NULL, '
+                          'author TEXT NOT NULL, '
+                          'created_utc REAL NOT NULL, '
+                          'signature BLOB NOT NULL)')
+        self._con.execute('CREATE INDEX IF NOT EXISTS post_created ON post (created_utc)')
+        self._con.execute('CREATE TABLE IF NOT EXISTS band ('
+                          'bucket INTEGER NOT NULL, '
+                          'post_id TEXT NOT NULL)')
+        self._con.execute('CREATE INDEX IF NOT EXISTS band_bucket ON band (bucket)')
+        self._con.execute('CREATE INDEX IF NOT EXISTS band_post ON band (post_id)')
+        self._con.commit()
+        self._last_prune = 0
+
+    def __len__(self):
+        with self._lock:
+            return self._con.execute('SELECT COUNT(*) FROM post').fetchone()[0]
+
+    def _find(self, sig, buckets, author, created_utc):
+        """ Find the most similar earlier post by another author """
+        candidates = self._con.execute(
+            'SELECT post_id, author, created_utc, signature FROM post '
+            'WHERE post_id IN (SELECT post_id FROM band WHERE bucket IN ({})) '
+            'AND created_utc >= ?'.format(", ".join("?" for _ in buckets)),
+            buckets + [created_utc - self._window]).fetchall()
+        best = None
+        for post_id, candidate_author, candidate_created, candidate_sig in candidates:
+            if candidate_author.lower() == author.lower():
+                continue
+            score = similarity(sig, array.array("I", candidate_sig))
+            if score >= self._threshold and (best is None or score > best.similarity):
+                best = DuplicateMatch(post_id, candidate_author, candidate_created, score)
+        return best
+
+    def check_and_add(self, post_id, author, created_utc, text):
+        """
+        Add text of a submission to the index
+
+        Returns a DuplicateMatch for the most similar earlier submission by another author,
+        None if there is no such submission.
+        """
+        sig = signature(text)
+        if sig is None:
+            return None
+        buckets = _band_buckets(sig)
+        with self._lock:
+            if self._con.execute('SELECT 1 FROM post WHERE post_id=?', (post_id,)).fetchone():
+                return None
+            match = self._find(sig, buckets, author, created_utc)
+            self._con.execute('INSERT INTO post (post_id, author, created_utc, signature) VALUES (?, ?, ?, ?)',
+                              (post_id, author, created_utc, sig.tobytes()))
+            self._con.executemany('INSERT INTO band (bucket, post_id) VALUES (?, ?)',
+                                  [(bucket, post_id) for bucket in buckets])
+            self._prune()
+            self._con.commit()
+        return match
+
+    def _prune(self, interval=3600):
+        """ Drop posts that are older than the window, at most once per interval """
+        now = time.time()
+        if now - self._last_prune < interval:
+            return
+        self._last_prune = now
+        oldest_allowed = now - self._window
+        self._con.execute('DELETE FROM band WHERE post_id IN (SELECT post_id FROM post WHERE created_utc < ?)',
+                          (oldest_allowed,))
+        self._con.execute('DELETE FROM post WHERE created_utc < ?', (oldest_allowed,))
+
+    def seed(self, history):
+        """ Add recent submissions from a HistoryStore """
+        for submission in history.iter_since(time.time() - self._window):
+            self.check_and_add(submission.post_id, submission.author, submission.created_utc,
+                               submission.title + "\n" + submission.body)
@@ -1,12 +1,17 @@
 #!/usr/bin/env python2
 
 import sys
+import os
 import re
+import time
 import argparse
 from datetime import datetime
+from contextlib import contextmanager
 
+import metrics
 from log_conf import LoggerManager
 from common import SubRedditMod
+from usernotes import warning_types
 
 # Configure logging
 LOGGER = LoggerManager().getLogger("trade_flair")
@@ -15,14 +20,15 @@ LOGGER = LoggerManager().getLogger("trade_flair")
 class TradeFlairer(object):
     """ Trade flair helper """
 
-    def __init__(self, subreddit, logger):
+    def __init__(self, subreddit, logger, user_db):
         self._subreddit = subreddit
         self._config = subreddit.config["trade"]
-        self.completed = []
-        self.pending = []
-        self._trade_count_cache = {}
+        self._user_db = user_db
+        self.completed = set()
+        self.pending = set()
         self._current_submission = None
         self._logger = logger
+        self._usernote_warnings = warning_types(self._config.get("usernote_warnings"))
 
     def open_submission(self, submission):
         if submission == "curr":
@@ -33,39 +39,59 @@ class TradeFlairer(object):
 
         self._logger.info("Opening trade confirmation submission {id}".format(id=submission))
 
-        with open(submission + "_completed.log", "a+") as completed_file:
-            completed_file.seek(0)
-            self.completed = completed_file.read().splitlines()
-
-        with open(submission + "_pending.log", "a+") as pending_file:
-            pending_file.seek(0)
-            self.pending = pending_file.read().splitlines()
+        self._import_logs(submission)
+
+        states = self._user_db.get_trade_states(submission)
+        self.completed = {comment_id for comment_id, state in states.items() if state == "completed"}
+        self.pending = {comment_id for comment_id, state in states.items() if state == "pending"}
+
+    def _import_logs(self, submission):
+        """ Import <id>_completed.log and <id>_pending.log kept by older versions """
+        logs = {}
+        for state in ("completed", "pending"):
+            path = "{id}_{state}.log".format(id=submission, state=state)
+            if os.path.exists(path):
+                with open(path) as log_file:
+                    logs[path] = [line for line in log_file.read().splitlines() if line]
+        if not logs:
+            return
+        self._logger.info("Importing trade confirmation logs for {id}".format(id=submission))
+        self._user_db.import_trade_states(submission,
+                                          logs.get("{id}_completed.log".format(id=submission), []),
+                                          logs.get("{id}_pending.log".format(id=submission), []))
+        for path in logs:
+            os.rename(path, path + ".imported")
 
     def close_submission(self):
         assert self._current_submission
-        if self.pending:
-            with open(self._current_submission + "_pending.log", "w") as pending_file:
-                pending_file.write("\n".join(self.pending))
         self._current_submission = None
 
     def add_completed(self, comment):
         assert self._current_submission
-        self.completed.append(comment.id)
-        with open(self._current_submission + "_completed.log", "a") as completed_file:
-            completed_file.write("{id}\n".format(id=comment.id))
+        self.completed.add(comment.id)
+        self.pending.discard(comment.id)
+        self._user_db.remove_edit_requests(self._current_submission, comment.id)
+        self._user_db.set_trade_state(self._current_submission, comment.id, "completed")
+
+    def add_edit_request(self, comment, root_id):
+        """ Check top level comment root_id again when comment, that the bot asked to be edited, is edited """
+        assert self._current_submission
+        self._user_db.add_edit_request(self._current_submission, comment.id, root_id)
 
     def add_pending(self, comment):
         assert self._current_submission
-        self.pending.append(comment.id)
+        self.pending.add(comment.id)
+        self._user_db.set_trade_state(self._current_submission, comment.id, "pending")
 
     def remove_pending(self, comment):
         assert self._current_submission
-        self.pending.remove(comment.id)
+        self.pending.discard(comment.id)
+        self._user_db.remove_trade_state(self._current_submission, comment.id, "pending")
 
     def get_unhandled_comments(self):
         assert self._current_submission
         comments = self._subreddit.get_top_level_comments(self._current_submission)
-        handled = self.completed + self.pending
+        handled = self.completed | self.pending
         unhandled = [comment for comment in comments if comment.id not in handled]
         self._logger.info("Checking {unhandled} out of {total} comments ({pending} pending)"
                           .format(unhandled=len(unhandled), total=len(comments),
@@ -83,6 +109,7 @@ class TradeFlairer(object):
                 comment.reply("Could not find user mention, "
                               "please edit your comment and make sure the username "
                               "starts with /u/ (no explicit linking!)")
+            self.add_edit_request(comment, comment.id)
             return None
 
         match = {user.lower() for user in match}
@@ -90,6 +117,7 @@ class TradeFlairer(object):
             if not bot_reply:
                 comment.reply("Found multiple usernames, "
                               "please only include one user per confirmation comment")
+            self.add_edit_request(comment, comment.id)
             return None
 
         if bot_reply:
@@ -102,6 +130,7 @@ class TradeFlairer(object):
         if "confirmed" not in comment.body.lower():
             if not bot_reply:
                 comment.reply('Could not find "confirmed" in comment, please edit your comment')
+            self.add_edit_request(comment, comment.parent_id.split("_", 1)[1])
             return False
 
         if bot_reply:
@@ -125,14 +154,20 @@ class TradeFlairer(object):
 
     def check_requirements(self, parent, reply):
         for comment in [parent, reply]:
-            if self._subreddit.check_user_suspended(comment.author):
+            profile = self._subreddit.get_profile(comment.author)
+            if profile.suspended:
                 return False
             if comment.banned_by:
                 comment.report("Flair: Banned user")
                 return False
+            note = self._get_warning_note(comment.author)
+            if note is not None:
+                # Report reasons are limited to 100 characters
+                comment.report("Flair: Usernote ({0}): {1}".format(note.warning, note.note)[:100])
+                return False
 
-            karma = comment.author.link_karma + comment.author.comment_karma
-            age = (datetime.utcnow() - datetime.utcfromtimestamp(comment.author.created_utc)).days
+            karma = profile.link_karma + profile.comment_karma
+            age = (datetime.utcnow() - datetime.utcfromtimestamp(profile.created_utc)).days
             trade_count = self.get_author_trade_count(comment)
 
             if trade_count is not None and trade_count < int(self._config["flair_check"]):
@@ -145,20 +180,20 @@ class TradeFlairer(object):
 
         return True
 
-    def get_author_trade_count(self, item):
-        if item.author.name in self._trade_count_cache:
-            return self._trade_count_cache[item.author.name]
-        if not item.author_flair_css_class:
-            return 0
+    def _get_warning_note(self, author):
+        """ Get the latest usernote on author with one of the warning types sending trades to review """
+        if not self._usernote_warnings:
+            return None
+        for note in self._subreddit.get_usernotes(author.name):
+            if note.warning in self._usernote_warnings:
+                return note
+        return None
 
-        trade_count = item.author_flair_css_class.lstrip("i-")
-        try:
-            trade_count = int(trade_count)
-        except ValueError:
-            trade_count = None
-        return trade_count
+    def get_author_trade_count(self, item):
+        return self._subreddit.get_user_trade_count(item)
 
     def flair(self, parent, reply, dock_trade=False):
+        """ Queue the flair changes of a trade, only stored in the user db until flush_flair """
         for comment in parent, reply:
             trade_count = self.get_author_trade_count(comment)
             if trade_count is not None:
@@ -168,107 +203,228 @@ class TradeFlairer(object):
                     trade_count += 1
                 new_flair_css_class = "i-{trade_count}".format(trade_count=trade_count)
                 self._subreddit.update_comment_user_flair(comment, css_class=new_flair_css_class)
-                self._trade_count_cache[comment.author.name] = trade_count
-
-        if not dock_trade:
-            try:
-                reply.reply(self._config["reply"])
-            except Exception:
-                LOGGER.info("Failed to reply, probably because of too old comment")
 
-    def process_post(self, post):
+    def complete(self, parent, reply):
+        """ Flair a confirmed trade and mark it completed, then reply to the confirmation """
+        # Flair and completed state are stored together, so a trade is never counted twice.
+        # Nothing goes to reddit while the transaction holds the db
+        with self._user_db.transaction():
+            self.flair(parent, reply)
+            self.add_completed(parent)
+        try:
+            reply.reply(self._config["reply"])
+        except Exception:
+            LOGGER.info("Failed to reply, probably because of too old comment")
+
+    @metrics.staged("process_comment")
+    def process_comment(self, comment):
+        if not hasattr(comment.author, 'name'):
+            # Deleted comment, ignore comment and move on
+            self.add_completed(comment)
+            return
+
+        tagged_user = self.check_top_level_comment(comment)
+        if tagged_user is None:
+            return
+        elif tagged_user.lower() == comment.author.name.lower():
+            comment.report("Flair: Self-tagging")
+
+        for reply in comment.replies:
+            if not hasattr(reply.author, 'name'):
+                # Deleted comment, ignore comment and move on
+                continue
+            if reply.author.name.lower() == tagged_user.lower():
+                if not self.check_reply(reply):
+                    continue
 
-        self.open_submission(post)
+                if self.check_requirements(comment, reply):
+                    self.complete(comment, reply)
+                    metrics.ITEMS.inc(kind="trade_confirmation", result="completed")
+                else:
+                    self.add_pending(comment)
+                    metrics.ITEMS.inc(kind="trade_confirmation", result="pending")
+                break
+            else:
+                reply.report("User not tagged in parent")
 
+    @contextmanager
+    def _comment_errors(self, comment_id):
+        """ Log errors processing a comment, so one failing comment does not stop the scan """
+        try:
+            yield
+        except Exception as exception:
+            # Not stored as handled, so it is checked again by the next full scan
+            self._logger.error("Failed to process comment {id}: {error}".format(id=comment_id, error=exception),
+                               extra={"comment_id": comment_id})
+            metrics.ITEMS.inc(kind="trade_confirmation", result="error")
+
+    @metrics.staged("full_scan")
+    def _full_scan(self, now):
         for comment in self.get_unhandled_comments():
-            if not hasattr(comment.author, 'name'):
-                # Deleted comment, ignore comment and move on
-                self.add_completed(comment)
-                continue
+            with self._comment_errors(comment.id):
+                self.process_comment(comment)
+        # Every comment made before the scan started has been seen
+        self._user_db.set_thread_scan(self._current_submission, now, now)
+
+    @metrics.staged("incremental_scan")
+    def _incremental_scan(self, now, last_scan_utc, last_full_scan_utc):
+        """
+        Process only top level comments that are new, got new replies or were edited after the bot asked
+        for it since the last scan
+
+        Other edits are only seen by the next full scan. Returns False if the new comments could not be
+        determined and a full scan is needed.
+        """
+        # Overlap a bit with the previous scan, processing a comment twice is harmless
+        new_comments = self._subreddit.get_new_thread_comments(self._current_submission, last_scan_utc - 60)
+        if new_comments is None:
+            return False
 
-            tagged_user = self.check_top_level_comment(comment)
-            if tagged_user is None:
-                continue
-            elif tagged_user.lower() == comment.author.name.lower():
-                comment.report("Flair: Self-tagging")
+        link_fullname = "t3_" + self._current_submission
+        changed = set()
+        for comment in new_comments:
+            if comment.parent_id == link_fullname:
+                changed.add(comment.id)
+            elif comment.parent_id.startswith("t1_"):
+                changed.add(comment.parent_id[3:])
+        edit_requests = self._user_db.get_edit_requests(self._current_submission)
+        if edit_requests:
+            # Edits don't show up in the comment listing, look the comments up together
+            for comment in self._subreddit.get_comments(edit_requests).values():
+                if comment.edited and comment.edited >= last_scan_utc - 60:
+                    changed.add(edit_requests[comment.id])
+        changed -= self.completed | self.pending
+
+        self._logger.info("Checking {changed} changed comments out of {new} new comments ({pending} pending)"
+                          .format(changed=len(changed), new=len(new_comments), pending=len(self.pending)))
+        for comment_id in changed:
+            with self._comment_errors(comment_id):
+                comment = self._subreddit.get_comment(comment_id)
+                if comment.is_root:
+                    self.process_comment(comment)
+
+        self._user_db.set_thread_scan(self._current_submission, now, last_full_scan_utc)
+        return True
 
-            for reply in comment.replies:
-                if not hasattr(reply.author, 'name'):
-                    # Deleted comment, ignore comment and move on
-                    continue
-                if reply.author.name.lower() == tagged_user.lower():
-                    if not self.check_reply(reply):
-                        continue
-
-                    if self.check_requirements(comment, reply):
-                        self.flair(comment, reply)
-                        self.add_completed(comment)
-                    else:
-                        self.add_pending(comment)
-                    break
-                else:
-                    reply.report("User not tagged in parent")
+    @metrics.staged("process_post")
+    def process_post(self, post, full=False):
+
+        self.open_submission(post)
 
+        now = time.time()
+        full_scan = True
+        scan = self._user_db.get_thread_scan(self._current_submission)
+        full_scan_interval = int(self._config.get("full_scan_interval") or 24) * 3600
+        if full or scan is None or now - scan[1] >= full_scan_interval:
+            self._full_scan(now)
+        elif not self._incremental_scan(now, *scan):
+            self._logger.info("Comment listing does not reach back to the last scan, doing a full scan")
+            self._full_scan(now)
+        else:
+            full_scan = False
+
+        self._logger.info("Processed trade confirmation submission {id}".format(id=self._current_submission),
+                          extra={"post_id": self._current_submission, "full_scan": full_scan,
+                                 "duration_ms": round((time.time() - now) * 1000, 1)})
         self.close_submission()
 
+    @metrics.staged("mod_messages")
     def process_mod_messages(self):
-
+        """
+        Flair trades submitted by mods through PMs
+
+        The submitted comments are fetched in one batch and grouped by confirmation thread,
+        so each thread is opened once and the replies of its comments are loaded together.
+        Handled messages are marked read together at the end.
+        """
+        pattern = r"^https?:\/\/(?:www\.)?reddit\.com\/r\/.*\/comments\/.{6}\/.*\/(.{7})\/$"
+        handled = []
+        requests = []
         for msg in self._subreddit.get_unread_mod_messages():
-            LOGGER.info("Processing PM from mod: " + msg.author.name)
-            pattern = r"^https?:\/\/(?:www\.)?reddit\.com\/r\/.*\/comments\/.{6}\/.*\/(.{7})\/$"
+            LOGGER.info("Processing PM from mod: " + msg.author.name, extra={"author": msg.author.name})
+            metrics.ITEMS.inc(kind="mod_message", result="received")
             comment_link = re.search(pattern, msg.body)
             if not comment_link:
                 msg.reply("You have submitted an invalid URL")
-                msg.mark_read()
+                handled.append(msg)
                 continue
+            requests.append((msg, comment_link.group(1)))
 
-            comment_id = comment_link.group(1)
-            comment = self._subreddit.praw_h.comment(id=comment_id).refresh()
-
+        try:
+            comments = self._subreddit.get_comments(comment_id for _, comment_id in requests)
+            by_submission = {}
+            for msg, comment_id in requests:
+                comment = comments.get(comment_id)
+                if comment is None:
+                    msg.reply("Could not find comment {id}".format(id=comment_id))
+                    handled.append(msg)
+                    continue
+                # TODO: Restore when stop supporting old confirmation threads
+                # tagged_user = self.check_top_level_comment(comment)
+                # if tagged_user is None:
+                if "u/" not in comment.body.lower():
+                    msg.reply("Could not find /u/[user] in comment, sure you submitted the top level comment?")
+                    handled.append(msg)
+                    continue
+                by_submission.setdefault(comment.link_id.split("_", 1)[1], []).append((msg, comment))
+
+            for submission_id, submission_requests in by_submission.items():
+                self.open_submission(submission_id)
+                self._subreddit.load_reply_trees(submission_id, [comment for _, comment in submission_requests])
+                for msg, comment in submission_requests:
+                    self._process_mod_message(msg, comment)
+                    handled.append(msg)
+                self.close_submission()
+        finally:
+            self._subreddit.mark_read(handled)
+
+    def _process_mod_message(self, msg, comment):
+        if comment.id in self.completed:
+            msg.reply("Trade already completed")
+            return
+
+        # TODO: Restore when stop supporting old confirmation threads
+        # if comment.id not in self.pending:
+        #     msg.reply("Could not find comment {id} in pending trade confirmations"
+        #               .format(id=comment.id))
+        #     return
+
+        if comment.mod_reports:
+            comment.mod.approve()
+        for reply in self._subreddit.get_replies(comment):
             # TODO: Restore when stop supporting old confirmation threads
-            # tagged_user = self.check_top_level_comment(comment)
-            # if tagged_user is None:
-            if "u/" not in comment.body.lower():
-                msg.reply("Could not find /u/[user] in comment, sure you submitted the top level comment?")
-                msg.mark_read()
-                continue
+            # if reply.author.name.lower() == tagged_user.lower():
+            if reply.author.name.lower() in comment.body.lower():
+                if not self.check_reply(reply):
+                    continue
+                if reply.mod_reports:
+                    reply.mod.approve()
+                self.complete(comment, reply)
+                msg.reply("Trade flair added for {comment} and {reply}"
+                          .format(comment=comment.author.name, reply=reply.author.name))
+                return
+        msg.reply("Could not find confirmation reply on submitted comment")
 
-            self.open_submission(comment.submission.id)
 
-            if comment_id in self.completed:
-                msg.reply("Trade already completed")
-                msg.mark_read()
-                continue
+def run(subreddit, post="curr", pm_only=False, full=False, sync_flair=False):
+    """ Process a trade confirmation thread and mod PMs with an existing SubRedditMod """
+    # Send flair changes left by a failed run before syncing, so the sync does not overwrite them
+    subreddit.flush_flair()
+    if sync_flair or subreddit.user_db.get_meta("flair_synced_utc") is None:
+        subreddit.sync_flair_ledger()
 
-            # TODO: Restore when stop supporting old confirmation threads
-            # if comment_id not in self.pending:
-            #     msg.reply("Could not find comment {id} in pending trade confirmations"
-            #               .format(id=comment_id))
-            #     msg.mark_read()
-            #     continue
-
-            if comment.mod_reports:
-                comment.mod.approve()
-            for reply in comment.replies:
-                # TODO: Restore when stop supporting old confirmation threads
-                # if reply.author.name.lower() == tagged_user.lower():
-                if reply.author.name.lower() in comment.body.lower():
-                    if not self.check_reply(reply):
-                        continue
-                    if reply.mod_reports:
-                        reply.mod.approve()
-                    self.flair(comment, reply)
-                    self.add_completed(comment)
-                    if comment.id in self.pending:
-                        self.remove_pending(comment)
-                    msg.reply("Trade flair added for {comment} and {reply}"
-                              .format(comment=comment.author.name, reply=reply.author.name))
-                    msg.mark_read()
-                    break
-            else:
-                msg.reply("Could not find confirmation reply on submitted comment")
-                msg.mark_read()
-            self.close_submission()
+    # Setup tradeflairer
+    trade_flairer = TradeFlairer(subreddit, LOGGER, subreddit.user_db)
+
+    try:
+        if not pm_only:
+            trade_flairer.process_post(post, full)
+
+        trade_flairer.process_mod_messages()
+    finally:
+        subreddit.flush_flair()
+        subreddit.flush_usernotes()
+        LOGGER.info("Profile cache: {}".format(subreddit.profiles))
 
 
 def main():
@@ -278,19 +434,17 @@ def main():
                         help="Which trade post to process (curr, prev or submission id)")
     parser.add_argument("-p", "--pm", dest="pm_only", default=False, action="store_true",
                         help="Only process PMs (from mods)")
+    parser.add_argument("-f", "--full", dest="full", default=False, action="store_true",
+                        help="Check all comments instead of only new ones")
+    parser.add_argument("-s", "--sync-flair", dest="sync_flair", default=False, action="store_true",
+                        help="Sync the flair ledger in the user db with the subreddit flair list")
     args = parser.parse_args()
 
     try:
         # Setup SubRedditMod
         subreddit = SubRedditMod(LOGGER)
-
-        # Setup tradeflairer
-        trade_flairer = TradeFlairer(subreddit, LOGGER)
-
-        if not args.pm_only:
-            trade_flairer.process_post(args.post)
-
-        trade_flairer.process_mod_messages()
+        metrics.setup(subreddit.config, "flair")
+        run(subreddit, args.post, args.pm_only, args.full, args.sync_flair)
 
     except KeyboardInterrupt:
         print("\nCtrl-C pressed, exiting gracefully")
@@ -2,6 +2,10 @@
 """ Heatware flair updater """
 
 import re
+import time
+import argparse
+
+import metrics
 from log_conf import LoggerManager
 from common import SubRedditMod
 
@@ -9,53 +13,195 @@ from common import SubRedditMod
 LOGGER = LoggerManager().getLogger("heatware")
 
 
-def process_comment(subreddit, cfg, comment):
-    """ Process a heatware thread comment"""
-    LOGGER.debug("Processing comment: " + comment.id)
+def get_heatware_id(match):
+    """ Get the id of the profile a heatware link (match of the configured regex) points to """
+    if "id" in match.re.groupindex:
+        return match.group("id")
+    # Profile links have several forms (eval.php?id=<id>, u/<id>), all with the same number
+    numbers = re.findall(r"\d+", match.group(0))
+    return numbers[-1] if numbers else match.group(0).lower()
+
+
+def seed_claims(user_db, regex):
+    """ Claim the heatware profiles linked in the flair of users in the flair ledger, once """
+    if user_db.get_meta("heatware_claims_seeded_utc") is not None:
+        return
+    flair_texts = user_db.get_flair_texts()
+    if not flair_texts:
+        # Flair ledger not synced yet
+        return
+    claims = {}
+    for username, flair_text in flair_texts:
+        match = regex.search(flair_text)
+        if not match:
+            continue
+        heatware_id = get_heatware_id(match)
+        if heatware_id in claims:
+            LOGGER.warning("Heatware {id} is in the flair of both /u/{first} and /u/{second}"
+                           .format(id=heatware_id, first=claims[heatware_id], second=username))
+            continue
+        claims[heatware_id] = username
+    user_db.import_heatware_claims(claims.items())
+    user_db.set_meta("heatware_claims_seeded_utc", time.time())
+    LOGGER.info("Seeded {} heatware claims from the flair ledger".format(len(claims)))
+
+
+def check_comment(subreddit, cfg, regex, comment):
+    """
+    Decide what to do with a heatware thread comment
+
+    Returns (claim, actions, result). claim is the (heatware id, flair text) to give the author, None to
+    leave the flair alone. actions are the (method, argument) calls (reply, report) to make on the comment.
+    """
     if subreddit.check_mod_reply(comment):
         # If a mod has already replied, case closed
-        return
+        return None, [], "mod_replied"
 
-    heatware = re.search(cfg["regex"], comment.body)
+    heatware = regex.search(comment.body)
     if not heatware:
         # If no match, notify user
-        comment.reply("No heatware link found, please double check your link and make a new comment")
-        return
+        return None, [("reply", "No heatware link found, please double check your link and make a new comment")], \
+            "no_link"
 
-    new_flair = heatware.group(0)
+    claim = (get_heatware_id(heatware), heatware.group(0))
+    claimed_by = subreddit.user_db.get_heatware_claim(claim[0])
+    if claimed_by is not None and claimed_by.lower() != comment.author.name.lower():
+        LOGGER.warning("Heatware {id} claimed by /u/{user} is already claimed by /u/{claimed_by}"
+                       .format(id=claim[0], user=comment.author.name, claimed_by=claimed_by),
+                       extra={"comment_id": comment.id, "author": comment.author.name})
+        # Report reasons are limited to 100 characters
+        return None, [("report", "Heatware already claimed by /u/{}".format(claimed_by)[:100])], "claimed"
+
+    actions = []
     if comment.author_flair_text:
         # If user already have flair text set
         if cfg["overwrite_flair"]:
-            subreddit.update_comment_user_flair(comment, text=new_flair)
             if cfg["report_overwrite"]:
-                comment.report("Overwritten flair: %s" % comment.author_flair_text)
+                actions.append(("report", "Overwritten flair: %s" % comment.author_flair_text))
         else:
+            claim = None
             if cfg["report_overwrite"]:
-                comment.report("User already has flair")
+                actions.append(("report", "User already has flair"))
         if cfg["overwrite_msg"]:
-            comment.reply(cfg["overwrite_msg"])
+            actions.append(("reply", cfg["overwrite_msg"]))
+        return claim, actions, "overwritten" if cfg["overwrite_flair"] else "has_flair"
+
+    if cfg["add_msg"]:
+        actions.append(("reply", cfg["add_msg"]))
+    return claim, actions, "added"
+
+
+def process_comment(subreddit, cfg, regex, link_id, comment):
+    """
+    Process a heatware thread comment
+
+    The flair, claim and handled state are committed before replying or reporting, so the db is not
+    held during the requests and a comment whose reply fails is not processed again.
+    """
+    LOGGER.debug("Processing comment: " + comment.id, extra={"comment_id": comment.id, "author": str(comment.author)})
+    if comment.author is None:
+        # Deleted comment
+        claim, actions, result = None, [], "deleted"
     else:
-        subreddit.update_comment_user_flair(comment, text=new_flair)
-        if cfg["add_msg"]:
-            comment.reply(cfg["add_msg"])
+        claim, actions, result = check_comment(subreddit, cfg, regex, comment)
+
+    user_db = subreddit.user_db
+    with user_db.transaction():
+        if claim is not None:
+            heatware_id, flair_text = claim
+            subreddit.update_comment_user_flair(comment, text=flair_text)
+            user_db.set_heatware_claim(heatware_id, comment.author.name, comment.id)
+        user_db.add_handled_comment(link_id, comment.id)
+    metrics.ITEMS.inc(kind="heatware", result=result)
+
+    for method, argument in actions:
+        try:
+            getattr(comment, method)(argument)
+        except Exception as exception:
+            LOGGER.error("Failed to {method} on comment {id}: {error}"
+                         .format(method=method, id=comment.id, error=exception), extra={"comment_id": comment.id})
 
 
-def process_thread(subreddit):
-    """ Get and process heatware thread comments """
+def get_new_root_comments(subreddit, link_id, last_scan_utc):
+    """ Get top level comments made since the last scan, None if they could not be determined """
+    # Overlap a bit with the previous scan, handled comments are skipped
+    new_comments = subreddit.get_new_thread_comments(link_id, last_scan_utc - 60)
+    if new_comments is None:
+        return None
+    link_fullname = "t3_" + link_id
+    return [comment for comment in new_comments if comment.parent_id == link_fullname]
+
+
+@metrics.staged("heatware")
+def process_thread(subreddit, full=False):
+    """
+    Get and process heatware thread comments
+
+    Only top level comments made since the last run are fetched, all of them are fetched every
+    full_scan_interval hours, when the comment listing does not reach back to the last run or with full.
+    Comments that have been handled are never processed again. The comment listing has no replies, the
+    replies of new comments are loaded together to check for mod replies.
+    """
     cfg = subreddit.config["heatware"]
-    comments = subreddit.get_all_comments(cfg["link_id"])
-    for comment in comments:
-        if not hasattr(comment, 'author'):
-            continue
-        if comment.is_root is True:
-            process_comment(subreddit, cfg, comment)
+    link_id = cfg["link_id"]
+    user_db = subreddit.user_db
+    regex = re.compile(cfg["regex"])
+    seed_claims(user_db, regex)
+
+    now = time.time()
+    comments = None
+    incremental = False
+    last_full_scan_utc = now
+    scan = user_db.get_thread_scan(link_id)
+    full_scan_interval = int(cfg.get("full_scan_interval") or 24) * 3600
+    if not full and scan is not None and now - scan[1] < full_scan_interval:
+        comments = get_new_root_comments(subreddit, link_id, scan[0])
+        if comments is None:
+            LOGGER.info("Comment listing does not reach back to the last scan, doing a full scan")
+        else:
+            last_full_scan_utc = scan[1]
+            incremental = True
+    if comments is None:
+        comments = list(subreddit.get_top_level_comments(link_id))
+
+    handled = user_db.get_handled_comments(link_id)
+    # Oldest first, the first user linking a heatware profile claims it
+    unhandled = sorted((comment for comment in comments if comment.id not in handled),
+                       key=lambda comment: comment.created_utc)
+    LOGGER.info("Checking {unhandled} out of {total} comments".format(unhandled=len(unhandled), total=len(comments)))
+    if incremental and unhandled:
+        subreddit.load_reply_trees(link_id, unhandled)
+    for comment in unhandled:
+        try:
+            process_comment(subreddit, cfg, regex, link_id, comment)
+        except Exception as exception:
+            # Not stored as handled, so it is checked again by the next full scan
+            LOGGER.error("Failed to process comment {id}: {error}".format(id=comment.id, error=exception),
+                         extra={"comment_id": comment.id})
+            metrics.ITEMS.inc(kind="heatware", result="error")
+    user_db.set_thread_scan(link_id, now, last_full_scan_utc)
+
+
+def run(subreddit, full=False):
+    """ Process the heatware thread with an existing SubRedditMod """
+    try:
+        process_thread(subreddit, full)
+    finally:
+        subreddit.flush_flair()
+        subreddit.flush_usernotes()
 
 
 def main():
     """ Main function, tries to parse thread and adjust flairs """
+    parser = argparse.ArgumentParser(description="Process heatware flairs")
+    parser.add_argument("-f", "--full", dest="full", default=False, action="store_true",
+                        help="Check all comments instead of only new ones")
+    args = parser.parse_args()
+
     try:
         subreddit = SubRedditMod(LOGGER)
-        process_thread(subreddit)
+        metrics.setup(subreddit.config, "heatware")
+        run(subreddit, args.full)
     except Exception as exc:
         LOGGER.error(exc)
 
@@ -0,0 +1,136 @@
+""" Append-only store of user submission history """
+
+import os
+import re
+import json
+import zlib
+import struct
+import sqlite3
+import threading
+from collections import namedtuple
+
+
+Submission = namedtuple("Submission", ["post_id", "author", "created_utc", "title", "body"])
+
+_HEADER = struct.Struct(">I")
+_SEGMENT_PATTERN = re.compile(r"^history-(\d{6})\.seg$")
+
+
+class HistoryStore(object):
+    """
+    Submission history stored as zlib compressed records appended to segment files
+
+    Segments are rotated when they reach max_segment_bytes. An sqlite index maps post ids
+    and authors to the segment and offset of their records.
+    """
+
+    def __init__(self, path, max_segment_bytes=64 * 1024 * 1024):
+        self._path = path
+        self._max_segment_bytes = max_segment_bytes
+        self._lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._index = sqlite3.connect(os.path.join(path, "history.idx"), check_same_thread=False)
+        self._index.execute('PRAGMA journal_mode=WAL')
+        self._index.execute('CREATE TABLE IF NOT EXISTS submission ('
+                            'post_id TEXT PRIMARY KEY NOT NULL, '
+                            'author TEXT NOT NULL COLLATE NOCASE, '
+                            'created_utc REAL, '
+                            'segment INTEGER NOT NULL, '
+                            'offset INTEGER NOT NULL, '
+                            'length INTEGER NOT NULL)')
+        self._index.execute('CREATE INDEX IF NOT EXISTS submission_author ON submission (author, created_utc)')
+        self._index.commit()
+        segments = self._segments()
+        self._segment = segments[-1] if segments else 1
+        self._segment_file = None
+
+    def _segments(self):
+        return sorted(int(match.group(1)) for match in map(_SEGMENT_PATTERN.match, os.listdir(self._path))
+                      if match)
+
+    def _segment_path(self, segment):
+        return os.path.join(self._path, "history-{:06d}.seg".format(segment))
+
+    def _open_segment(self):
+        if self._segment_file is None:
+            self._segment_file = open(self._segment_path(self._segment), "ab")
+        if self._segment_file.tell() >= self._max_segment_bytes:
+            self._segment_file.close()
+            self._segment += 1
+            self._segment_file = open(self._segment_path(self._segment), "ab")
+        return self._segment_file
+
+    def append(self, post_id, author, created_utc, title, body, commit=True):
+        """ Append a submission, ignored if post_id is already stored """
+        record = zlib.compress(json.dumps({"id": post_id, "author": author, "created_utc": created_utc,
+                                           "title": title, "body": body}).encode())
+        with self._lock:
+            if self._index.execute('SELECT 1 FROM submission WHERE post_id=?', (post_id,)).fetchone():
+                return
+            segment_file = self._open_segment()
+            offset = segment_file.tell()
+            segment_file.write(_HEADER.pack(len(record)) + record)
+            segment_file.flush()
+            self._index.execute('INSERT INTO submission (post_id, author, created_utc, segment, offset, length) '
+                                'VALUES (?, ?, ?, ?, ?, ?)',
+                                (post_id, author, created_utc, self._segment, offset, len(record)))
+            if commit:
+                self._index.commit()
+
+    def commit(self):
+        with self._lock:
+            self._index.commit()
+
+    def close(self):
+        with self._lock:
+            self._index.commit()
+            self._index.close()
+            if self._segment_file is not None:
+                self._segment_file.close()
+
+    def _read(self, rows):
+        """ Read records for index rows of (segment, offset, length), grouped per segment """
+        submissions = []
+        rows = sorted(rows)
+        segment_file = None
+        current_segment = None
+        try:
+            for segment, offset, length in rows:
+                if segment != current_segment:
+                    if segment_file is not None:
+                        segment_file.close()
+                    segment_file = open(self._segment_path(segment), "rb")
+                    current_segment = segment
+                segment_file.seek(offset + _HEADER.size)
+                record = json.loads(zlib.decompress(segment_file.read(length)).decode())
+                submissions.append(Submission(record["id"], record["author"], record["created_utc"],
+                                              record["title"], record["body"]))
+        finally:
+            if segment_file is not None:
+                segment_file.close()
+        return submissions
+
+    def get(self, post_id):
+        """ Get a stored submission, None if unknown """
+        with self._lock:
+            rows = self._index.execute('SELECT segment, offset, length FROM submission WHERE post_id=?',
+                                       (post_id,)).fetchall()
+        submissions = self._read(rows)
+        return submissions[0] if submissions else None
+
+    def get_by_author(self, author):
+        """ Get all stored submissions by author, oldest first """
+        with self._lock:
+            rows = self._index.execute('SELECT segment, offset, length FROM submission WHERE author=?',
+                                       (author,)).fetchall()
+        return sorted(self._read(rows), key=lambda submission: submission.created_utc or 0)
+
+    def iter_since(self, created_utc, batch_size=1000):
+        """ Iterate over submissions created after created_utc, in the order they were stored """
+        with self._lock:
+            rows = self._index.execute('SELECT segment, offset, length FROM submission WHERE created_utc>? '
+                                       'ORDER BY segment, offset', (created_utc,)).fetchall()
+        for start in range(0, len(rows), batch_size):
+            for submission in self._read(rows[start:start + batch_size]):
+                yield submission
@@ -1,21 +1,140 @@
 import sys
 import os
+import copy
+import json
+import time
+import queue
+import stat
+import atexit
 from configparser import SafeConfigParser
 import logging
-
-# load config file
-containing_dir = os.path.abspath(os.path.dirname(sys.argv[0]))
-cfg_file = SafeConfigParser()
-path_to_cfg = os.path.join(containing_dir, 'config.cfg')
-cfg_file.read(path_to_cfg)
-sentry = cfg_file.get('logging', 'sentry')
-
+import logging.handlers
 
 try:
-    import sentry_sdk
+    import fcntl
 except ImportError:
-    # sentry_sdk not installed, skip sentry even though config exists
-    sentry = ""
+    # Windows, rotation is not coordinated between processes
+    fcntl = None
+
+
+def get_logging_config():
+    """ Read the logging section of config.cfg, empty if missing """
+    containing_dir = os.path.abspath(os.path.dirname(sys.argv[0]))
+    cfg_file = SafeConfigParser()
+    path_to_cfg = os.path.join(containing_dir, 'config.cfg')
+    cfg_file.read(path_to_cfg)
+    if not cfg_file.has_section('logging'):
+        return {}
+    return dict(cfg_file.items('logging'))
+
+
+# Attributes every LogRecord has, everything else was passed through extra
+_RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats records as JSON lines, fields passed through extra (post_id, author, duration_ms, ...) are included """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that keeps extra fields and the traceback separate from the message
+
+    on_first_record is called before the first record is queued, to set up what writes the queue.
+    """
+
+    def __init__(self, log_queue, on_first_record=None):
+        super(StructuredQueueHandler, self).__init__(log_queue)
+        self._on_first_record = on_first_record
+
+    def emit(self, record):
+        # Called with the handler lock held, so the setup runs once
+        if self._on_first_record is not None:
+            on_first_record, self._on_first_record = self._on_first_record, None
+            on_first_record()
+        super(StructuredQueueHandler, self).emit(record)
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class SizedTimedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler that also rotates every interval seconds, and can be shared by several processes
+
+    The time check uses the modification time of the log, it is rotated when it was last written in an
+    earlier interval (counted from the epoch, so a daily log rotates at midnight UTC). Scripts run from
+    cron rotate it too, however short they run.
+    All scripts append to the same log. One of them rotates it while holding a lock on <log>.lock,
+    the others notice that the log was replaced and reopen it. Nothing is rotated if backup_count is 0.
+    """
+
+    def __init__(self, filename, max_bytes=0, interval=0, backup_count=0):
+        super(SizedTimedRotatingFileHandler, self).__init__(filename, maxBytes=max_bytes,
+                                                            backupCount=backup_count, delay=True)
+        self._interval = interval
+        self._lock_path = self.baseFilename + ".lock"
+        self._record_size = 0
+
+    def _stat(self):
+        try:
+            return os.stat(self.baseFilename)
+        except OSError:
+            return None
+
+    def _reopen_if_replaced(self, file_stat):
+        """ Close the stream if another process rotated the log, it is reopened by the next write """
+        if self.stream is None:
+            return
+        if file_stat is None or os.fstat(self.stream.fileno()).st_ino != file_stat.st_ino:
+            self.stream.close()
+            self.stream = None
+
+    def _needs_rollover(self, file_stat):
+        if file_stat is None or not self.backupCount or not stat.S_ISREG(file_stat.st_mode):
+            return False
+        if self._interval and file_stat.st_mtime // self._interval < time.time() // self._interval:
+            return True
+        return bool(self.maxBytes) and file_stat.st_size + self._record_size >= self.maxBytes
+
+    def shouldRollover(self, record):
+        file_stat = self._stat()
+        self._reopen_if_replaced(file_stat)
+        self._record_size = len(self.format(record)) + 1 if self.maxBytes else 0
+        return self._needs_rollover(file_stat)
+
+    def doRollover(self):
+        with open(self._lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Another process may have rotated the log while this one waited for the lock
+            file_stat = self._stat()
+            self._reopen_if_replaced(file_stat)
+            if self._needs_rollover(file_stat):
+                super(SizedTimedRotatingFileHandler, self).doRollover()
 
 
 class Singleton(type):
@@ -29,22 +148,67 @@ class Singleton(type):
 
 
 class LoggerManager(object, metaclass=Singleton):
+    """
+    Logging through a queue, records are written by a single background thread
+
+    Logging a record only puts it on the queue, so it costs next to nothing in the scripts' loops.
+    config.cfg is only read, and the log file and sentry only set up, when the first record is logged,
+    so creating loggers at import time is cheap.
+    """
     _loggers = {}
+    _queue_handler = None
 
     def __init__(self, *args, **kwargs):
-        if sentry and "disable_sentry" not in kwargs:
+        self._enable_sentry = "disable_sentry" not in kwargs
+        self._listener = None
+        LoggerManager._queue_handler = StructuredQueueHandler(queue.Queue(-1), self._start)
+
+    def _start(self):
+        """ Read the logging config and start writing the queued records """
+        config = get_logging_config()
+
+        handler = SizedTimedRotatingFileHandler(config.get('log_file') or 'actions.log',
+                                                int(config.get('log_max_bytes') or 0),
+                                                int(config.get('log_rotate_hours') or 0) * 3600,
+                                                int(config.get('log_backup_count') or 0))
+        if config.get('log_format') == 'json':
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(module)s - %(message)s'))
+
+        self._listener = logging.handlers.QueueListener(self._queue_handler.queue, handler,
+                                                        respect_handler_level=True)
+        self._listener.start()
+        # Write what is left in the queue on exit
+        atexit.register(self._listener.stop)
+
+        if not self._enable_sentry:
+            return
+        sentry = config.get('sentry')
+        if sentry:
+            try:
+                import sentry_sdk
+            except ImportError:
+                # sentry_sdk not installed, skip sentry even though config exists
+                return
             sentry_sdk.init(sentry)
 
     @staticmethod
     def getLogger(name=None, enable_sentry=True):
-        LoggerManager._loggers[name] = logging.getLogger(name)
-        LoggerManager._loggers[name].setLevel(logging.INFO)
+        if name in LoggerManager._loggers:
+            return LoggerManager._loggers[name]
+
+        if LoggerManager._queue_handler is None:
+            LoggerManager()
 
-        fileh = logging.FileHandler('actions.log')
-        fileh.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(module)s - %(message)s'))
-        LoggerManager._loggers[name].addHandler(fileh)
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.INFO)
+        # Added once per logger, getting a logger again does not stack handlers
+        if LoggerManager._queue_handler not in logger.handlers:
+            logger.addHandler(LoggerManager._queue_handler)
+        LoggerManager._loggers[name] = logger
 
         requests_log = logging.getLogger("requests")
         requests_log.setLevel(logging.WARNING)
 
-        return LoggerManager._loggers[name]
+        return logger
@@ -0,0 +1,273 @@
+""" Counters and histograms of the bot's stages and API calls, exported in the Prometheus text format """
+
+import abc
+import os
+import time
+import atexit
+import functools
+import threading
+from contextlib import contextmanager
+
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for name, value in labels) + "}"
+
+
+class _Metric(abc.ABC):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    @abc.abstractmethod
+    def _samples(self, const_labels):
+        """ Get the sample lines of the metric, with const_labels added to the labels """
+
+    def render(self, const_labels=()):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.kind)]
+        with self._lock:
+            lines.extend(self._samples(tuple(const_labels)))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def values(self):
+        """ Get all values, by tuple of label values """
+        with self._lock:
+            return dict(self._values)
+
+    def _samples(self, const_labels):
+        return ["{}{} {}".format(self.name, _format_labels(const_labels + tuple(zip(self.labelnames, key))), value)
+                for key, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Bucket counts, then count and sum
+                counts = self._values[key] = [0] * len(self.buckets) + [0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def get(self, **labels):
+        """ Get (count, sum) of observations """
+        counts = self._values.get(self._key(labels))
+        return (counts[-2], counts[-1]) if counts else (0, 0.0)
+
+    def _samples(self, const_labels):
+        lines = []
+        for key, counts in sorted(self._values.items()):
+            labels = const_labels + tuple(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, counts):
+                lines.append("{}_bucket{} {}".format(self.name, _format_labels(labels + (("le", repr(float(bound))),)),
+                                                     count))
+            lines.append("{}_bucket{} {}".format(self.name, _format_labels(labels + (("le", "+Inf"),)), counts[-2]))
+            lines.append("{}_count{} {}".format(self.name, _format_labels(labels), counts[-2]))
+            lines.append("{}_sum{} {}".format(self.name, _format_labels(labels), counts[-1]))
+        return lines
+
+
+class Registry(object):
+    """ Set of metrics, rendered together with labels common to all of them (like the script name) """
+
+    def __init__(self):
+        self._metrics = []
+        self.const_labels = ()
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render(self.const_labels))
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """ Write all metrics to path for the node exporter textfile collector, atomically """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as textfile:
+            textfile.write(self.render())
+        os.replace(tmp_path, path)
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "redditswapbot_stage_seconds", "Time spent in a processing stage", ["stage"]))
+API_CALLS = REGISTRY.register(Counter(
+    "redditswapbot_api_calls_total", "Reddit API requests, by the stage making them", ["stage", "method"]))
+API_SECONDS = REGISTRY.register(Histogram(
+    "redditswapbot_api_request_seconds", "Reddit API request latency, including rate limit waits", ["method"]))
+API_ERRORS = REGISTRY.register(Counter(
+    "redditswapbot_api_errors_total", "Reddit API requests that raised", ["stage", "method"]))
+ITEMS = REGISTRY.register(Counter(
+    "redditswapbot_items_total", "Items processed (posts, comments, messages), by result", ["kind", "result"]))
+QUEUE_LAG = REGISTRY.register(Histogram(
+    "redditswapbot_queue_lag_seconds", "Time items waited in a queue before being processed", ["queue"]))
+POST_LAG = REGISTRY.register(Histogram(
+    "redditswapbot_post_lag_seconds", "Time between creation of a submission and the end of its check",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "redditswapbot_queue_depth", "Items waiting in a queue", ["queue"]))
+
+_local = threading.local()
+
+
+def current_stage():
+    """ Innermost stage of the current thread, API calls are counted against it """
+    stages = getattr(_local, "stages", None)
+    return stages[-1] if stages else "other"
+
+
+@contextmanager
+def stage(name):
+    """ Time a processing stage, nested stages are timed separately """
+    stages = getattr(_local, "stages", None)
+    if stages is None:
+        stages = _local.stages = []
+    stages.append(name)
+    start = time.time()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.time() - start, stage=name)
+        stages.pop()
+
+
+def staged(name):
+    """ Decorator running a function as stage name """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_session(core):
+    """ Count and time the requests of a prawcore session (praw_h._core) """
+    request = core.request
+
+    def counted_request(method, path, *args, **kwargs):
+        stage_name = current_stage()
+        API_CALLS.inc(stage=stage_name, method=method)
+        start = time.time()
+        try:
+            return request(method, path, *args, **kwargs)
+        except Exception:
+            API_ERRORS.inc(stage=stage_name, method=method)
+            raise
+        finally:
+            API_SECONDS.observe(time.time() - start, method=method)
+
+    core.request = counted_request
+
+
+def _write_periodically(path, interval):
+    while True:
+        time.sleep(interval)
+        REGISTRY.write_textfile(path)
+
+
+def setup(config, script):
+    """
+    Export metrics as configured in the metrics section of config.cfg
+
+    textfile_dir gets a <script>.prom file, written every textfile_interval seconds and on exit.
+    port serves the metrics over HTTP on localhost.
+    """
+    REGISTRY.const_labels = (("script", script),)
+    if "metrics" not in config.sections():
+        return
+    metrics_config = config["metrics"]
+    textfile_dir = metrics_config.get("textfile_dir")
+    if textfile_dir:
+        path = os.path.join(textfile_dir, script + ".prom")
+        atexit.register(REGISTRY.write_textfile, path)
+        thread = threading.Thread(target=_write_periodically,
+                                  args=(path, int(metrics_config.get("textfile_interval") or 60)),
+                                  name="metrics-textfile")
+        thread.daemon = True
+        thread.start()
+    port = int(metrics_config.get("port") or 0)
+    if port:
+        serve(port)
+
+
+def serve(port):
+    """ Serve metrics over HTTP on localhost in a background thread """
+    # Only imported when used, it is slow to import for the cron scripts
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = REGISTRY.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http")
+    thread.daemon = True
+    thread.start()
+    return server
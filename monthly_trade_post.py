@@ -3,39 +3,39 @@
 import sys, os
 import re
 from configparser import SafeConfigParser
-import praw
 import time
 from log_conf import LoggerManager
 
 containing_dir = os.path.abspath(os.path.dirname(sys.argv[0]))
-cfg_file = SafeConfigParser()
 path_to_cfg = os.path.join(containing_dir, 'config.cfg')
-cfg_file.read(path_to_cfg)
-
-username = cfg_file.get('login', 'username')
-password = cfg_file.get('login', 'password')
-app_key = cfg_file.get('login', 'client_id')
-app_secret = cfg_file.get('login', 'client_secret')
-user_agent = cfg_file.get('login', 'user_agent')
-subreddit = cfg_file.get('subreddit', 'name')
-curr_id = cfg_file.get('trade', 'link_id')
 
 # configure logging
 logger = LoggerManager().getLogger(__name__)
 
+def load_config():
+    cfg_file = SafeConfigParser()
+    cfg_file.read(path_to_cfg)
+    return(cfg_file)
+
 def get_month():
     month = time.strftime('%B')
     return(month)
 
-def login():
-    r = praw.Reddit(client_id=app_key,
-                    client_secret=app_secret,
-                    username=username,
-                    password=password,
-                    user_agent=user_agent)
+def login(cfg_file):
+    # praw is only imported when logging in, it takes most of the startup time
+    import praw
+    import rate_budget
+    r = praw.Reddit(client_id=cfg_file.get('login', 'client_id'),
+                    client_secret=cfg_file.get('login', 'client_secret'),
+                    username=cfg_file.get('login', 'username'),
+                    password=cfg_file.get('login', 'password'),
+                    user_agent=cfg_file.get('login', 'user_agent'))
+    rate_budget_file = cfg_file.get('subreddit', 'rate_budget_file', fallback='')
+    if rate_budget_file:
+        rate_budget.install(r, rate_budget_file)
     return(r)
 
-def post_thread(r,month):
+def post_thread(r, subreddit, month):
     post = r.subreddit(subreddit).submit('%s Confirmed Trade Thread' % month, selftext='''Post your confirmed trades below, When confirming a post put Confirmed only nothing else it makes the bot unhappy :(
 
 If more proof is requested by the bot please send a [modmail](http://www.reddit.com/message/compose?to=%%2Fr%%2F%s) including the following:
@@ -47,25 +47,30 @@ If more proof is requested by the bot please send a [modmail](http://www.reddit.
     #r.send_message('/r/'+subreddit, 'New Trade Thread', 'A new trade thread has been posted for the month and the sidebar has been updated.')
     return (post.id)
 
-def change_sidebar(r, post_id, month):
+def change_sidebar(r, subreddit, post_id, month):
     sb = r.subreddit(subreddit).mod.settings()["description"]
     new_flair = r'[Confirm your Trades](/' + post_id + ')'
     new_sb = re.sub(r'\[Confirm your Trades\]\(\/[a-z0-9]+\)', new_flair, sb, 1)
     r.subreddit(subreddit).mod.update(description=new_sb)
 
 def update_config(post_id):
-    cfg_file.set('trade', 'prevlink_id', curr_id)
+    # Read again, the config may have changed since start when running in bot_daemon.py
+    cfg_file = load_config()
+    cfg_file.set('trade', 'prevlink_id', cfg_file.get('trade', 'link_id'))
     cfg_file.set('trade', 'link_id', post_id)
-    with open(r'config.cfg', 'w') as configfile:
+    with open(path_to_cfg, 'w') as configfile:
         cfg_file.write(configfile)
 
-def main():
+def run(r):
+    subreddit = load_config().get('subreddit', 'name')
     month = get_month()
-    r = login()
-    post_id = post_thread(r, month)
-    change_sidebar(r, post_id, month)
+    post_id = post_thread(r, subreddit, month)
+    change_sidebar(r, subreddit, post_id, month)
     update_config(post_id)
     logger.info("Posted Trade Confirmation thread")
 
+def main():
+    run(login(load_config()))
+
 if __name__ == '__main__':
     main()
@@ -2,16 +2,22 @@
 """ New post checker """
 
 import sys
-import re
-import sqlite3
-import unicodedata
-import json
 import os
+import queue
+import threading
+from collections import deque, OrderedDict
 from datetime import datetime
-from time import sleep
+from time import sleep, time
 
+import metrics
 from log_conf import LoggerManager
 from common import SubRedditMod
+from rate_budget import PRIORITY_HIGH, PRIORITY_LOW
+from user_db import parse_trade_count
+from usernotes import warning_types
+from history_store import HistoryStore
+from dupe_index import DupeIndex
+from classifier import ClassifierLoader, clean_text, PERSONAL, NONPERSONAL
 
 
 # configure logging
@@ -21,88 +27,50 @@ LOGGER = LoggerManager().getLogger("post_check")
 class PostChecker(object):
     """ Post check helper """
 
-    def __init__(self, subreddit, db_con, post_categories, locations):
+    def __init__(self, subreddit, user_db, classifier, history=None, dupes=None):
         self._subreddit = subreddit
         self._config = subreddit.config["post_check"]
-        self._user_db_con = db_con
-        self._user_db_cursor = self._user_db_con.cursor()
-        self._post_categories = post_categories
-        self._locations = locations
-
-    def _get_user_db_entry(self, post):
-        self._user_db_cursor.execute('SELECT * FROM user WHERE username=?', (post.author.name,))
-        return self._user_db_cursor.fetchone()
-
-    def _update_user_db(self, post, fields_to_set):
-        fields = ", ".join(field + "=?" for field in fields_to_set)
-        self._user_db_cursor.execute('UPDATE OR IGNORE user SET {} WHERE username=?'.format(fields),
-                                     (post.created_utc, post.id, post.author.name))
-
-    def _add_to_user_db(self, post, fields_to_set):
-        fields = ", ".join(("username",) + fields_to_set)
-        self._user_db_cursor.execute('INSERT OR IGNORE INTO user ({}) VALUES (?, ?, ?)'.format(fields),
-                                     (post.author.name, post.created_utc, post.id))
-
-    def _is_personal_post(self, title):
-        return bool(re.search(self._config["trade_post_format"], title))
-
-    def _is_nonpersonal_post(self, title):
-        return bool(re.search(self._config["informational_post_format"], title))
-
-    def save_submission(self, post):
-        user_path = os.path.join(self._config["user_history_dir"], str(post.author))
-
-        if not os.path.exists(user_path):
-            os.makedirs(user_path)
-
-        with open(os.path.join(user_path, post.id), "w") as f:
-            f.write(unicodedata.normalize('NFKD', post.title).encode('ascii', 'ignore').decode() + "\n")
-            f.write(unicodedata.normalize('NFKD', post.selftext).encode('ascii', 'ignore').decode())
-
-    def check_and_flair_personal(self, post, clean_title):
-        """ Check title of personal post and flair accordingly """
-
-        location, have, want = re.search(self._config["trade_post_format"], clean_title).groups()
+        self._user_db = user_db
+        self._classifier = classifier
+        self._history = history
+        self._dupes = dupes
+        self._usernote_warnings = warning_types(self._config.get("usernote_warnings"))
+
+    @metrics.staged("history")
+    def save_submission(self, post, duplicate_check=True):
+        title = clean_text(post.title)
+        body = clean_text(post.selftext)
+        self._history.append(post.id, str(post.author), post.created_utc, title, body)
+        if self._dupes is not None and duplicate_check:
+            self.check_duplicate(post, title + "\n" + body)
+
+    @metrics.staged("duplicate_check")
+    def check_duplicate(self, post, text):
+        """ Report post if its text is a near-duplicate of a recent post by another user """
+        match = self._dupes.check_and_add(post.id, str(post.author), post.created_utc, text)
+        if match is None:
+            return
+        LOGGER.info("Submission https://redd.it/{} is a near-duplicate ({:.0%}) of https://redd.it/{} by /u/{}"
+                    .format(post.id, match.similarity, match.post_id, match.author),
+                    extra={"post_id": post.id, "author": str(post.author), "duplicate_of": match.post_id})
+        post.report("Possible duplicate of https://redd.it/{} by /u/{}".format(match.post_id, match.author))
 
-        if "-" in location:
-            primary, secondary = location.split("-", 1)
-        else:
-            primary = "OTHER"
-            secondary = location
+    def check_and_flair_personal(self, post, verdict):
+        """ Flair personal post according to its classification """
 
-        if (primary not in self._locations or
-                secondary not in self._locations[primary]):
-            self.remove_post(post, "location")
-            return False
-
-        if self._config["user_history_dir"]:
+        if self._history is not None:
             self.save_submission(post)
 
-        timestamp_check = False
-        post_category = self._config["default_category"]
-        personal_categories = self._post_categories["personal"]
-        for category, category_prop in personal_categories.items():
-            assert not ("have" in category_prop and "want" in category_prop), "Limitation of script"
-            if "want" in category_prop:
-                regex = category_prop["want"].replace("\\\\", "\\")
-                if re.search(regex, want, re.IGNORECASE):
-                    post_category = category
-                    timestamp_check = category_prop["timestamp_check"]
-            if "have" in category_prop:
-                regex = category_prop["have"].replace("\\\\", "\\")
-                if re.search(regex, have, re.IGNORECASE):
-                    post_category = category
-                    timestamp_check = category_prop["timestamp_check"]
-
-        post.mod.flair(text=post_category, css_class=personal_categories[post_category]["class"])
+        post.mod.flair(text=verdict.category, css_class=verdict.css_class)
 
         self.check_repost(post, "personal")
 
-        if timestamp_check:
+        if verdict.timestamp_check:
+            timestamp_regex = self._classifier.get().timestamp_regex
             lines = list(line for line in post.selftext.splitlines() if line)
-            if not re.search(self._config["timestamp_regex"], post.selftext, re.IGNORECASE):
+            if not timestamp_regex.search(post.selftext):
                 post.report("Could not find timestamp.")
-            if not re.search(self._config["timestamp_regex"], " ".join(lines[:3]), re.IGNORECASE):
+            if not timestamp_regex.search(" ".join(lines[:3])):
                 post.reply("Hello, we have updated the rules with a recommendation to include the "
                            "timestamp at the beginning of the submission and I could not find any "
                            "timestamp in the beginning of your submission.\n\n"
@@ -113,21 +81,17 @@ class PostChecker(object):
 
         return True
 
-    def check_and_flair_nonpersonal(self, post, clean_title):
-        """ Check title of personal post and flair accordingly """
+    def check_and_flair_nonpersonal(self, post, verdict):
+        """ Flair nonpersonal post according to its classification """
 
-        tag = re.search(self._config["informational_post_format"], clean_title).group(1)
+        post_category_prop = verdict.category_prop
 
-        for category, category_prop in self._post_categories["nonpersonal"].items():
-            if tag == category_prop["tag"]:
-                post_category = category
-                post_category_prop = category_prop
-                break
-        else:
-            self.remove_post(post, "tag")
-            return False
+        if self._history is not None:
+            # Categories without repost check (like META and Giveaway) are recurring posts from templates,
+            # they are not checked for duplicates
+            self.save_submission(post, post_category_prop.get("repost_check", True))
 
-        post.mod.flair(text=post_category, css_class=post_category_prop["class"])
+        post.mod.flair(text=verdict.category, css_class=verdict.css_class)
 
         if "required_flair" in post_category_prop:
             if post_category_prop["required_flair"] != post.author_flair_css_class:
@@ -142,75 +106,80 @@ class PostChecker(object):
 
         return True
 
+    @metrics.staged("check_post")
     def check_post(self, post):
         """
         Check post for rule violations
         """
 
-        clean_title = unicodedata.normalize('NFKD', post.title).encode('ascii', 'ignore').decode()
-
-        if self._is_personal_post(clean_title):
-            if "trade_post_format_strict" in self._config:
-                if not bool(re.match(self._config["trade_post_format_strict"], clean_title)):
-                    self.remove_post(post, "title")
-                    return
-
-            if not self.check_and_flair_personal(post, clean_title):
-                return
+        start = time()
+        with metrics.stage("classify"):
+            verdict = self._classifier.get().classify(clean_text(post.title))
 
-        elif self._is_nonpersonal_post(clean_title):
+        if verdict.kind == PERSONAL:
+            self.check_and_flair_personal(post, verdict)
+        elif verdict.kind == NONPERSONAL:
             # TODO: Add strict format check (not necessary at the moment)
-            if not self.check_and_flair_nonpersonal(post, clean_title):
-                return
-
+            self.check_and_flair_nonpersonal(post, verdict)
         else:
-            self.remove_post(post)
-            return
+            self.remove_post(post, verdict.bad_part)
 
+        LOGGER.info("Checked post {}".format(post.id),
+                    extra={"post_id": post.id, "author": str(post.author), "verdict": verdict.kind,
+                           "category": verdict.category, "duration_ms": round((time() - start) * 1000, 1)})
+        metrics.ITEMS.inc(kind="post", result=verdict.kind)
+        metrics.POST_LAG.observe(time() - post.created_utc)
+
+    @metrics.staged("remove_post")
     def remove_post(self, post, bad_part="title"):
         """
         Reply and remove post
         """
 
         # TODO: Implement this in a better way
-        if post.author in self._subreddit.get_mods():
+        if self._subreddit.is_mod(post.author):
             # Let mods make posts with arbitrary tags
             return
 
         comment = "REMOVED: Your post was automatically removed due to an incorrect title."
         comment += "\n\nYour **{bad_part}** does not match the format specified in the {rules_link}.".format(
             bad_part=bad_part, rules_link=self._subreddit.get_rules_link())
-        post.reply(comment).mod.distinguish()
-        post.mod.remove()
+        with self._subreddit.priority(PRIORITY_HIGH):
+            post.reply(comment).mod.distinguish()
+            post.mod.remove()
 
+    @metrics.staged("post_comment")
     def post_comment(self, post):
         """
         Post user info comment
         """
 
-        age = str(datetime.utcfromtimestamp(post.author.created_utc))
+        profile = self._subreddit.get_profile(post.author)
+        age = str(datetime.utcfromtimestamp(profile.created_utc))
 
-        try:
-            reputation = int(post.author_flair_css_class.lstrip('i-'))
-        except AttributeError:
-            reputation = 0
-        except ValueError:
-            reputation = post.author_flair_css_class.lstrip('i-')
+        flair_css_class, flair_text = self._subreddit.get_user_flair(post)
+        reputation = parse_trade_count(flair_css_class)
+        if reputation is None:
+            reputation = flair_css_class.lstrip('i-')
 
         comment = "* Username: /u/{0}\n".format(str(post.author.name))
         comment += ("  * [[Click here to send a PM to this user]](https://www.reddit.com/message/compose/?to={0})\n"
                     .format(str(post.author.name)))
         comment += "* Join date: {0}\n".format(age)
-        comment += "* Link karma: {0}\n".format(str(post.author.link_karma))
-        comment += "* Comment karma: {0}\n".format(str(post.author.comment_karma))
+        comment += "* Link karma: {0}\n".format(str(profile.link_karma))
+        comment += "* Comment karma: {0}\n".format(str(profile.comment_karma))
         if isinstance(reputation, int):
             comment += "* Reputation: {0} trade(s)\n".format(reputation)
         else:
             comment += "* Reputation: User is currently a {0}.\n".format(reputation)
         # TODO: Distinguish between normal flair and other flairs
-        if post.author_flair_text is not None and "http" in post.author_flair_text:
-            name = "Heatware" if "heatware" in post.author_flair_text else "Link"
-            comment += "* {0}: [{1}]({1})\n".format(name, post.author_flair_text)
+        if flair_text is not None and "http" in flair_text:
+            name = "Heatware" if "heatware" in flair_text else "Link"
+            comment += "* {0}: [{1}]({1})\n".format(name, flair_text)
+        if self._usernote_warnings:
+            for note in self._subreddit.get_usernotes(post.author.name):
+                if note.warning in self._usernote_warnings:
+                    comment += "* Mod note ({0}): {1}\n".format(datetime.utcfromtimestamp(note.time).date(), note.note)
         disclaimer = ("This information does not guarantee a successful swap. "
                       "It is being provided to help potential trade partners have "
                       "more immediate background information about with whom they are swapping. "
@@ -219,42 +188,389 @@ class PostChecker(object):
                           rules=self._subreddit.get_rules_link(), wiki=self._subreddit.get_wiki_link())
         disclaimer = "\n^^" + disclaimer.replace(" ", " ^^")
         comment += "{0}\n".format(disclaimer)
-        post.reply(comment).mod.distinguish()
+        # Informational only, removals and flair go first
+        with self._subreddit.priority(PRIORITY_LOW):
+            post.reply(comment).mod.distinguish()
 
+    def prefetch_removal_status(self, posts):
+        """ Look up removal status of previous posts that check_repost may need for posts, in batches """
+        if not posts:
+            return
+        since = min(post.created_utc for post in posts) - int(self._config["lower_min"]) * 60
+        authors = {post.author.name for post in posts if post.author}
+        self._subreddit.removal_status.prefetch(self._user_db.get_recent_post_ids(authors, since))
+
+    @metrics.staged("check_repost")
     def check_repost(self, post, category_prefix="personal"):
         """
         Check post for repost rule violations
         """
 
-        db_row = self._get_user_db_entry(post)
+        with metrics.stage("repost_db"):
+            db_row = self._user_db.get_user(post.author.name)
         last_created_col = "{}_last_created".format(category_prefix)
         last_id_col = "{}_last_id".format(category_prefix)
-        if db_row is not None:
+        if db_row is not None and db_row[last_id_col]:
             last_id = db_row[last_id_col]
             last_created = db_row[last_created_col]
             if post.id != last_id:
-                LOGGER.info("Checking post {} for repost violation".format(post.id))
+                log_fields = {"post_id": post.id, "author": post.author.name, "previous_post_id": last_id}
+                LOGGER.info("Checking post {} for repost violation".format(post.id), extra=log_fields)
                 post_created = post.created_utc
                 seconds_between_posts = (post_created - last_created)
                 if (seconds_between_posts < int(self._config["lower_min"]) * 60 and
                         self._subreddit.is_removed(last_id)):
                     LOGGER.info("Submission https://redd.it/{} not reported because grace period. "
-                                "(Previous submission: https://redd.it/{})".format(post.id, last_id))
+                                "(Previous submission: https://redd.it/{})".format(post.id, last_id), extra=log_fields)
                 elif seconds_between_posts < int(self._config["upper_hour"]) * 3600:
                     LOGGER.info("Submission https://redd.it/{} removed and flagged for repost violation. "
-                                "(Previous submission: https://redd.it/{})".format(post.id, last_id))
-                    post.mod.remove()
-                    reply = post.reply("Your submission has automatically been flagged for review. "
-                                       "Please do not delete your submission and/or make a new submission.\n\n"
-                                       "A mod will review your submission as soon as possible "
-                                       "and approve the post if everything looks OK.")
-                    reply.report("Probable repost, link to previous post: https://redd.it/{}".format(last_id))
+                                "(Previous submission: https://redd.it/{})".format(post.id, last_id), extra=log_fields)
+                    with self._subreddit.priority(PRIORITY_HIGH):
+                        post.mod.remove()
+                        reply = post.reply("Your submission has automatically been flagged for review. "
+                                           "Please do not delete your submission and/or make a new submission.\n\n"
+                                           "A mod will review your submission as soon as possible "
+                                           "and approve the post if everything looks OK.")
+                        reply.report("Probable repost, link to previous post: https://redd.it/{}".format(last_id))
                     return
-            self._update_user_db(post, (last_created_col, last_id_col))
+
+        with metrics.stage("repost_db"):
+            self._user_db.set_last_post(post.author.name, category_prefix, post.id, post.created_utc)
+
+
+class ProcessedIndex(object):
+    """ Bounded set of processed post ids, persisted to the user db """
+
+    def __init__(self, user_db, max_size=10000, max_age=7 * 24 * 3600):
+        self._user_db = user_db
+        self._max_size = max_size
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        self._entries = OrderedDict(tuple(row) for row in self._user_db.get_processed())
+        self._evict()
+
+    def __contains__(self, post_id):
+        return post_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, post_id):
+        """ Mark post id as processed """
+        now = time()
+        with self._lock:
+            self._entries[post_id] = now
+            self._entries.move_to_end(post_id)
+            self._user_db.add_processed(post_id, now)
+            self._evict()
+
+    def _evict(self):
+        """ Drop entries that are too old or exceed the size limit """
+        oldest_allowed = time() - self._max_age
+        evicted = []
+        while self._entries:
+            post_id, processed_utc = next(iter(self._entries.items()))
+            if processed_utc >= oldest_allowed and len(self._entries) <= self._max_size:
+                break
+            del self._entries[post_id]
+            evicted.append(post_id)
+        if evicted:
+            self._user_db.remove_processed(evicted)
+
+
+class PostPipeline(object):
+    """
+    Runs a handler on posts using a pool of workers
+
+    Posts by the same author always go to the same worker so they are handled in order.
+    Submitting blocks when the worker queue is full, and workers wait when the API rate
+    limit is running low. Posts the handler failed on are returned by join.
+    """
+
+    def __init__(self, subreddit, handler, workers=4, queue_size=10, min_remaining=10):
+        self._subreddit = subreddit
+        self._handler = handler
+        self._min_remaining = min_remaining
+        self._failed = []
+        self._failed_lock = threading.Lock()
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        for worker_queue in self._queues:
+            worker = threading.Thread(target=self._work, args=(worker_queue,))
+            worker.daemon = True
+            worker.start()
+
+    def _work(self, worker_queue):
+        while True:
+            queued_at, post = worker_queue.get()
+            metrics.QUEUE_LAG.observe(time() - queued_at, queue="pipeline")
+            try:
+                self._subreddit.wait_for_rate_limit(self._min_remaining)
+                self._handler(post)
+            except Exception as exception:
+                LOGGER.error("Checking post {} failed: {}".format(post.id, exception), extra={"post_id": post.id})
+                with self._failed_lock:
+                    self._failed.append(post)
+            finally:
+                worker_queue.task_done()
+
+    def submit(self, post):
+        """ Queue post for handling """
+        author = post.author.name.lower() if post.author else ""
+        self._queues[hash(author) % len(self._queues)].put((time(), post))
+        metrics.QUEUE_DEPTH.set(sum(worker_queue.qsize() for worker_queue in self._queues), queue="pipeline")
+
+    def join(self):
+        """ Wait until all submitted posts have been handled, returns the posts that failed since the last join """
+        for worker_queue in self._queues:
+            worker_queue.join()
+        with self._failed_lock:
+            failed, self._failed = self._failed, []
+        return failed
+
+
+class SubmissionFeed(object):
+    """ Continuous feed of new submissions with gap detection and a durable checkpoint """
+
+    def __init__(self, subreddit, checkpoint_path, initial_limit=20, max_backoff=300):
+        self._subreddit = subreddit
+        self._checkpoint_path = checkpoint_path
+        self._initial_limit = initial_limit
+        self._max_backoff = max_backoff
+        self._seen = deque(maxlen=1000)
+        self._catch_up_needed = False
+        self.checkpoint = self._load_checkpoint()
+
+    def _load_checkpoint(self):
+        """ Load (fullname, created_utc) of the last handled submission, None if there is none """
+        try:
+            with open(self._checkpoint_path) as checkpoint_file:
+                fullname, created_utc = checkpoint_file.read().split()
+        except (IOError, ValueError):
+            return None
+        return fullname, float(created_utc)
+
+    def save_checkpoint(self, post):
+        """ Store post as the last handled submission """
+        if self.checkpoint is not None and post.created_utc < self.checkpoint[1]:
+            return
+        self.checkpoint = (post.fullname, post.created_utc)
+        tmp_path = self._checkpoint_path + ".tmp"
+        with open(tmp_path, "w") as checkpoint_file:
+            checkpoint_file.write("{} {}\n".format(*self.checkpoint))
+        os.replace(tmp_path, self._checkpoint_path)
+
+    def forget(self, posts):
+        """ Let posts be returned again by the next catch up, for posts that could not be handled """
+        for post in posts:
+            try:
+                self._seen.remove(post.fullname)
+            except ValueError:
+                pass
+        self._catch_up_needed = True
+
+    def _is_new(self, post):
+        if post.fullname in self._seen:
+            return False
+        if self.checkpoint is not None:
+            fullname, created_utc = self.checkpoint
+            if post.fullname == fullname or post.created_utc < created_utc:
+                return False
+        return True
+
+    def _filter_new(self, posts):
+        new_posts = []
+        for post in posts:
+            if self._is_new(post):
+                self._seen.append(post.fullname)
+                new_posts.append(post)
+        return new_posts
+
+    @metrics.staged("feed_catch_up")
+    def catch_up(self):
+        """ Get all posts made since the checkpoint, oldest first """
+        self._catch_up_needed = False
+        if self.checkpoint is None:
+            posts = self._subreddit.get_new_since(limit=self._initial_limit)
         else:
-            self._add_to_user_db(post, (last_created_col, last_id_col))
+            posts = self._subreddit.get_new_since(*self.checkpoint)
+            LOGGER.debug("Caught up on {} posts since {}".format(len(posts), self.checkpoint[0]))
+        return self._filter_new(posts)
+
+    def batches(self):
+        """
+        Yield lists of new posts, oldest first
+
+        Catches up from the checkpoint before (re)starting the stream so posts made while
+        the stream was down are not missed, and while streaming after posts were forgotten.
+        """
+        backoff = 1
+        while True:
+            try:
+                batch = self.catch_up()
+                if batch:
+                    yield batch
+                batch = []
+                for post in self._subreddit.stream_new(pause_after=0):
+                    if post is None:
+                        if self._catch_up_needed:
+                            batch = sorted(self.catch_up() + batch, key=lambda post: post.created_utc)
+                        if batch:
+                            yield batch
+                            batch = []
+                        backoff = 1
+                        continue
+                    batch.extend(self._filter_new([post]))
+            except KeyboardInterrupt:
+                raise
+            except Exception as exception:
+                LOGGER.error("Submission stream failed, retrying in {}s: {}".format(backoff, exception))
+                sleep(backoff)
+                backoff = min(backoff * 2, self._max_backoff)
 
-        self._user_db_con.commit()
+
+class PostCheckRunner(object):
+    """ Sets up post checking for a SubRedditMod and checks batches of new posts """
+
+    # Checks of a post that fail are retried with later batches, up to this many checks
+    max_attempts = 3
+
+    def __init__(self, subreddit):
+        self._subreddit = subreddit
+        self._attempts = {}
+        config_path = subreddit.config_file
+        classifier = ClassifierLoader(LOGGER, lambda: SubRedditMod.load_config(config_path),
+                                      "submission_categories.json", "locations.json",
+                                      config_path if os.path.exists(config_path) else None)
+        classifier.get()
+
+        # Setup PostChecker
+        self._user_db = subreddit.user_db
+        post_check_config = subreddit.config["post_check"]
+        history = None
+        dupes = None
+        history_dir = post_check_config["user_history_dir"]
+        if history_dir:
+            history = HistoryStore(history_dir)
+            if post_check_config.get("dupe_check"):
+                dupes = DupeIndex(os.path.join(history_dir, "dupes.idx"),
+                                  float(post_check_config.get("dupe_threshold") or 0.7),
+                                  int(post_check_config.get("dupe_window") or 30) * 24 * 3600)
+                if not len(dupes):
+                    dupes.seed(history)
+        self.post_checker = PostChecker(subreddit, self._user_db, classifier, history, dupes)
+
+        checkpoint_path = post_check_config.get("checkpoint_file") or "post_check.checkpoint"
+        self.feed = SubmissionFeed(subreddit, checkpoint_path)
+
+        self._processed = ProcessedIndex(self._user_db,
+                                         int(post_check_config.get("processed_max_size") or 10000),
+                                         int(post_check_config.get("processed_max_age") or 168) * 3600)
+
+        # Only walk replies to find already handled posts when there is no processed history at all
+        self._first_pass = not self._processed
+
+        workers = int(post_check_config.get("workers") or 1)
+        self._pipeline = None
+        if workers > 1:
+            self._pipeline = PostPipeline(subreddit, self.handle_post, workers,
+                                          min_remaining=int(post_check_config.get("min_ratelimit_remaining") or 10))
+
+    def handle_post(self, post):
+        if self._first_pass and self._subreddit.check_mod_reply(post):
+            self._processed.add(post.id)
+        if post.id not in self._processed:
+            self.post_checker.check_post(post)
+            self._processed.add(post.id)
+
+    def handle_batch(self, new_posts):
+        """
+        Check a batch of new posts, oldest first, and move the checkpoint past it
+
+        The checkpoint is not moved past a post whose check failed (like on a reddit 5xx), the post is
+        checked again with a later batch. Posts are given up on after max_attempts checks.
+        """
+        try:
+            self.post_checker.prefetch_removal_status(new_posts)
+        except Exception as exception:
+            LOGGER.error(exception)
+        if self._pipeline is not None:
+            for post in new_posts:
+                self._pipeline.submit(post)
+            failed = self._pipeline.join()
+        else:
+            failed = []
+            for post in new_posts:
+                try:
+                    self.handle_post(post)
+                except Exception as exception:
+                    LOGGER.error("Checking post {} failed: {}".format(post.id, exception), extra={"post_id": post.id})
+                    failed.append(post)
+        # Make sure the results of the batch are stored before moving the checkpoint past it
+        self._user_db.flush()
+        try:
+            self._subreddit.flush_usernotes()
+        except Exception as exception:
+            LOGGER.error(exception)
+        retry = self._retry_failed(new_posts, failed)
+        if retry:
+            self.feed.forget(retry)
+            first_failed = min(new_posts.index(post) for post in retry)
+            if first_failed:
+                self.feed.save_checkpoint(new_posts[first_failed - 1])
+        else:
+            self.feed.save_checkpoint(new_posts[-1])
+        self._first_pass = False
+
+    def _retry_failed(self, new_posts, failed):
+        """ Count the checks of failed posts, returns the failed posts to check again """
+        failed_fullnames = {post.fullname for post in failed}
+        for post in new_posts:
+            if post.fullname not in failed_fullnames:
+                self._attempts.pop(post.fullname, None)
+        retry = []
+        for post in failed:
+            attempts = self._attempts.get(post.fullname, 0) + 1
+            if attempts < self.max_attempts:
+                self._attempts[post.fullname] = attempts
+                retry.append(post)
+            else:
+                self._attempts.pop(post.fullname, None)
+                LOGGER.error("Giving up on post {} after {} failed checks".format(post.id, attempts),
+                             extra={"post_id": post.id})
+                metrics.ITEMS.inc(kind="post", result="error")
+        return retry
+
+    def poll(self):
+        """ Check all posts made since the checkpoint, a batch that fails is caught up on by the next poll """
+        new_posts = self.feed.catch_up()
+        if new_posts:
+            try:
+                self.handle_batch(new_posts)
+            except Exception:
+                # The checkpoint was not moved past the batch, catch up on it again
+                self.feed.forget(new_posts)
+                raise
+
+    def run(self, retry_delay=60, max_retry_delay=600):
+        """
+        Check new posts as they come in, forever
+
+        A batch that fails (the user db is locked, the checkpoint can't be written, ...) is retried
+        after retry_delay seconds, doubled on every failure in a row.
+        """
+        delay = retry_delay
+        while True:
+            new_posts = []
+            try:
+                for new_posts in self.feed.batches():
+                    self.handle_batch(new_posts)
+                    delay = retry_delay
+            except Exception as exception:
+                LOGGER.error("Checking posts failed, retrying in {}s: {}".format(delay, exception))
+                # The checkpoint was not moved past the batch, catch up on it again
+                self.feed.forget(new_posts)
+                sleep(delay)
+                delay = min(delay * 2, max_retry_delay)
 
 
 def main():
@@ -263,44 +579,18 @@ def main():
     try:
         # Setup SubRedditMod
         subreddit = SubRedditMod(LOGGER)
-        with open("submission_categories.json") as category_file:
-            post_categories = json.load(category_file)
-        with open("locations.json") as locations_file:
-            locations = json.load(locations_file)
-
-        # Setup PostChecker
-        user_db = subreddit.config["trade"]["user_db"]
-        db_con = sqlite3.connect(user_db)
-        db_con.row_factory = sqlite3.Row
-        post_checker = PostChecker(subreddit, db_con, post_categories, locations)
+        metrics.setup(subreddit.config, "post_check")
+        runner = PostCheckRunner(subreddit)
+        subreddit.mod_roster.start()
     except Exception as exception:
         LOGGER.error(exception)
         sys.exit()
 
-    while True:
-        try:
-            first_pass = True
-            processed = []
-            while True:
-                new_posts = subreddit.get_new(20)
-                for post in new_posts:
-                    if first_pass and subreddit.check_mod_reply(post):
-                        processed.append(post.id)
-                    if post.id in processed:
-                        continue
-                    post_checker.check_post(post)
-                    processed.append(post.id)
-                first_pass = False
-                LOGGER.debug("Sleeping for 1 minute")
-                sleep(60)
-
-        except KeyboardInterrupt:
-            print("\nCtrl-C pressed, exiting gracefully")
-            sys.exit(0)
-
-        except Exception as exception:
-            LOGGER.error(exception)
-            sleep(60)
+    try:
+        runner.run()
+    except KeyboardInterrupt:
+        print("\nCtrl-C pressed, exiting gracefully")
+        sys.exit(0)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,157 @@
+""" Reddit API rate limit budget shared by all bot processes using the same account """
+
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+# Request priorities, lower is more important
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Requests left in the window that lower priorities may not use, per priority
+DEFAULT_RESERVE = (0, 10, 50)
+
+
+class RateBudget(object):
+    """
+    Token bucket of API requests kept in an sqlite database
+
+    The bucket is refilled from the X-Ratelimit-* headers of every response, so it follows the
+    requests of all processes using the account. Requests are spread evenly over what is left of
+    the rate limit window, and each priority leaves a reserve in the bucket for higher priorities.
+    """
+
+    def __init__(self, path, reserve=DEFAULT_RESERVE, timeout=30):
+        self._reserve = reserve
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._con.execute('PRAGMA journal_mode=WAL')
+        self._con.execute('CREATE TABLE IF NOT EXISTS budget ('
+                          'id INTEGER PRIMARY KEY CHECK (id = 0), '
+                          'remaining REAL, '
+                          'reset_utc REAL, '
+                          'last_request_utc REAL)')
+        self._con.execute('INSERT OR IGNORE INTO budget (id, remaining, reset_utc, last_request_utc) '
+                          'VALUES (0, NULL, 0, 0)')
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._con.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._con
+            except Exception:
+                self._con.execute('ROLLBACK')
+                raise
+            self._con.execute('COMMIT')
+
+    def state(self):
+        """ Get (remaining, reset_utc), remaining is None if unknown or the window has passed """
+        with self._lock:
+            remaining, reset_utc = self._con.execute('SELECT remaining, reset_utc FROM budget').fetchone()
+        if remaining is None or time.time() >= reset_utc:
+            return None, reset_utc
+        return remaining, reset_utc
+
+    def _try_acquire(self, priority):
+        """ Take a request from the bucket, returns seconds to wait before trying again or 0 if taken """
+        with self._transaction() as con:
+            remaining, reset_utc, last_request_utc = con.execute(
+                'SELECT remaining, reset_utc, last_request_utc FROM budget').fetchone()
+            now = time.time()
+            if remaining is not None and now < reset_utc:
+                available = remaining - self._reserve[priority]
+                if available < 1:
+                    return reset_utc - now
+                # The most important requests are not paced, only limited by the bucket
+                if priority != PRIORITY_HIGH:
+                    wait = last_request_utc + (reset_utc - now) / available - now
+                    if wait > 0:
+                        return wait
+                remaining -= 1
+            con.execute('UPDATE budget SET remaining=?, last_request_utc=?', (remaining, now))
+        return 0
+
+    def acquire(self, priority=PRIORITY_NORMAL):
+        """ Wait until a request of priority may be made """
+        while True:
+            wait = self._try_acquire(priority)
+            if wait <= 0:
+                return
+            # Check again now and then, other processes may have refilled the bucket
+            time.sleep(min(wait, 5))
+
+    def update(self, response_headers):
+        """ Refill the bucket from the rate limit headers of a response """
+        if "x-ratelimit-remaining" not in response_headers:
+            return
+        now = time.time()
+        remaining = float(response_headers["x-ratelimit-remaining"])
+        reset_utc = now + int(response_headers["x-ratelimit-reset"])
+        with self._transaction() as con:
+            current_remaining, current_reset_utc = con.execute('SELECT remaining, reset_utc FROM budget').fetchone()
+            # Responses of other processes can arrive out of order within a window, keep the lowest count
+            if current_remaining is not None and abs(current_reset_utc - reset_utc) < 5:
+                remaining = min(remaining, current_remaining)
+            con.execute('UPDATE budget SET remaining=?, reset_utc=?', (remaining, reset_utc))
+
+    def wait_for_window(self, min_remaining, logger=None):
+        """ Sleep until the rate limit window resets if less than min_remaining requests are left """
+        remaining, reset_utc = self.state()
+        if remaining is None or remaining >= min_remaining:
+            return
+        sleep_seconds = reset_utc - time.time()
+        if sleep_seconds > 0:
+            if logger:
+                logger.info("Rate limit almost used up, sleeping for {:.0f}s".format(sleep_seconds))
+            time.sleep(sleep_seconds)
+
+
+class SharedRateLimiter(object):
+    """
+    Replacement of the prawcore rate limiter taking its requests from a RateBudget
+
+    Implements the interface prawcore uses without importing it, so scripts can import this module cheaply.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self._local = threading.local()
+
+    @property
+    def current_priority(self):
+        return getattr(self._local, "priority", PRIORITY_NORMAL)
+
+    @contextmanager
+    def priority(self, priority):
+        """ Make requests of the current thread with priority """
+        previous = self.current_priority
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def call(self, request_function, set_header_callback, *args, **kwargs):
+        """ Make a request once the budget allows it and update the budget from the response """
+        self.delay()
+        kwargs["headers"] = set_header_callback()
+        response = request_function(*args, **kwargs)
+        self.update(response.headers)
+        return response
+
+    def delay(self):
+        self.budget.acquire(self.current_priority)
+
+    def update(self, response_headers):
+        self.budget.update(response_headers)
+
+
+def install(reddit, path):
+    """ Make a praw Reddit instance take its requests from the budget at path, returns the limiter """
+    limiter = SharedRateLimiter(RateBudget(path))
+    reddit._core._rate_limiter = limiter
+    return limiter
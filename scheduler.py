@@ -0,0 +1,188 @@
+""" Simple in-process job scheduler with interval and cron-like schedules """
+
+import time
+import threading
+from datetime import datetime, timedelta
+
+
+_CRON_ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+    "@yearly": "0 0 1 1 *",
+}
+
+
+class IntervalSchedule(object):
+    """ Run every seconds """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def next_run(self, after):
+        return after + self.seconds
+
+    def __str__(self):
+        return "every {}s".format(self.seconds)
+
+
+class CronSchedule(object):
+    """
+    Run on a cron expression (minute hour day-of-month month day-of-week) in local time
+
+    Fields support *, numbers, ranges (a-b), lists (a,b) and steps (*/n, a-b/n).
+    The aliases @hourly, @daily, @weekly, @monthly and @yearly are supported as well.
+    """
+
+    _RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = _CRON_ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise ValueError("Cron expression needs 5 fields: {}".format(expression))
+        self._minutes, self._hours, self._days, self._months, self._weekdays = [
+            self._parse_field(field, low, high) for field, (low, high) in zip(fields, self._RANGES)]
+        # Like cron, restricting both day fields means either of them has to match
+        self._any_day = fields[2] == "*" or fields[4] == "*"
+
+    @staticmethod
+    def _parse_field(field, low, high):
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step = part.split("/", 1)
+                step = int(step)
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = [int(value) for value in part.split("-", 1)]
+            else:
+                start = end = int(part)
+                if step != 1:
+                    end = high
+            if start < low or end > high or start > end:
+                raise ValueError("Cron field {} out of range {}-{}".format(field, low, high))
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, moment):
+        # cron counts weekdays from sunday
+        day_match = moment.day in self._days
+        weekday_match = (moment.weekday() + 1) % 7 in self._weekdays
+        if self._any_day:
+            return day_match and weekday_match
+        return day_match or weekday_match
+
+    def next_run(self, after):
+        moment = datetime.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=5 * 366)
+        while moment < limit:
+            if moment.month not in self._months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self._hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self._minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return time.mktime(moment.timetuple())
+        raise ValueError("Cron expression never matches: {}".format(self.expression))
+
+    def __str__(self):
+        return "cron '{}'".format(self.expression)
+
+
+def parse_schedule(text):
+    """ Parse a schedule from config, a number of seconds or a cron expression """
+    text = text.strip()
+    if text.isdigit():
+        return IntervalSchedule(int(text))
+    return CronSchedule(text)
+
+
+class Job(object):
+    """ Scheduled job, never runs more than once at a time """
+
+    def __init__(self, name, func, schedule, exclusive=False):
+        self.name = name
+        self.func = func
+        self.schedule = schedule
+        self.exclusive = exclusive
+        self.next_run = None
+        self.running = threading.Lock()
+
+
+class Scheduler(object):
+    """
+    Runs jobs in their own threads when they are due
+
+    A job that is still running when it is due again is skipped for that run. Exclusive jobs
+    never run at the same time as other exclusive jobs.
+    """
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._jobs = []
+        self._exclusive = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def add(self, name, func, schedule, exclusive=False, run_now=False):
+        job = Job(name, func, schedule, exclusive)
+        now = time.time()
+        job.next_run = now if run_now else schedule.next_run(now)
+        self._jobs.append(job)
+        self._logger.info("Scheduled {} {}, next run at {}".format(
+            name, schedule, datetime.fromtimestamp(job.next_run).strftime("%Y-%m-%d %H:%M:%S")))
+        return job
+
+    def _run_job(self, job):
+        try:
+            if job.exclusive:
+                self._exclusive.acquire()
+            try:
+                self._logger.info("Running job {}".format(job.name))
+                start = time.time()
+                job.func()
+                self._logger.info("Job {} done in {:.1f}s".format(job.name, time.time() - start))
+            finally:
+                if job.exclusive:
+                    self._exclusive.release()
+        except Exception as exception:
+            self._logger.error("Job {} failed: {}".format(job.name, exception))
+        finally:
+            job.running.release()
+
+    def run_pending(self):
+        """ Start all due jobs, returns seconds until the next job is due """
+        now = time.time()
+        for job in self._jobs:
+            if job.next_run > now:
+                continue
+            job.next_run = job.schedule.next_run(now)
+            if not job.running.acquire(False):
+                self._logger.warning("Job {} is still running, skipping this run".format(job.name))
+                continue
+            thread = threading.Thread(target=self._run_job, args=(job,), name="job-" + job.name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        if not self._jobs:
+            return 60
+        return max(min(job.next_run for job in self._jobs) - time.time(), 0)
+
+    def run(self):
+        """ Run jobs until stop is called """
+        while not self._stop.is_set():
+            self._stop.wait(min(self.run_pending(), 60))
+
+    def stop(self, timeout=None):
+        """ Stop scheduling new runs and wait for running jobs """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
@@ -0,0 +1,104 @@
+""" Shared test setup and fakes of reddit things """
+
+import logging
+
+import pytest
+
+import log_conf
+from common import SubRedditMod
+from user_db import UserDB
+
+
+@pytest.fixture(autouse=True, scope="session")
+def log_to_tmp(tmp_path_factory):
+    """ Write the log of the code under test to a temporary directory instead of the working directory """
+    log_file = str(tmp_path_factory.mktemp("log") / "actions.log")
+    original = log_conf.get_logging_config
+    log_conf.get_logging_config = lambda: {"log_file": log_file}
+    yield log_file
+    log_conf.get_logging_config = original
+
+
+class Author(object):
+
+    def __init__(self, name, css_class=None):
+        self.name = name
+        self.flair_css_class = css_class
+
+
+class Comment(object):
+    """ Comment on the thread, reply fails with reply_error after calling on_reply """
+
+    def __init__(self, comment_id, author, body="", css_class=None, flair_text=None, created_utc=0,
+                 parent_id="t3_thread", reply_error=None, on_reply=None):
+        self.id = comment_id
+        self.fullname = "t1_" + comment_id
+        self.parent_id = parent_id
+        self.author = Author(author) if author is not None else None
+        self.body = body
+        self.author_flair_css_class = css_class
+        self.author_flair_text = flair_text
+        self.created_utc = created_utc
+        self.replies_sent = []
+        self.reports = []
+        self._reply_error = reply_error
+        self._on_reply = on_reply
+
+    def reply(self, body):
+        if self._on_reply is not None:
+            self._on_reply()
+        if self._reply_error is not None:
+            raise self._reply_error
+        self.replies_sent.append(body)
+
+    def report(self, reason):
+        self.reports.append(reason)
+
+
+class Reddit(object):
+    """ praw Reddit answering every post, like morechildren, with things """
+
+    def __init__(self, things):
+        self.things = things
+        self.posts = []
+
+    def post(self, path, data):
+        self.posts.append(data)
+        return self.things
+
+
+class Flair(object):
+    """ subreddit.flair, update fails with error or returns results not ok for the users in failing """
+
+    def __init__(self):
+        self.sent = []
+        self.error = None
+        self.failing = set()
+
+    def update(self, flair_list):
+        if self.error is not None:
+            raise self.error
+        self.sent.extend(flair_list)
+        return [{"ok": flair["user"] not in self.failing} for flair in flair_list]
+
+
+class Subreddit(object):
+
+    def __init__(self):
+        self.flair = Flair()
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "user.db")
+
+
+@pytest.fixture
+def subreddit(db_path):
+    """ SubRedditMod of bot swapbot with a user db in tmp_path, not logged in to reddit """
+    subreddit = SubRedditMod(logging.getLogger("test"), "unused.cfg")
+    subreddit._config = {"trade": {"reply": "Added", "user_db": db_path},
+                         "login": {"username": "swapbot"}, "subreddit": {}}
+    subreddit._user_db = UserDB(db_path)
+    subreddit._subreddit = Subreddit()
+    return subreddit
@@ -0,0 +1,92 @@
+""" Tests of submission title classification """
+
+import os
+import json
+import logging
+import shutil
+import threading
+import time
+
+import pytest
+
+from classifier import ClassifierLoader, TitleClassifier, PERSONAL, NONPERSONAL, INVALID
+from common import DictConfigParser
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def classifier():
+    config = DictConfigParser()
+    config.read(os.path.join(ROOT_DIR, "config.cfg.sample"))
+    with open(os.path.join(ROOT_DIR, "submission_categories.json")) as category_file:
+        post_categories = json.load(category_file)
+    with open(os.path.join(ROOT_DIR, "locations.json")) as locations_file:
+        locations = json.load(locations_file)
+    return TitleClassifier(config["post_check"], post_categories, locations)
+
+
+def test_selling_is_checked_for_timestamp(classifier):
+    verdict = classifier.classify("[US-CA] [H] GMK Olivia [W] PayPal")
+    assert (verdict.kind, verdict.category, verdict.timestamp_check) == (PERSONAL, "Selling", True)
+
+
+def test_buying_is_not_checked_for_timestamp(classifier):
+    verdict = classifier.classify("[US-CA] [H] PayPal [W] GMK Olivia")
+    assert (verdict.kind, verdict.category, verdict.timestamp_check) == (PERSONAL, "Buying", False)
+
+
+def test_default_category_is_not_checked_for_timestamp(classifier):
+    verdict = classifier.classify("[US-CA] [H] GMK [W] Keyboard")
+    assert (verdict.kind, verdict.category, verdict.timestamp_check) == (PERSONAL, "Trading", False)
+
+
+def test_matched_trading_is_checked_for_timestamp(classifier):
+    verdict = classifier.classify("[US-CA] [H] GMK [W] Trade")
+    assert (verdict.kind, verdict.category, verdict.timestamp_check) == (PERSONAL, "Trading", True)
+
+
+def test_invalid_location(classifier):
+    verdict = classifier.classify("[XX-YY] [H] GMK [W] PayPal")
+    assert (verdict.kind, verdict.bad_part) == (INVALID, "location")
+
+
+def test_nonpersonal_tag(classifier):
+    verdict = classifier.classify("[IC] New keycap set")
+    assert (verdict.kind, verdict.category, verdict.timestamp_check) == (NONPERSONAL, "Interest Check", False)
+
+
+def test_unknown_tag(classifier):
+    verdict = classifier.classify("[WTS] Keyboard")
+    assert (verdict.kind, verdict.bad_part) == (INVALID, "tag")
+
+
+def test_changed_config_is_loaded_once_by_concurrent_workers(tmp_path):
+    paths = []
+    for name in ("submission_categories.json", "locations.json"):
+        paths.append(str(tmp_path / name))
+        shutil.copy(os.path.join(ROOT_DIR, name), paths[-1])
+    config = DictConfigParser()
+    config.read(os.path.join(ROOT_DIR, "config.cfg.sample"))
+    loader = ClassifierLoader(logging.getLogger("test"), lambda: config, *paths)
+    first = loader.get()
+
+    builds = []
+    build = loader._build
+
+    def slow_build():
+        builds.append(threading.current_thread())
+        time.sleep(0.05)
+        return build()
+    loader._build = slow_build
+    os.utime(paths[0], (time.time() + 10, time.time() + 10))
+
+    classifiers = []
+    workers = [threading.Thread(target=lambda: classifiers.append(loader.get())) for _ in range(8)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert len(builds) == 1
+    assert len({id(classifier) for classifier in classifiers}) == 1
+    assert classifiers[0] is not first
@@ -0,0 +1,190 @@
+""" Tests of trade flair: completing trades and sending the flair journal """
+
+import logging
+import sqlite3
+
+import pytest
+
+from praw.models import MoreComments
+
+from common import FLAIR_MAX_ATTEMPTS, ReplyIndex
+from conftest import Author, Comment, Reddit
+from flair import TradeFlairer
+
+LOGGER = logging.getLogger("test")
+
+
+def test_reply_is_sent_after_the_trade_is_committed(subreddit, db_path):
+    flairer = TradeFlairer(subreddit, LOGGER, subreddit.user_db)
+    flairer.open_submission("thread")
+
+    def write_from_other_process():
+        # The db is not held while replying to reddit
+        with sqlite3.connect(db_path, timeout=0) as con:
+            con.execute("INSERT INTO meta (key, value) VALUES ('other', 1)")
+
+    parent = Comment("c1", "alice", css_class="i-3")
+    reply = Comment("c2", "bob", css_class="i-0", on_reply=write_from_other_process)
+    flairer.complete(parent, reply)
+    assert reply.replies_sent == ["Added"]
+    assert subreddit.user_db.get_trade_states("thread") == {"c1": "completed"}
+
+
+def test_failed_reply_keeps_the_trade(subreddit):
+    flairer = TradeFlairer(subreddit, LOGGER, subreddit.user_db)
+    flairer.open_submission("thread")
+    parent = Comment("c1", "alice", css_class="i-3")
+    reply = Comment("c2", "bob", css_class="i-0", reply_error=RuntimeError("comment too old"))
+    flairer.complete(parent, reply)
+    assert subreddit.user_db.get_trade_states("thread") == {"c1": "completed"}
+    assert {entry[:2] for entry in subreddit.user_db.get_flair_journal()} == {("alice", "i-4"), ("bob", "i-1")}
+
+
+def test_flair_journal_is_sent_again_after_a_failed_flush(subreddit):
+    subreddit.update_comment_user_flair(Comment("c1", "alice", css_class="i-3"), css_class="i-4")
+    subreddit.update_comment_user_flair(Comment("c2", "bob", css_class="i-0"), css_class="i-1")
+    subreddit.subreddit.flair.error = RuntimeError("503 Service Unavailable")
+    with pytest.raises(RuntimeError):
+        subreddit.flush_flair()
+    assert len(subreddit.user_db.get_flair_journal()) == 2
+
+    # Next run, after the flair changed again
+    subreddit.update_comment_user_flair(Comment("c3", "alice", css_class="i-4"), css_class="i-5")
+    subreddit.subreddit.flair.error = None
+    subreddit.flush_flair()
+    assert sorted((flair["user"], flair["flair_css_class"]) for flair in subreddit.subreddit.flair.sent) == [
+        ("alice", "i-5"), ("bob", "i-1")]
+    assert subreddit.user_db.get_flair_journal() == []
+
+
+def test_refused_flair_changes_are_sent_again(subreddit):
+    subreddit.update_comment_user_flair(Comment("c1", "alice", css_class="i-3"), css_class="i-4")
+    subreddit.update_comment_user_flair(Comment("c2", "bob", css_class="i-0"), css_class="i-1")
+    subreddit.subreddit.flair.failing = {"bob"}
+    subreddit.flush_flair()
+    assert [entry[:2] for entry in subreddit.user_db.get_flair_journal()] == [("bob", "i-1")]
+    assert subreddit.user_db.get_flair("alice")[:2] == (4, "i-4")
+    # The ledger keeps the trade while the change is retried
+    assert subreddit.get_user_trade_count(Comment("c3", "bob", css_class="i-0")) == 1
+
+    subreddit.subreddit.flair.failing = set()
+    subreddit.flush_flair()
+    assert subreddit.user_db.get_flair_journal() == []
+    assert [flair["user"] for flair in subreddit.subreddit.flair.sent] == ["alice", "bob", "bob"]
+
+
+def test_refused_flair_change_is_dropped_after_max_attempts(subreddit):
+    subreddit.update_comment_user_flair(Comment("c1", "ghost", css_class="i-0"), css_class="i-1")
+    subreddit.subreddit.flair.failing = {"ghost"}
+    for _ in range(FLAIR_MAX_ATTEMPTS - 1):
+        subreddit.flush_flair()
+    assert subreddit.user_db.get_flair_journal()[0][4] == FLAIR_MAX_ATTEMPTS - 1
+
+    # A new change is sent with a new count
+    subreddit.update_comment_user_flair(Comment("c2", "ghost", css_class="i-1"), css_class="i-2")
+    subreddit.flush_flair()
+    assert subreddit.user_db.get_flair_journal()[0][4] == 1
+
+    for _ in range(FLAIR_MAX_ATTEMPTS - 1):
+        subreddit.flush_flair()
+    assert subreddit.user_db.get_flair_journal() == []
+
+
+def test_flair_set_outside_the_bot_wins_over_the_ledger(subreddit):
+    subreddit.user_db.set_flair("alice", "i-3", None)
+    # Set by a mod since the ledger was synced
+    comment = Comment("c1", "alice", css_class="i-10", flair_text="https://heatware.com/u/123")
+    assert subreddit.get_user_trade_count(comment) == 10
+    assert subreddit.user_db.get_flair("alice") == (10, "i-10", "https://heatware.com/u/123")
+
+    flairer = TradeFlairer(subreddit, LOGGER, subreddit.user_db)
+    flairer.open_submission("thread")
+    flairer.complete(comment, Comment("c2", "bob", css_class="i-0"))
+    assert {entry[0]: entry[1:3] for entry in subreddit.user_db.get_flair_journal()}["alice"] == (
+        "i-11", "https://heatware.com/u/123")
+
+
+def test_queued_flair_wins_until_it_is_sent(subreddit):
+    subreddit.update_comment_user_flair(Comment("c1", "alice", css_class="i-3"), css_class="i-4")
+    # Comments fetched before the flair was sent still have the old flair
+    stale = Comment("c2", "alice", css_class="i-3")
+    assert subreddit.get_user_trade_count(stale) == 4
+    assert subreddit.get_user_flair(stale) == ("i-4", None)
+
+    subreddit.flush_flair()
+    assert subreddit.get_user_trade_count(Comment("c3", "alice", css_class="i-4")) == 4
+
+
+def test_unknown_user_flair_is_read_from_the_item(subreddit):
+    assert subreddit.get_user_trade_count(Comment("c1", "alice", css_class="i-7")) == 7
+    assert subreddit.get_user_flair(Comment("c2", "bob", css_class="mod")) == ("mod", None)
+    assert subreddit.user_db.get_flair("alice") is None
+
+
+class Replies(list):
+
+    def list(self):
+        return list(self)
+
+
+class TreeComment(object):
+    """ Comment in a loaded tree, refresh loads its replies from replies_on_refresh """
+
+    def __init__(self, comment_id, author, parent_id, replies_on_refresh=()):
+        self.id = comment_id
+        self.fullname = "t1_" + comment_id
+        self.author = Author(author)
+        self.parent_id = parent_id
+        self.replies = Replies()
+        self.refreshed = False
+        self._replies_on_refresh = replies_on_refresh
+
+    def refresh(self):
+        self.refreshed = True
+        self.replies = Replies(self._replies_on_refresh)
+
+
+def test_replies_are_loaded_together(subreddit):
+    truncated_reply = TreeComment("r2", "dave", "t1_c2")
+    first = TreeComment("c1", "alice", "t3_thread")
+    second = TreeComment("c2", "carol", "t3_thread", [truncated_reply])
+    reply = TreeComment("r1", "bob", "t1_c1")
+    subreddit._praw_h = Reddit([first, reply, second,
+                                MoreComments(None, {"count": 1, "children": ["r2"], "parent_id": "t1_c2"})])
+    subreddit._new_reply_index = lambda: ReplyIndex("swapbot", set())
+
+    subreddit.load_reply_trees("thread", [first, second])
+    assert subreddit._praw_h.posts == [{"children": "c1,c2", "link_id": "t3_thread"}]
+    assert subreddit.get_replies(first) == [reply]
+    assert not first.refreshed
+    # Not all replies were in the response
+    assert subreddit.get_replies(second) == [truncated_reply]
+    assert second.refreshed
+
+
+def test_comment_edited_after_an_edit_request_is_checked_again(subreddit):
+    subreddit.check_bot_reply = lambda comment: None
+    flairer = TradeFlairer(subreddit, LOGGER, subreddit.user_db)
+    flairer.open_submission("thread")
+    comment = Comment("c1", "alice", "Traded with bob")
+    comment.is_root = True
+    comment.edited = False
+    assert flairer.check_top_level_comment(comment) is None
+    assert subreddit.user_db.get_edit_requests("thread") == {"c1": "c1"}
+
+    processed = []
+    flairer.process_comment = lambda comment: processed.append(comment.id)
+    subreddit.get_new_thread_comments = lambda link_id, since_utc: []
+    subreddit.get_comments = lambda comment_ids: {comment_id: comment for comment_id in comment_ids}
+    subreddit.get_comment = lambda comment_id: comment
+    now = 10000.0
+    assert flairer._incremental_scan(now, now - 300, now - 300)
+    assert processed == []
+
+    # Edits don't show up in the comment listing
+    comment.edited = now - 100
+    assert flairer._incremental_scan(now, now - 300, now - 300)
+    assert processed == ["c1"]
+
+    flairer.add_completed(comment)
+    assert subreddit.user_db.get_edit_requests("thread") == {}
@@ -0,0 +1,115 @@
+""" Tests of the heatware thread: profile claims and handled comments """
+
+import re
+import time
+
+import pytest
+
+import heatware
+from common import ReplyIndex
+from conftest import Comment, Reddit
+
+REGEX = re.compile(r"^(https?:\/\/(?:www\.)?heatware\.com\/(?:eval\.php\?id=|u\/)(?P<id>\d{1,7})(?:\/to\/?)?)$")
+
+CFG = {"link_id": "thread", "regex": REGEX.pattern, "add_msg": "Added", "report_overwrite": True,
+       "overwrite_flair": False, "overwrite_msg": ""}
+
+
+@pytest.fixture
+def subreddit(subreddit):
+    subreddit._config["heatware"] = dict(CFG)
+    subreddit.check_mod_reply = lambda comment: False
+    return subreddit
+
+
+def flair_texts(subreddit):
+    return {entry[0]: entry[2] for entry in subreddit.user_db.get_flair_journal()}
+
+
+def test_claimed_profile_is_reported(subreddit):
+    first = Comment("c1", "alice", "https://www.heatware.com/u/123")
+    heatware.process_comment(subreddit, CFG, REGEX, "thread", first)
+    assert first.replies_sent == ["Added"]
+    assert subreddit.user_db.get_heatware_claim("123") == "alice"
+
+    # The same profile in its other link form
+    second = Comment("c2", "mallory", "http://heatware.com/eval.php?id=123")
+    heatware.process_comment(subreddit, CFG, REGEX, "thread", second)
+    assert second.reports == ["Heatware already claimed by /u/alice"]
+    assert second.replies_sent == []
+    assert "mallory" not in flair_texts(subreddit)
+    assert subreddit.user_db.get_heatware_claim("123") == "alice"
+    assert subreddit.user_db.get_handled_comments("thread") == {"c1", "c2"}
+
+
+def test_profile_can_be_claimed_again_by_the_same_user(subreddit):
+    heatware.process_comment(subreddit, CFG, REGEX, "thread", Comment("c1", "alice", "https://heatware.com/u/123"))
+    again = Comment("c2", "alice", "https://heatware.com/eval.php?id=123")
+    heatware.process_comment(subreddit, CFG, REGEX, "thread", again)
+    assert again.reports == []
+    assert flair_texts(subreddit) == {"alice": "https://heatware.com/eval.php?id=123"}
+
+
+def test_claims_are_seeded_from_the_flair_ledger(subreddit):
+    subreddit.user_db.import_flairs([
+        {"user": "alice", "flair_text": "https://www.heatware.com/u/123", "flair_css_class": "i-3"},
+        {"user": "bob", "flair_text": "https://heatware.com/eval.php?id=123", "flair_css_class": "i-1"},
+        {"user": "carol", "flair_text": "Mod", "flair_css_class": "mod"}])
+    heatware.seed_claims(subreddit.user_db, REGEX)
+    assert subreddit.user_db.get_heatware_claim("123") == "alice"
+
+    comment = Comment("c1", "bob", "https://heatware.com/u/123")
+    heatware.process_comment(subreddit, CFG, REGEX, "thread", comment)
+    assert comment.reports == ["Heatware already claimed by /u/alice"]
+
+
+def test_failed_reply_keeps_the_comment_handled(subreddit):
+    comment = Comment("c1", "alice", "https://heatware.com/u/123", reply_error=RuntimeError("403 Forbidden"))
+    heatware.process_comment(subreddit, CFG, REGEX, "thread", comment)
+    assert subreddit.user_db.get_handled_comments("thread") == {"c1"}
+    assert subreddit.user_db.get_heatware_claim("123") == "alice"
+    assert flair_texts(subreddit) == {"alice": "https://heatware.com/u/123"}
+
+
+def test_failing_comment_does_not_block_the_thread(subreddit):
+    comments = [Comment("c1", "alice", "https://heatware.com/u/1", created_utc=1),
+                Comment("c2", "bob", "https://heatware.com/u/2", created_utc=2),
+                Comment("c3", None, "[deleted]", created_utc=3)]
+    subreddit.get_top_level_comments = lambda link_id: comments
+
+    def check_mod_reply(comment):
+        if comment.id == "c1":
+            raise RuntimeError("503 Service Unavailable")
+        return False
+    subreddit.check_mod_reply = check_mod_reply
+
+    heatware.process_thread(subreddit, full=True)
+    assert subreddit.user_db.get_handled_comments("thread") == {"c2", "c3"}
+    assert flair_texts(subreddit) == {"bob": "https://heatware.com/u/2"}
+
+    # Checked again by the next full scan
+    subreddit.check_mod_reply = lambda comment: False
+    heatware.process_thread(subreddit, full=True)
+    assert subreddit.user_db.get_handled_comments("thread") == {"c1", "c2", "c3"}
+    assert comments[0].replies_sent == ["Added"]
+
+
+def test_new_comment_answered_by_a_mod_is_skipped(subreddit):
+    # The real check, on the replies loaded for the new comments
+    del subreddit.check_mod_reply
+    subreddit._new_reply_index = lambda: ReplyIndex("swapbot", {"heatmod"})
+    now = time.time()
+    subreddit.user_db.set_thread_scan("thread", now - 60, now - 60)
+
+    answered = Comment("c1", "alice", "https://heatware.com/u/1", created_utc=now)
+    new = Comment("c2", "bob", "https://heatware.com/u/2", created_utc=now)
+    mod_reply = Comment("r1", "heatmod", "Already verified", created_utc=now, parent_id="t1_c1")
+    # Comments in the listing have no replies
+    subreddit.get_new_thread_comments = lambda link_id, since_utc: [new, mod_reply, answered]
+    subreddit._praw_h = Reddit([answered, mod_reply, new])
+
+    heatware.process_thread(subreddit)
+    assert answered.replies_sent == []
+    assert new.replies_sent == ["Added"]
+    assert flair_texts(subreddit) == {"bob": "https://heatware.com/u/2"}
+    assert subreddit.user_db.get_handled_comments("thread") == {"c1", "c2"}
@@ -0,0 +1,82 @@
+""" Tests of log rotation """
+
+import os
+import time
+import logging
+
+from log_conf import SizedTimedRotatingFileHandler
+
+DAY = 24 * 3600
+
+
+def _record(message):
+    return logging.LogRecord("test", logging.INFO, __file__, 1, message, (), None)
+
+
+def _read(path):
+    with open(path) as log_file:
+        return log_file.read()
+
+
+def _write_old_log(path, age):
+    with open(path, "w") as log_file:
+        log_file.write("old\n")
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+
+
+def test_rotates_log_written_in_an_earlier_interval(tmp_path):
+    path = str(tmp_path / "actions.log")
+    _write_old_log(path, 2 * DAY)
+    handler = SizedTimedRotatingFileHandler(path, interval=DAY, backup_count=2)
+    handler.handle(_record("new"))
+    handler.close()
+    assert _read(path + ".1") == "old\n"
+    assert _read(path) == "new\n"
+
+
+def test_keeps_log_written_in_the_current_interval(tmp_path):
+    path = str(tmp_path / "actions.log")
+    _write_old_log(path, 0)
+    handler = SizedTimedRotatingFileHandler(path, interval=DAY, backup_count=2)
+    handler.handle(_record("new"))
+    handler.close()
+    assert not os.path.exists(path + ".1")
+    assert _read(path) == "old\nnew\n"
+
+
+def test_rotates_by_size(tmp_path):
+    path = str(tmp_path / "actions.log")
+    handler = SizedTimedRotatingFileHandler(path, max_bytes=10, backup_count=2)
+    handler.handle(_record("first"))
+    handler.handle(_record("second"))
+    handler.close()
+    assert _read(path + ".1") == "first\n"
+    assert _read(path) == "second\n"
+
+
+def test_never_rotates_without_backups(tmp_path):
+    path = str(tmp_path / "actions.log")
+    _write_old_log(path, 2 * DAY)
+    handler = SizedTimedRotatingFileHandler(path, max_bytes=10, interval=DAY, backup_count=0)
+    handler.handle(_record("first"))
+    handler.handle(_record("second"))
+    handler.close()
+    assert os.listdir(str(tmp_path)) == ["actions.log"]
+    assert _read(path) == "old\nfirst\nsecond\n"
+
+
+def test_handlers_sharing_a_log_rotate_it_once(tmp_path):
+    path = str(tmp_path / "actions.log")
+    first = SizedTimedRotatingFileHandler(path, max_bytes=20, backup_count=5)
+    second = SizedTimedRotatingFileHandler(path, max_bytes=20, backup_count=5)
+    first.handle(_record("first 1"))
+    second.handle(_record("second 1"))
+    # Rotated by the first handler, the second one writes to the new log instead of the rotated one
+    first.handle(_record("first 2"))
+    second.handle(_record("second 2"))
+    first.close()
+    second.close()
+    assert _read(path + ".1") == "first 1\nsecond 1\n"
+    assert _read(path) == "first 2\nsecond 2\n"
+    assert not os.path.exists(path + ".2")
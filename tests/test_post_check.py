@@ -0,0 +1,274 @@
+""" Tests of the submission feed checkpoint, the post check loop and duplicate checks """
+
+import time
+
+import pytest
+
+import post_check
+from classifier import Verdict, NONPERSONAL
+from dupe_index import DupeIndex
+from history_store import HistoryStore
+from post_check import PostChecker, PostCheckRunner, PostPipeline, SubmissionFeed
+
+
+class Post(object):
+
+    def __init__(self, number):
+        self.id = "p{}".format(number)
+        self.fullname = "t3_" + self.id
+        self.created_utc = 1000.0 + number
+
+    def __repr__(self):
+        return self.id
+
+
+class Subreddit(object):
+    """ New posts of a subreddit, the stream has nothing new and stops the test when polled stream_polls times """
+
+    def __init__(self, count, stream_polls=1):
+        self.posts = [Post(number) for number in range(count)]
+        self._stream_polls = stream_polls
+
+    def get_new_since(self, fullname=None, created_utc=0, limit=None):
+        posts = []
+        for post in list(reversed(self.posts))[:limit]:
+            if post.fullname == fullname or post.created_utc < created_utc:
+                break
+            posts.append(post)
+        posts.reverse()
+        return posts
+
+    def stream_new(self, pause_after=0):
+        for _ in range(self._stream_polls):
+            yield None
+        raise KeyboardInterrupt
+
+
+@pytest.fixture
+def checkpoint_path(tmp_path):
+    return str(tmp_path / "post_check.checkpoint")
+
+
+def test_first_catch_up_is_limited(checkpoint_path):
+    feed = SubmissionFeed(Subreddit(50), checkpoint_path, initial_limit=20)
+    posts = feed.catch_up()
+    assert [post.id for post in posts] == ["p{}".format(number) for number in range(30, 50)]
+
+
+def test_catch_up_from_checkpoint_survives_restart(checkpoint_path):
+    subreddit = Subreddit(10)
+    feed = SubmissionFeed(subreddit, checkpoint_path)
+    feed.save_checkpoint(subreddit.posts[6])
+    subreddit.posts.extend(Post(number) for number in range(10, 12))
+
+    restarted = SubmissionFeed(subreddit, checkpoint_path)
+    assert restarted.checkpoint == ("t3_p6", 1006.0)
+    assert [post.id for post in restarted.catch_up()] == ["p7", "p8", "p9", "p10", "p11"]
+    # Posts are only returned once
+    assert restarted.catch_up() == []
+
+
+def test_checkpoint_never_moves_back(checkpoint_path):
+    subreddit = Subreddit(10)
+    feed = SubmissionFeed(subreddit, checkpoint_path)
+    feed.save_checkpoint(subreddit.posts[6])
+    feed.save_checkpoint(subreddit.posts[3])
+    assert SubmissionFeed(subreddit, checkpoint_path).checkpoint == ("t3_p6", 1006.0)
+
+
+def test_forgotten_posts_are_caught_up_again(checkpoint_path):
+    subreddit = Subreddit(5)
+    feed = SubmissionFeed(subreddit, checkpoint_path)
+    posts = feed.catch_up()
+    feed.forget(posts)
+    assert feed.catch_up() == posts
+
+
+def test_failed_batch_is_retried(checkpoint_path, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(post_check, "sleep", sleeps.append)
+    runner = PostCheckRunner.__new__(PostCheckRunner)
+    runner.feed = SubmissionFeed(Subreddit(3), checkpoint_path)
+    handled = []
+
+    def handle_batch(new_posts):
+        if not sleeps:
+            raise IOError("database is locked")
+        handled.append([post.id for post in new_posts])
+        runner.feed.save_checkpoint(new_posts[-1])
+
+    runner.handle_batch = handle_batch
+    with pytest.raises(KeyboardInterrupt):
+        runner.run(retry_delay=60)
+    assert sleeps == [60]
+    assert handled == [["p0", "p1", "p2"]]
+    assert runner.feed.checkpoint == ("t3_p2", 1002.0)
+
+
+def test_retry_delay_backs_off(checkpoint_path, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(post_check, "sleep", sleeps.append)
+    runner = PostCheckRunner.__new__(PostCheckRunner)
+    runner.feed = SubmissionFeed(Subreddit(3), checkpoint_path)
+
+    def handle_batch(new_posts):
+        if len(sleeps) == 5:
+            raise KeyboardInterrupt
+        raise IOError("database is locked")
+
+    runner.handle_batch = handle_batch
+    with pytest.raises(KeyboardInterrupt):
+        runner.run(retry_delay=60, max_retry_delay=600)
+    assert sleeps == [60, 120, 240, 480, 600]
+
+
+class Stores(object):
+    """ User db, post checker and SubRedditMod of a PostCheckRunner, without anything to store or prefetch """
+
+    def flush(self):
+        pass
+
+    def flush_usernotes(self):
+        pass
+
+    def prefetch_removal_status(self, posts):
+        pass
+
+    def wait_for_rate_limit(self, min_remaining):
+        pass
+
+
+def batch_runner(checkpoint_path, subreddit, failing):
+    """ PostCheckRunner whose check fails for the post ids in failing, handled post ids are in runner.handled """
+    runner = PostCheckRunner.__new__(PostCheckRunner)
+    runner.feed = SubmissionFeed(subreddit, checkpoint_path)
+    runner._subreddit = runner._user_db = runner.post_checker = Stores()
+    runner._pipeline = None
+    runner._first_pass = False
+    runner._attempts = {}
+    runner.handled = []
+
+    def handle_post(post):
+        if post.id in failing:
+            raise IOError("503 Service Unavailable")
+        runner.handled.append(post.id)
+    runner.handle_post = handle_post
+    return runner
+
+
+def test_checkpoint_stops_before_a_failed_post(checkpoint_path):
+    failing = {"p1"}
+    runner = batch_runner(checkpoint_path, Subreddit(3), failing)
+    runner.handle_batch(runner.feed.catch_up())
+    assert runner.handled == ["p0", "p2"]
+    assert runner.feed.checkpoint == ("t3_p0", 1000.0)
+
+    failing.clear()
+    retry = runner.feed.catch_up()
+    assert [post.id for post in retry] == ["p1"]
+    runner.handle_batch(retry)
+    assert runner.handled == ["p0", "p2", "p1"]
+    assert runner.feed.checkpoint == ("t3_p1", 1001.0)
+
+
+def test_failing_post_is_given_up_on(checkpoint_path):
+    runner = batch_runner(checkpoint_path, Subreddit(2), {"p1"})
+    runner.handle_batch(runner.feed.catch_up())
+    for _ in range(runner.max_attempts - 1):
+        assert runner.feed.checkpoint == ("t3_p0", 1000.0)
+        runner.handle_batch(runner.feed.catch_up())
+    assert runner.feed.checkpoint == ("t3_p1", 1001.0)
+    assert runner.feed.catch_up() == []
+
+
+def test_pipeline_returns_failed_posts():
+    def handler(post):
+        if post.id == "p1":
+            raise IOError("503 Service Unavailable")
+    pipeline = PostPipeline(Stores(), handler, workers=2)
+    posts = [Post(number) for number in range(3)]
+    for post in posts:
+        post.author = None
+        pipeline.submit(post)
+    assert pipeline.join() == [posts[1]]
+    assert pipeline.join() == []
+
+
+def test_forgotten_posts_are_caught_up_while_streaming(checkpoint_path):
+    feed = SubmissionFeed(Subreddit(3, stream_polls=2), checkpoint_path)
+    batches = feed.batches()
+    first = next(batches)
+    feed.forget(first[1:2])
+    assert [post.id for post in next(batches)] == ["p1"]
+
+
+LISTING = ("Group buy for the Example 65% keyboard, aluminium case in silver and black, brass weight, "
+           "hotswap PCB, shipping worldwide from the US warehouse in March, join through the form below")
+
+
+class Listing(object):
+    """ Submission with the flair and reports set by the post check """
+
+    def __init__(self, post_id, author, selftext):
+        self.id = post_id
+        self.author = author
+        self.created_utc = time.time()
+        self.title = "[GB] Example 65"
+        self.selftext = selftext
+        self.reports = []
+        self.mod = self
+
+    def flair(self, text, css_class):
+        pass
+
+    def report(self, reason):
+        self.reports.append(reason)
+
+
+class CheckedSubreddit(object):
+    config = {"post_check": {}}
+
+
+@pytest.fixture
+def checker(tmp_path):
+    checker = PostChecker(CheckedSubreddit(), None, None, HistoryStore(str(tmp_path)),
+                          DupeIndex(str(tmp_path / "dupes.idx")))
+    checker.check_repost = lambda post, category_prefix: None
+    checker.post_comment = lambda post: None
+    return checker
+
+
+def nonpersonal_verdict(category_prop):
+    return Verdict(NONPERSONAL, None, "Group Buy", "groupbuy", None, False, category_prop)
+
+
+def test_nonpersonal_duplicate_is_reported(checker):
+    verdict = nonpersonal_verdict({"tag": "GB", "class": "groupbuy"})
+    checker.check_and_flair_nonpersonal(Listing("p1", "vendor", LISTING), verdict)
+    duplicate = Listing("p2", "alt", LISTING)
+    checker.check_and_flair_nonpersonal(duplicate, verdict)
+    assert duplicate.reports == ["Possible duplicate of https://redd.it/p1 by /u/vendor"]
+
+
+def test_categories_without_repost_check_are_not_checked_for_duplicates(checker):
+    verdict = nonpersonal_verdict({"tag": "Giveaway", "class": "giveaway", "repost_check": False})
+    checker.check_and_flair_nonpersonal(Listing("p1", "mod", LISTING), verdict)
+    giveaway = Listing("p2", "othermod", LISTING)
+    checker.check_and_flair_nonpersonal(giveaway, verdict)
+    assert giveaway.reports == []
+
+
+def test_failed_poll_is_caught_up_by_the_next_poll(checkpoint_path):
+    runner = batch_runner(checkpoint_path, Subreddit(2), set())
+    flush = runner._user_db.flush
+
+    def locked():
+        raise IOError("database is locked")
+    runner._user_db.flush = locked
+    with pytest.raises(IOError):
+        runner.poll()
+    assert runner.feed.checkpoint is None
+
+    runner._user_db.flush = flush
+    runner.poll()
+    assert runner.feed.checkpoint == ("t3_p1", 1001.0)
@@ -0,0 +1,110 @@
+""" Tests of the rate limit budget shared through an sqlite db """
+
+import time
+
+import pytest
+
+from rate_budget import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, RateBudget
+
+
+class Clock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(1000000.0)
+    monkeypatch.setattr(time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "ratelimit.db")
+
+
+def headers(remaining, reset):
+    return {"x-ratelimit-remaining": str(remaining), "x-ratelimit-reset": str(reset)}
+
+
+def test_unknown_budget_is_not_limited(clock, db_path):
+    budget = RateBudget(db_path)
+    assert budget.state() == (None, 0)
+    assert budget._try_acquire(PRIORITY_LOW) == 0
+    assert budget.state() == (None, 0)
+
+
+def test_empty_bucket_waits_for_a_refill(clock, db_path):
+    budget = RateBudget(db_path)
+    budget.update(headers(0, 100))
+    assert budget._try_acquire(PRIORITY_HIGH) == 100
+
+    # Refilled by a response of another process
+    other = RateBudget(db_path)
+    clock.now += 1
+    other.update(headers(600, 600))
+    assert budget._try_acquire(PRIORITY_HIGH) == 0
+    assert other.state() == (599, clock.now + 600)
+
+
+def test_passed_window_is_not_limited(clock, db_path):
+    budget = RateBudget(db_path)
+    budget.update(headers(0, 100))
+    clock.now += 100
+    assert budget.state() == (None, clock.now)
+    assert budget._try_acquire(PRIORITY_NORMAL) == 0
+
+
+def test_lower_priorities_leave_a_reserve(clock, db_path):
+    budget = RateBudget(db_path, reserve=(0, 10, 50))
+    budget.update(headers(30, 600))
+    assert budget._try_acquire(PRIORITY_LOW) == 600
+    assert budget._try_acquire(PRIORITY_NORMAL) == 0
+    assert budget.state()[0] == 29
+
+    budget.update(headers(10.5, 600))
+    assert budget._try_acquire(PRIORITY_NORMAL) == 600
+    assert budget._try_acquire(PRIORITY_HIGH) == 0
+    assert budget.state()[0] == 9.5
+
+
+def test_requests_are_spread_over_the_window(clock, db_path):
+    budget = RateBudget(db_path, reserve=(0, 0, 0))
+    budget.update(headers(100, 500))
+    assert budget._try_acquire(PRIORITY_NORMAL) == 0
+    # 99 requests left for 500 seconds
+    assert budget._try_acquire(PRIORITY_NORMAL) == pytest.approx(500 / 99)
+    assert budget._try_acquire(PRIORITY_HIGH) == 0
+    clock.now += 10
+    assert budget._try_acquire(PRIORITY_NORMAL) == 0
+    assert budget.state()[0] == 97
+
+
+def test_update_keeps_the_lower_count_of_a_window(clock, db_path):
+    budget = RateBudget(db_path)
+    budget.update(headers(100, 600))
+    # Late response of another process, sent before the last one
+    budget.update(headers(150, 598))
+    assert budget.state() == (100, clock.now + 598)
+
+    # Requests taken since the last response are not in the headers yet
+    budget._try_acquire(PRIORITY_HIGH)
+    budget._try_acquire(PRIORITY_HIGH)
+    budget.update(headers(99, 600))
+    assert budget.state()[0] == 98
+
+    budget.update({})
+    assert budget.state()[0] == 98
+
+
+def test_update_of_a_new_window_takes_the_header_values(clock, db_path):
+    budget = RateBudget(db_path)
+    budget.update(headers(3, 10))
+    clock.now += 10
+    budget.update(headers(600, 600))
+    assert budget.state() == (600, clock.now + 600)
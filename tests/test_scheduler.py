@@ -0,0 +1,79 @@
+""" Tests of schedule parsing and cron next run times """
+
+import time
+from datetime import datetime
+
+import pytest
+
+from scheduler import CronSchedule, IntervalSchedule, parse_schedule
+
+
+def next_run(expression, after):
+    return datetime.fromtimestamp(parse_schedule(expression).next_run(time.mktime(after.timetuple())))
+
+
+def test_number_is_an_interval():
+    schedule = parse_schedule(" 300 ")
+    assert isinstance(schedule, IntervalSchedule)
+    assert schedule.next_run(1000.5) == 1300.5
+
+
+def test_expression_is_a_cron_schedule():
+    schedule = parse_schedule("*/15 * * * *")
+    assert isinstance(schedule, CronSchedule)
+    assert str(schedule) == "cron '*/15 * * * *'"
+
+
+def test_step():
+    assert next_run("*/15 * * * *", datetime(2026, 3, 4, 10, 7, 30)) == datetime(2026, 3, 4, 10, 15)
+    assert next_run("*/15 * * * *", datetime(2026, 3, 4, 10, 45)) == datetime(2026, 3, 4, 11, 0)
+    assert next_run("5/20 * * * *", datetime(2026, 3, 4, 10, 26)) == datetime(2026, 3, 4, 10, 45)
+
+
+def test_next_run_is_after_the_given_time():
+    assert next_run("0 3 * * *", datetime(2026, 3, 4, 3, 0)) == datetime(2026, 3, 5, 3, 0)
+    assert next_run("0 3 * * *", datetime(2026, 3, 4, 2, 59, 59)) == datetime(2026, 3, 4, 3, 0)
+
+
+def test_lists_and_ranges():
+    assert next_run("0,30 8-9 * * *", datetime(2026, 3, 4, 9, 30)) == datetime(2026, 3, 5, 8, 0)
+    assert next_run("0 0 * 6-8/2 *", datetime(2026, 6, 30, 12, 0)) == datetime(2026, 8, 1, 0, 0)
+
+
+def test_weekdays_count_from_sunday():
+    # 2026-03-07 is a saturday
+    assert next_run("30 9 * * 1-5", datetime(2026, 3, 7, 12, 0)) == datetime(2026, 3, 9, 9, 30)
+    assert next_run("0 0 * * 0", datetime(2026, 3, 7, 12, 0)) == datetime(2026, 3, 8, 0, 0)
+
+
+def test_either_day_field_matches_when_both_are_restricted():
+    # The 13th, or any friday (2026-03-06)
+    assert next_run("0 0 13 * 5", datetime(2026, 3, 4, 0, 0)) == datetime(2026, 3, 6, 0, 0)
+    assert next_run("0 0 13 * 5", datetime(2026, 3, 11, 0, 0)) == datetime(2026, 3, 13, 0, 0)
+    # Only the day of month is restricted
+    assert next_run("0 0 13 * *", datetime(2026, 3, 4, 0, 0)) == datetime(2026, 3, 13, 0, 0)
+
+
+def test_aliases():
+    assert next_run("@hourly", datetime(2026, 3, 4, 10, 7)) == datetime(2026, 3, 4, 11, 0)
+    assert next_run("@daily", datetime(2026, 3, 4, 10, 7)) == datetime(2026, 3, 5, 0, 0)
+    assert next_run("@weekly", datetime(2026, 3, 4, 10, 7)) == datetime(2026, 3, 8, 0, 0)
+    assert next_run("@monthly", datetime(2026, 12, 4, 10, 7)) == datetime(2027, 1, 1, 0, 0)
+    assert next_run("@yearly", datetime(2026, 3, 4, 10, 7)) == datetime(2027, 1, 1, 0, 0)
+
+
+def test_leap_day():
+    assert next_run("0 0 29 2 *", datetime(2026, 3, 1, 0, 0)) == datetime(2028, 2, 29, 0, 0)
+
+
+def test_expression_that_never_matches():
+    with pytest.raises(ValueError):
+        next_run("0 0 31 2 *", datetime(2026, 3, 4, 0, 0))
+
+
+@pytest.mark.parametrize("expression", ["* * * *", "* * * * * *", "60 * * * *", "* 24 * * *", "* * 0 * *",
+                                        "* * * 13 *", "* * * * 7", "5-1 * * * *", "a * * * *", "*/0 * * * *",
+                                        "@sometimes"])
+def test_invalid_expression(expression):
+    with pytest.raises(ValueError):
+        parse_schedule(expression)
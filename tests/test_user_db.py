@@ -0,0 +1,101 @@
+""" Tests of the user db schema migrations """
+
+import sqlite3
+
+import pytest
+
+import user_db
+from user_db import MIGRATIONS, UserDB
+
+
+def user_version(db_path):
+    with sqlite3.connect(db_path) as con:
+        return con.execute('PRAGMA user_version').fetchone()[0]
+
+
+def user_columns(db_path):
+    with sqlite3.connect(db_path) as con:
+        return {row[1] for row in con.execute('PRAGMA table_info(user)')}
+
+
+def create_old_db(db_path, version, statements=()):
+    """ Create a db with the schema of the first version migrations, then run statements """
+    con = sqlite3.connect(db_path, isolation_level=None)
+    cursor = con.cursor()
+    for migration in MIGRATIONS[:version]:
+        migration(cursor)
+    for statement in statements:
+        cursor.execute(statement)
+    cursor.execute('PRAGMA user_version={:d}'.format(version))
+    con.close()
+
+
+def test_new_db_has_the_latest_schema(db_path):
+    db = UserDB(db_path)
+    db.close()
+    assert user_version(db_path) == len(MIGRATIONS)
+    with sqlite3.connect(db_path) as con:
+        tables = {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    assert tables == {"user", "processed", "trade_confirmation", "thread_scan", "meta", "flair_journal", "profile",
+                      "handled_comment", "heatware_claim", "edit_request"}
+
+
+def test_db_of_the_flair_import_is_migrated(db_path):
+    # Flair ledger created by the old flair import, with a last post of a personal post
+    create_old_db(db_path, 1, [
+        "ALTER TABLE user ADD COLUMN last_created REAL",
+        "ALTER TABLE user ADD COLUMN last_id TEXT",
+        "INSERT INTO user VALUES ('alice', NULL, 'i-12', 1000.0, 'p1')",
+        "INSERT INTO user VALUES ('bob', 'Mod', 'i-mod', NULL, NULL)",
+        "INSERT INTO user VALUES ('carol', 'https://heatware.com/u/1', NULL, NULL, NULL)",
+    ])
+    db = UserDB(db_path)
+    assert db.get_flair("alice") == (12, "i-12", None)
+    assert db.get_flair("bob") == (None, "i-mod", "Mod")
+    assert db.get_flair("carol") == (0, None, "https://heatware.com/u/1")
+    assert db.get_recent_post_ids(["alice"], 0) == {"p1"}
+    db.close()
+    assert user_version(db_path) == len(MIGRATIONS)
+
+
+def test_db_left_by_an_interrupted_migration_is_migrated(db_path):
+    # The trade_count column was added but the user_version not stored
+    version = MIGRATIONS.index(user_db._add_trade_count_column)
+    create_old_db(db_path, version, ["ALTER TABLE user ADD COLUMN trade_count INTEGER",
+                                     "INSERT INTO user (username, flair_css_class) VALUES ('alice', 'i-3')"])
+    db = UserDB(db_path)
+    assert db.get_flair("alice") == (3, "i-3", None)
+    db.close()
+    assert user_version(db_path) == len(MIGRATIONS)
+
+
+def crash(cursor):
+    raise sqlite3.OperationalError("disk I/O error")
+
+
+def test_migrations_before_a_failed_one_are_kept(db_path, monkeypatch):
+    version = MIGRATIONS.index(user_db._add_trade_count_column)
+    create_old_db(db_path, version)
+    monkeypatch.setattr(user_db, "MIGRATIONS", MIGRATIONS[:version + 1] + [crash])
+    with pytest.raises(sqlite3.OperationalError):
+        UserDB(db_path)
+    assert user_version(db_path) == version + 1
+    assert "trade_count" in user_columns(db_path)
+
+
+def test_failed_migration_is_rolled_back(db_path, monkeypatch):
+    version = MIGRATIONS.index(user_db._add_trade_count_column)
+    create_old_db(db_path, version)
+
+    def add_column_and_crash(cursor):
+        user_db._add_trade_count_column(cursor)
+        crash(cursor)
+    monkeypatch.setattr(user_db, "MIGRATIONS", MIGRATIONS[:version] + [add_column_and_crash])
+    with pytest.raises(sqlite3.OperationalError):
+        UserDB(db_path)
+    assert user_version(db_path) == version
+    assert "trade_count" not in user_columns(db_path)
+
+    monkeypatch.setattr(user_db, "MIGRATIONS", MIGRATIONS)
+    UserDB(db_path).close()
+    assert user_version(db_path) == len(MIGRATIONS)
@@ -0,0 +1,227 @@
+""" Tests of the Toolbox usernotes codec, the revision cache and the checks using usernotes """
+
+import base64
+import json
+import logging
+import zlib
+from contextlib import contextmanager
+
+import pytest
+
+import usernotes
+from common import Profile
+from flair import TradeFlairer
+from post_check import PostChecker
+from usernotes import Note, UsernoteCache
+from user_db import UserDB
+
+LOGGER = logging.getLogger("test")
+
+# Notes as written by Toolbox: moderators and warning types are indexes into the constants
+USERS = {
+    "Alice": {"ns": [{"n": "Scammed a buyer", "t": 1500000200, "m": 1, "l": "l,5abcde,dfg123h", "w": 0},
+                     {"n": "Late shipping", "t": 1500000100, "m": 0, "l": "", "w": None}]},
+    "bob": {"ns": [{"n": "Good trader", "t": 1400000000, "m": 0, "l": "m,8xyz12", "w": 2}]},
+}
+CONSTANTS = {"users": ["modone", "modtwo"], "warnings": ["ban", None, "gooduser"]}
+
+
+def toolbox_page(users=USERS, constants=CONSTANTS, ver=6):
+    blob = base64.b64encode(zlib.compress(json.dumps(users).encode("utf-8"))).decode("utf-8")
+    return json.dumps({"ver": ver, "constants": constants, "blob": blob})
+
+
+def test_toolbox_page_is_decoded():
+    index = usernotes.index_notes(usernotes.decode(toolbox_page()))
+    assert index["alice"] == [Note("Alice", "Scammed a buyer", "modtwo", "l,5abcde,dfg123h", "ban", 1500000200),
+                              Note("Alice", "Late shipping", "modone", "", "none", 1500000100)]
+    assert index["bob"] == [Note("bob", "Good trader", "modone", "m,8xyz12", "gooduser", 1400000000)]
+
+
+def test_encoded_page_decodes_to_the_same_notes():
+    notes = usernotes.decode(toolbox_page())
+    content = usernotes.encode(notes)
+    page = json.loads(content)
+    assert page["ver"] == 6
+    assert page["constants"] == CONSTANTS
+    # The blob is base64 of zlib compressed json, like Toolbox reads it
+    assert json.loads(zlib.decompress(base64.b64decode(page["blob"])).decode("utf-8")) == USERS
+    assert usernotes.decode(content) == notes
+
+
+def test_added_note_extends_the_constants():
+    notes = usernotes.decode(toolbox_page())
+    assert usernotes.add_note(notes, Note("bob", "Chargeback", "modthree", "", "permban", 1600000000))
+    assert notes["constants"] == {"users": ["modone", "modtwo", "modthree"],
+                                  "warnings": ["ban", None, "gooduser", "permban"]}
+    assert notes["users"]["bob"]["ns"][0] == {"n": "Chargeback", "t": 1600000000, "m": 2, "l": "", "w": 3}
+    # Indexes of the existing notes still point at the same constants
+    index = usernotes.index_notes(usernotes.decode(usernotes.encode(notes)))
+    assert index["alice"][0].moderator == "modtwo"
+    assert [note.warning for note in index["bob"]] == ["permban", "gooduser"]
+
+    assert not usernotes.add_note(notes, Note("bob", "Chargeback", "modthree", "", "permban", 1600000000))
+    assert len(notes["users"]["bob"]["ns"]) == 2
+
+
+def test_other_schema_is_refused():
+    with pytest.raises(ValueError):
+        usernotes.decode(toolbox_page(ver=5))
+
+
+def test_links_are_compressed():
+    assert usernotes.compress_link("https://www.reddit.com/r/swap/comments/5abcde/title/dfg123h/") == "l,5abcde,dfg123h"
+    assert usernotes.compress_link("https://old.reddit.com/r/swap/comments/5abcde/title/") == "l,5abcde"
+    assert usernotes.compress_link("https://www.reddit.com/message/messages/8xyz12") == "m,8xyz12"
+    assert usernotes.compress_link("l,5abcde") == "l,5abcde"
+    assert usernotes.compress_link("https://example.com/comments/5abcde") == ""
+
+
+class WikiPage(object):
+
+    def __init__(self, wiki):
+        self._wiki = wiki
+
+    def revisions(self, limit=None):
+        yield {"id": self._wiki.revision_id}
+
+    @property
+    def revision_id(self):
+        return self._wiki.revision_id
+
+    @property
+    def content_md(self):
+        self._wiki.downloads += 1
+        return self._wiki.content
+
+
+class Wiki(object):
+
+    def __init__(self, content):
+        self.content = content
+        self.revision_id = "rev1"
+        self.downloads = 0
+
+    def __getitem__(self, name):
+        assert name == usernotes.PAGE_NAME
+        return WikiPage(self)
+
+
+class Subreddit(object):
+
+    def __init__(self, content):
+        self.wiki = Wiki(content)
+
+
+def test_page_is_only_downloaded_for_a_new_revision(tmp_path):
+    subreddit = Subreddit(toolbox_page())
+    user_db = UserDB(str(tmp_path / "user.db"))
+    cache = UsernoteCache(lambda: subreddit, LOGGER, check_interval=0, user_db=user_db)
+    assert cache.get("ALICE")[0].note == "Scammed a buyer"
+    assert cache.get("bob")[0].note == "Good trader"
+    assert subreddit.wiki.downloads == 1
+
+    subreddit.wiki.content = toolbox_page(users={"carol": {"ns": [{"n": "New", "t": 1, "m": 0, "l": "", "w": 0}]}})
+    subreddit.wiki.revision_id = "rev2"
+    assert cache.get("alice") == []
+    assert cache.get("carol")[0].note == "New"
+    assert subreddit.wiki.downloads == 2
+
+    # The page is kept in the user db for the next run
+    restarted = UsernoteCache(lambda: subreddit, LOGGER, check_interval=0, user_db=user_db)
+    assert restarted.get("carol")[0].note == "New"
+    assert subreddit.wiki.downloads == 2
+
+
+class UsernoteSubreddit(object):
+    """ SubRedditMod with usernotes and profiles """
+
+    def __init__(self, notes, config):
+        self.config = config
+        self._notes = notes
+
+    def get_usernotes(self, username):
+        return [note for note in self._notes if note.username.lower() == str(username).lower()]
+
+    def get_profile(self, user):
+        return Profile(str(user), 1000, 1000, 0, False)
+
+    def get_user_flair(self, item):
+        return "i-3", None
+
+    def get_user_trade_count(self, item):
+        return 3
+
+    def get_rules_link(self):
+        return "[RULES](/r/swap/rules)"
+
+    def get_wiki_link(self):
+        return "[WIKI](/r/swap/wiki)"
+
+    @contextmanager
+    def priority(self, priority):
+        yield
+
+
+class Author(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class Item(object):
+    """ Trade comment or submission """
+
+    def __init__(self, author):
+        self.author = Author(author)
+        self.banned_by = None
+        self.reports = []
+        self.replies_sent = []
+
+    def report(self, reason):
+        self.reports.append(reason)
+
+    def reply(self, body):
+        self.replies_sent.append(body)
+        return self
+
+    @property
+    def mod(self):
+        return self
+
+    def distinguish(self):
+        pass
+
+
+NOTES = [Note("alice", "Scammed a buyer", "modone", "", "ban", 1500000000),
+         Note("bob", "Good trader", "modone", "", "gooduser", 1400000000)]
+
+TRADE_CONFIG = {"flair_check": 5, "age_check": 0, "karma_check": 0}
+
+
+def test_trade_by_user_with_warning_note_is_reported():
+    subreddit = UsernoteSubreddit(NOTES, {"trade": dict(TRADE_CONFIG, usernote_warnings="ban, permban")})
+    flairer = TradeFlairer(subreddit, LOGGER, None)
+    parent, reply = Item("bob"), Item("alice")
+    assert not flairer.check_requirements(parent, reply)
+    assert reply.reports == ["Flair: Usernote (ban): Scammed a buyer"]
+    assert parent.reports == []
+
+
+def test_usernotes_are_not_looked_up_by_default():
+    subreddit = UsernoteSubreddit(NOTES, {"trade": dict(TRADE_CONFIG, usernote_warnings="")})
+    subreddit.get_usernotes = None
+    assert TradeFlairer(subreddit, LOGGER, None).check_requirements(Item("bob"), Item("alice"))
+
+
+def test_user_info_comment_lists_configured_notes():
+    subreddit = UsernoteSubreddit(NOTES, {"post_check": {"usernote_warnings": "gooduser"}})
+    checker = PostChecker(subreddit, None, None)
+    for username, listed in (("bob", True), ("alice", False)):
+        post = Item(username)
+        checker.post_comment(post)
+        assert ("* Mod note (2014-05-13): Good trader\n" in post.replies_sent[0]) == listed
+        assert "Scammed" not in post.replies_sent[0]
@@ -0,0 +1,457 @@
+""" User database (user.db) access """
+
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+def parse_trade_count(css_class):
+    """ Get trade count from a flair css class (i-<count>), None for special classes like i-mod """
+    if not css_class:
+        return 0
+    try:
+        return int(css_class.lstrip("i-"))
+    except ValueError:
+        return None
+
+
+def _create_user_table(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS user ('
+                   'username TEXT PRIMARY KEY NOT NULL, '
+                   'flair_text TEXT, '
+                   'flair_css_class TEXT)')
+
+
+def _add_last_post_columns(cursor):
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(user)')}
+    for prefix in ("personal", "nonpersonal"):
+        if prefix + "_last_created" not in columns:
+            cursor.execute('ALTER TABLE user ADD COLUMN {}_last_created REAL'.format(prefix))
+        if prefix + "_last_id" not in columns:
+            cursor.execute("ALTER TABLE user ADD COLUMN {}_last_id TEXT DEFAULT ''".format(prefix))
+    if "last_created" in columns and "last_id" in columns:
+        # Databases created by older versions of the flair import only tracked personal posts
+        cursor.execute('UPDATE user SET personal_last_created=last_created, personal_last_id=last_id '
+                       'WHERE personal_last_created IS NULL AND last_created IS NOT NULL')
+
+
+def _create_processed_table(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS processed ('
+                   'id TEXT PRIMARY KEY NOT NULL, '
+                   'processed_utc REAL NOT NULL)')
+
+
+def _create_trade_confirmation_table(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS trade_confirmation ('
+                   'thread_id TEXT NOT NULL, '
+                   'comment_id TEXT NOT NULL, '
+                   "state TEXT NOT NULL CHECK (state IN ('completed', 'pending')), "
+                   'updated_utc REAL, '
+                   'PRIMARY KEY (thread_id, comment_id)) WITHOUT ROWID')
+
+
+def _create_thread_scan_table(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS thread_scan ('
+                   'thread_id TEXT PRIMARY KEY NOT NULL, '
+                   'last_scan_utc REAL NOT NULL, '
+                   'last_full_scan_utc REAL NOT NULL)')
+
+
+def _add_trade_count_column(cursor):
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(user)')}
+    if "trade_count" not in columns:
+        cursor.execute('ALTER TABLE user ADD COLUMN trade_count INTEGER')
+    cursor.execute("UPDATE user SET trade_count=CAST(substr(flair_css_class, 3) AS INTEGER) "
+                   "WHERE flair_css_class GLOB 'i-[0-9]*' AND flair_css_class NOT GLOB 'i-*[^0-9]*'")
+    cursor.execute("UPDATE user SET trade_count=0 WHERE flair_css_class='' OR "
+                   "(flair_css_class IS NULL AND flair_text IS NOT NULL)")
+
+
+def _create_meta_table(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS meta ('
+                   'key TEXT PRIMARY KEY NOT NULL, '
+                   'value)')
+
+
+def _create_flair_journal_table(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS flair_journal ('
+                   'username TEXT PRIMARY KEY NOT NULL, '
+                   'flair_text TEXT, '
+                   'flair_css_class TEXT, '
+                   'queued_utc REAL NOT NULL)')
+
+
+def _create_profile_table(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS profile ('
+                   'username TEXT PRIMARY KEY NOT NULL COLLATE NOCASE, '
+                   'link_karma INTEGER, '
+                   'comment_karma INTEGER, '
+                   'created_utc REAL, '
+                   'suspended INTEGER NOT NULL, '
+                   'fetched_utc REAL NOT NULL)')
+
+
+def _create_handled_comment_table(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS handled_comment ('
+                   'thread_id TEXT NOT NULL, '
+                   'comment_id TEXT NOT NULL, '
+                   'handled_utc REAL NOT NULL, '
+                   'PRIMARY KEY (thread_id, comment_id)) WITHOUT ROWID')
+
+
+def _create_heatware_claim_table(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS heatware_claim ('
+                   'heatware_id TEXT PRIMARY KEY NOT NULL, '
+                   'username TEXT NOT NULL COLLATE NOCASE, '
+                   'comment_id TEXT, '
+                   'claimed_utc REAL NOT NULL)')
+
+
+def _add_flair_journal_attempts_column(cursor):
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(flair_journal)')}
+    if "attempts" not in columns:
+        cursor.execute('ALTER TABLE flair_journal ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+
+
+def _create_edit_request_table(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS edit_request ('
+                   'thread_id TEXT NOT NULL, '
+                   'comment_id TEXT NOT NULL, '
+                   'root_id TEXT NOT NULL, '
+                   'requested_utc REAL NOT NULL, '
+                   'PRIMARY KEY (thread_id, comment_id)) WITHOUT ROWID')
+
+
+# Schema migrations, the index + 1 of the last applied migration is stored as the db user_version
+MIGRATIONS = [
+    _create_user_table,
+    _add_last_post_columns,
+    _create_processed_table,
+    _create_trade_confirmation_table,
+    _create_thread_scan_table,
+    _add_trade_count_column,
+    _create_meta_table,
+    _create_flair_journal_table,
+    _create_profile_table,
+    _create_handled_comment_table,
+    _create_heatware_claim_table,
+    _add_flair_journal_attempts_column,
+    _create_edit_request_table,
+]
+
+POST_PREFIXES = ("personal", "nonpersonal")
+
+
+class UserDB(object):
+    """
+    Repository for the user db
+
+    Owns the schema, runs in WAL mode so other scripts can read while the bot writes,
+    and groups writes into fewer commits (see flush).
+    """
+
+    def __init__(self, path, commit_every=50, commit_interval=5.0):
+        self._con = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._con.row_factory = sqlite3.Row
+        self._lock = threading.RLock()
+        self._commit_every = commit_every
+        self._commit_interval = commit_interval
+        self._pending_writes = 0
+        self._last_commit = time.time()
+        self._transaction_depth = 0
+        if path != ":memory:":
+            self._con.execute('PRAGMA journal_mode=WAL')
+        self._con.execute('PRAGMA synchronous=NORMAL')
+        self.migrate()
+
+    def migrate(self):
+        """
+        Bring schema up to date
+
+        Each migration is committed together with its user_version, so a migration interrupted by a crash
+        is rolled back and runs again on the next start. sqlite3 would otherwise commit DDL right away.
+        """
+        with self._lock:
+            version = self._con.execute('PRAGMA user_version').fetchone()[0]
+            for number in range(version + 1, len(MIGRATIONS) + 1):
+                cursor = self._con.cursor()
+                cursor.execute('BEGIN IMMEDIATE')
+                try:
+                    # Another script may have migrated the db while waiting for the lock
+                    if cursor.execute('PRAGMA user_version').fetchone()[0] < number:
+                        MIGRATIONS[number - 1](cursor)
+                        cursor.execute('PRAGMA user_version={:d}'.format(number))
+                except BaseException:
+                    self._con.rollback()
+                    raise
+                self._con.commit()
+
+    def _write(self, sql, params=(), many=False, commit=False):
+        with self._lock:
+            if many:
+                self._con.executemany(sql, params)
+            else:
+                self._con.execute(sql, params)
+            self._pending_writes += 1
+            if self._transaction_depth:
+                return
+            if (commit or self._pending_writes >= self._commit_every or
+                    time.time() - self._last_commit >= self._commit_interval):
+                self.flush()
+
+    @contextmanager
+    def transaction(self):
+        """ Commit all writes in the block together, or none of them if the block raises """
+        with self._lock:
+            if self._transaction_depth == 0:
+                self.flush()
+            self._transaction_depth += 1
+            try:
+                yield
+            except BaseException:
+                self._transaction_depth -= 1
+                if self._transaction_depth == 0:
+                    self._con.rollback()
+                    self._pending_writes = 0
+                raise
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self.flush()
+
+    def flush(self):
+        """ Commit pending writes """
+        with self._lock:
+            self._con.commit()
+            self._pending_writes = 0
+            self._last_commit = time.time()
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._con.close()
+
+    def get_user(self, username):
+        """ Get user row, None if the user is unknown """
+        with self._lock:
+            return self._con.execute('SELECT * FROM user WHERE username=?', (username,)).fetchone()
+
+    def set_last_post(self, username, prefix, post_id, created_utc):
+        """ Store the last post of a user in the category prefix (personal or nonpersonal) """
+        assert prefix in POST_PREFIXES
+        self._write('INSERT INTO user (username, {0}_last_created, {0}_last_id) VALUES (?, ?, ?) '
+                    'ON CONFLICT(username) DO UPDATE SET '
+                    '{0}_last_created=excluded.{0}_last_created, {0}_last_id=excluded.{0}_last_id'
+                    .format(prefix), (username, created_utc, post_id))
+
+    def import_flairs(self, flairs):
+        """ Insert or update flairs from an iterable of dicts with user, flair_text and flair_css_class """
+        self._write('INSERT INTO user (username, flair_text, flair_css_class, trade_count) '
+                    'VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT(username) DO UPDATE SET '
+                    'flair_text=excluded.flair_text, flair_css_class=excluded.flair_css_class, '
+                    'trade_count=excluded.trade_count',
+                    ((flair["user"], flair["flair_text"], flair["flair_css_class"],
+                      parse_trade_count(flair["flair_css_class"])) for flair in flairs), many=True)
+        self.flush()
+
+    def get_flair(self, username):
+        """ Get (trade_count, flair_css_class, flair_text) of user, None if the user is unknown """
+        with self._lock:
+            row = self._con.execute('SELECT trade_count, flair_css_class, flair_text FROM user '
+                                    'WHERE username=? AND (flair_css_class IS NOT NULL OR flair_text IS NOT NULL '
+                                    'OR trade_count IS NOT NULL)', (username,)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def set_flair(self, username, css_class, text):
+        """ Store flair of user as set on the subreddit """
+        self._write('INSERT INTO user (username, flair_text, flair_css_class, trade_count) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT(username) DO UPDATE SET '
+                    'flair_text=excluded.flair_text, flair_css_class=excluded.flair_css_class, '
+                    'trade_count=excluded.trade_count',
+                    (username, text, css_class, parse_trade_count(css_class)), commit=True)
+
+    def get_flair_texts(self):
+        """ Get (username, flair_text) of all users with flair text """
+        with self._lock:
+            return [tuple(row) for row in self._con.execute(
+                "SELECT username, flair_text FROM user WHERE flair_text IS NOT NULL AND flair_text != ''")]
+
+    def get_top_traders(self, limit=10):
+        """ Get (username, trade_count) of the users with most trades """
+        with self._lock:
+            return [tuple(row) for row in self._con.execute(
+                'SELECT username, trade_count FROM user WHERE trade_count IS NOT NULL '
+                'ORDER BY trade_count DESC LIMIT ?', (limit,))]
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._con.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def set_meta(self, key, value):
+        self._write('INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value',
+                    (key, value), commit=True)
+
+    def get_processed(self):
+        """ Get (id, processed_utc) of all processed posts, oldest first """
+        with self._lock:
+            return self._con.execute('SELECT id, processed_utc FROM processed ORDER BY processed_utc').fetchall()
+
+    def add_processed(self, post_id, processed_utc):
+        self._write('INSERT INTO processed (id, processed_utc) VALUES (?, ?) '
+                    'ON CONFLICT(id) DO UPDATE SET processed_utc=excluded.processed_utc',
+                    (post_id, processed_utc))
+
+    def remove_processed(self, post_ids):
+        self._write('DELETE FROM processed WHERE id=?', [(post_id,) for post_id in post_ids], many=True)
+
+    def get_trade_states(self, thread_id):
+        """ Get dict of comment id to state (completed or pending) of trade confirmations in a thread """
+        with self._lock:
+            return dict(self._con.execute('SELECT comment_id, state FROM trade_confirmation WHERE thread_id=?',
+                                          (thread_id,)))
+
+    def set_trade_state(self, thread_id, comment_id, state):
+        """ Set state of a trade confirmation, committed immediately so a trade is never flaired twice """
+        self._write('INSERT INTO trade_confirmation (thread_id, comment_id, state, updated_utc) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT(thread_id, comment_id) DO UPDATE SET '
+                    'state=excluded.state, updated_utc=excluded.updated_utc',
+                    (thread_id, comment_id, state, time.time()), commit=True)
+
+    def remove_trade_state(self, thread_id, comment_id, state):
+        """ Remove trade confirmation if it is in state """
+        self._write('DELETE FROM trade_confirmation WHERE thread_id=? AND comment_id=? AND state=?',
+                    (thread_id, comment_id, state), commit=True)
+
+    def add_edit_request(self, thread_id, comment_id, root_id):
+        """ Store that the bot asked for comment to be edited, root_id is the top level comment to check again """
+        self._write('INSERT OR IGNORE INTO edit_request (thread_id, comment_id, root_id, requested_utc) '
+                    'VALUES (?, ?, ?, ?)', (thread_id, comment_id, root_id, time.time()), commit=True)
+
+    def get_edit_requests(self, thread_id):
+        """ Get dict of comment id to root comment id of the comments the bot asked to be edited in a thread """
+        with self._lock:
+            return dict(self._con.execute('SELECT comment_id, root_id FROM edit_request WHERE thread_id=?',
+                                          (thread_id,)))
+
+    def remove_edit_requests(self, thread_id, root_id):
+        """ Remove the edit requests of the comments below a top level comment """
+        self._write('DELETE FROM edit_request WHERE thread_id=? AND root_id=?', (thread_id, root_id))
+
+    def import_trade_states(self, thread_id, completed, pending):
+        """ Import trade confirmations in one transaction, completed ones take precedence """
+        now = time.time()
+        with self._lock:
+            with self._con:
+                self._con.executemany('INSERT OR IGNORE INTO trade_confirmation '
+                                      '(thread_id, comment_id, state, updated_utc) VALUES (?, ?, ?, ?)',
+                                      [(thread_id, comment_id, "completed", now) for comment_id in completed] +
+                                      [(thread_id, comment_id, "pending", now) for comment_id in pending])
+
+    def get_thread_scan(self, thread_id):
+        """ Get (last_scan_utc, last_full_scan_utc) of a thread, None if it has never been scanned """
+        with self._lock:
+            row = self._con.execute('SELECT last_scan_utc, last_full_scan_utc FROM thread_scan WHERE thread_id=?',
+                                    (thread_id,)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def set_thread_scan(self, thread_id, last_scan_utc, last_full_scan_utc):
+        self._write('INSERT INTO thread_scan (thread_id, last_scan_utc, last_full_scan_utc) VALUES (?, ?, ?) '
+                    'ON CONFLICT(thread_id) DO UPDATE SET '
+                    'last_scan_utc=excluded.last_scan_utc, last_full_scan_utc=excluded.last_full_scan_utc',
+                    (thread_id, last_scan_utc, last_full_scan_utc), commit=True)
+
+    def get_handled_comments(self, thread_id):
+        """ Get set of ids of the comments in a thread that have been handled """
+        with self._lock:
+            return {row[0] for row in self._con.execute('SELECT comment_id FROM handled_comment WHERE thread_id=?',
+                                                        (thread_id,))}
+
+    def add_handled_comment(self, thread_id, comment_id):
+        self._write('INSERT OR IGNORE INTO handled_comment (thread_id, comment_id, handled_utc) VALUES (?, ?, ?)',
+                    (thread_id, comment_id, time.time()))
+
+    def get_heatware_claim(self, heatware_id):
+        """ Get name of the user that claimed a heatware profile, None if it is unclaimed """
+        with self._lock:
+            row = self._con.execute('SELECT username FROM heatware_claim WHERE heatware_id=?',
+                                    (heatware_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_heatware_claim(self, heatware_id, username, comment_id):
+        self._write('INSERT INTO heatware_claim (heatware_id, username, comment_id, claimed_utc) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT(heatware_id) DO UPDATE SET username=excluded.username, '
+                    'comment_id=excluded.comment_id, claimed_utc=excluded.claimed_utc',
+                    (heatware_id, username, comment_id, time.time()))
+
+    def import_heatware_claims(self, claims):
+        """ Import (heatware_id, username) claims in one transaction, existing claims are kept """
+        now = time.time()
+        with self._lock:
+            with self._con:
+                self._con.executemany('INSERT OR IGNORE INTO heatware_claim (heatware_id, username, claimed_utc) '
+                                      'VALUES (?, ?, ?)', [(heatware_id, username, now)
+                                                           for heatware_id, username in claims])
+
+    def queue_flair(self, username, css_class, text):
+        """ Store flair of user and add it to the journal of flair changes to send to the subreddit """
+        with self.transaction():
+            self.set_flair(username, css_class, text)
+            self._write('INSERT INTO flair_journal (username, flair_text, flair_css_class, queued_utc) '
+                        'VALUES (?, ?, ?, ?) '
+                        'ON CONFLICT(username) DO UPDATE SET flair_text=excluded.flair_text, '
+                        'flair_css_class=excluded.flair_css_class, queued_utc=excluded.queued_utc, attempts=0',
+                        (username, text, css_class, time.time()))
+
+    def is_flair_queued(self, username):
+        """ Check if a flair change of user is waiting in the journal to be sent to the subreddit """
+        with self._lock:
+            return self._con.execute('SELECT 1 FROM flair_journal WHERE username=?', (username,)).fetchone() is not None
+
+    def get_flair_journal(self):
+        """ Get (username, flair_css_class, flair_text, queued_utc, attempts) of flair changes not yet sent """
+        with self._lock:
+            return [tuple(row) for row in self._con.execute(
+                'SELECT username, flair_css_class, flair_text, queued_utc, attempts FROM flair_journal '
+                'ORDER BY queued_utc')]
+
+    def remove_flair_journal(self, entries):
+        """ Remove sent (username, queued_utc) entries, unless the flair has been changed again since """
+        self._write('DELETE FROM flair_journal WHERE username=? AND queued_utc=?', entries, many=True, commit=True)
+
+    def add_flair_journal_attempt(self, entries):
+        """ Count a failed attempt to send (username, queued_utc) entries, unless the flair has been changed since """
+        self._write('UPDATE flair_journal SET attempts=attempts+1 WHERE username=? AND queued_utc=?', entries,
+                    many=True, commit=True)
+
+    def get_profile(self, username):
+        """ Get (username, link_karma, comment_karma, created_utc, suspended, fetched_utc), None if unknown """
+        with self._lock:
+            row = self._con.execute('SELECT username, link_karma, comment_karma, created_utc, suspended, fetched_utc '
+                                    'FROM profile WHERE username=?', (username,)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def set_profile(self, username, link_karma, comment_karma, created_utc, suspended, fetched_utc):
+        self._write('INSERT INTO profile (username, link_karma, comment_karma, created_utc, suspended, fetched_utc) '
+                    'VALUES (?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT(username) DO UPDATE SET link_karma=excluded.link_karma, '
+                    'comment_karma=excluded.comment_karma, created_utc=excluded.created_utc, '
+                    'suspended=excluded.suspended, fetched_utc=excluded.fetched_utc',
+                    (username, link_karma, comment_karma, created_utc, int(suspended), fetched_utc))
+
+    def get_recent_post_ids(self, usernames, since_utc):
+        """ Get ids of the last posts of usernames made after since_utc """
+        usernames = list(usernames)
+        post_ids = set()
+        with self._lock:
+            for start in range(0, len(usernames), 500):
+                chunk = usernames[start:start + 500]
+                placeholders = ", ".join("?" for _ in chunk)
+                for prefix in POST_PREFIXES:
+                    post_ids.update(row[0] for row in self._con.execute(
+                        'SELECT {0}_last_id FROM user WHERE username IN ({1}) AND {0}_last_created > ?'
+                        .format(prefix, placeholders), chunk + [since_utc]))
+        post_ids.discard("")
+        post_ids.discard(None)
+        return post_ids
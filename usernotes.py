@@ -0,0 +1,279 @@
+""" Usernotes (Toolbox format) stored on the usernotes wiki page of the subreddit """
+
+import re
+import json
+import time
+import zlib
+import base64
+import threading
+from collections import namedtuple
+
+import metrics
+
+
+# Toolbox usernotes schema version that is read and written
+SCHEMA = 6
+# Max size of a wiki page in characters
+MAX_PAGE_SIZE = 524288
+PAGE_NAME = "usernotes"
+WARNINGS = ["none", "spamwatch", "spamwarn", "abusewarn", "ban", "permban", "botban", "gooduser"]
+
+Note = namedtuple("Note", ["username", "note", "moderator", "link", "warning", "time"])
+
+_FULL_LINK = re.compile(r"^https?://(\w{1,3}\.)?reddit.com/")
+_SHORT_LINK = re.compile(r"^[ml],[A-Za-z\d]{2,}(,[A-Za-z\d]+)?$")
+_COMMENT_LINK = re.compile(r"/comments/([A-Za-z\d]{2,})(?:/[^\s]+/([A-Za-z\d]+))?")
+_MESSAGE_LINK = re.compile(r"/message/messages/([A-Za-z\d]+)")
+
+
+def warning_types(value):
+    """ Get the set of warning types in a comma separated config value """
+    return {warning.strip().lower() for warning in (value or "").split(",") if warning.strip()}
+
+
+def compress_link(link):
+    """ Get the short form of a link to a submission, comment or message used in usernotes, '' if unknown """
+    if _SHORT_LINK.match(link):
+        return link
+    if not _FULL_LINK.match(link):
+        return ""
+    match = _COMMENT_LINK.search(link)
+    if match:
+        return "l," + ",".join(part for part in match.groups() if part)
+    match = _MESSAGE_LINK.search(link)
+    if match:
+        return "m," + match.group(1)
+    return ""
+
+
+def decode(content):
+    """ Decode the content of the usernotes page, returns the page with the users blob expanded """
+    page = json.loads(content)
+    if page.get("ver") != SCHEMA:
+        raise ValueError("Usernotes schema is v{}, v{} is supported".format(page.get("ver"), SCHEMA))
+    users = json.loads(zlib.decompress(base64.b64decode(page["blob"])).decode("utf-8"))
+    return {"ver": SCHEMA, "constants": page["constants"], "users": users}
+
+
+def encode(notes):
+    """ Encode notes (as returned by decode) as the content of the usernotes page """
+    blob = zlib.compress(json.dumps(notes["users"], separators=(",", ":")).encode("utf-8"), 9)
+    content = json.dumps({"ver": SCHEMA, "constants": notes["constants"],
+                          "blob": base64.b64encode(blob).decode("utf-8")}, separators=(",", ":"))
+    if len(content) > MAX_PAGE_SIZE:
+        raise OverflowError("Usernotes page is too large ({} characters)".format(len(content)))
+    return content
+
+
+def empty_notes():
+    return {"ver": SCHEMA, "constants": {"users": [], "warnings": list(WARNINGS)}, "users": {}}
+
+
+def _constant_index(constants, value):
+    if value not in constants:
+        constants.append(value)
+    return constants.index(value)
+
+
+def _constant(values, index):
+    return values[index] if isinstance(index, int) and 0 <= index < len(values) else None
+
+
+def index_notes(notes):
+    """ Get the notes (as returned by decode) as lists of Note by lowercase username, newest first """
+    constants = notes["constants"]
+    index = {}
+    for username, user in notes["users"].items():
+        index.setdefault(username.lower(), []).extend(
+            Note(username, entry.get("n", ""), _constant(constants["users"], entry.get("m")), entry.get("l") or "",
+                 _constant(constants["warnings"], entry.get("w")) or "none", entry.get("t") or 0)
+            for entry in user["ns"])
+    for user_notes in index.values():
+        user_notes.sort(key=lambda note: note.time, reverse=True)
+    return index
+
+
+def add_note(notes, note):
+    """ Add note to notes, returns False if it was already there """
+    constants = notes["constants"]
+    entry = {"n": note.note, "t": note.time, "m": _constant_index(constants["users"], note.moderator),
+             "l": note.link, "w": _constant_index(constants["warnings"], note.warning)}
+    user_notes = notes["users"].setdefault(note.username, {"ns": []})["ns"]
+    # A write that failed without an answer may have been saved after all
+    if entry in user_notes:
+        return False
+    # Newest first
+    user_notes.insert(0, entry)
+    return True
+
+
+class UsernoteCache(object):
+    """
+    Decoded usernotes page with an index by username
+
+    The latest revision of the page is checked at most every check_interval seconds, the page is only
+    downloaded again when it changed. The page is kept in the user db (when given) so scripts run from
+    cron only download it when it was edited since their last run.
+    """
+
+    def __init__(self, get_subreddit, logger, check_interval=60, user_db=None):
+        self._get_subreddit = get_subreddit
+        self._logger = logger
+        self._check_interval = check_interval
+        self._user_db = user_db
+        self._revision_id = None
+        self._content = None
+        self._index = {}
+        self._checked = None
+        self._lock = threading.Lock()
+        self.downloads = 0
+
+    def _load(self, revision_id, content):
+        self._index = index_notes(decode(content) if content else empty_notes())
+        self._revision_id = revision_id
+        self._content = content
+
+    def _latest_revision(self):
+        """ Get id of the latest revision of the page, None if there is no page """
+        import prawcore
+        try:
+            for revision in self._get_subreddit().wiki[PAGE_NAME].revisions(limit=1):
+                return revision["id"]
+        except prawcore.exceptions.NotFound:
+            pass
+        return None
+
+    def _refresh(self, force):
+        now = time.time()
+        if self._checked is None and self._user_db is not None:
+            revision_id = self._user_db.get_meta("usernotes_revision")
+            if revision_id is not None:
+                self._load(revision_id, self._user_db.get_meta("usernotes_content"))
+        if not force and self._checked is not None and now - self._checked < self._check_interval:
+            return
+        revision_id = self._latest_revision()
+        if revision_id is not None and revision_id != self._revision_id:
+            page = self._get_subreddit().wiki[PAGE_NAME]
+            self._load(page.revision_id, page.content_md)
+            self.downloads += 1
+            self._logger.debug("Downloaded usernotes revision {}".format(self._revision_id))
+            if self._user_db is not None:
+                with self._user_db.transaction():
+                    self._user_db.set_meta("usernotes_revision", self._revision_id)
+                    self._user_db.set_meta("usernotes_content", self._content)
+        elif revision_id is None:
+            self._load(None, None)
+        self._checked = now
+
+    def invalidate(self):
+        """ Check the revision on the next lookup, after the page was edited """
+        with self._lock:
+            if self._checked is not None:
+                self._checked = 0
+
+    def get(self, username):
+        """ Get notes on username, newest first, notes of an older revision are used if reddit can't be reached """
+        with self._lock:
+            try:
+                self._refresh(False)
+            except Exception as exception:
+                self._logger.warning("Could not check usernotes revision: {}".format(exception))
+            return list(self._index.get(username.lower(), ()))
+
+    def current(self):
+        """ Get (revision id, notes) of the latest revision of the page, revision id is None if there is no page """
+        with self._lock:
+            self._refresh(True)
+            return self._revision_id, decode(self._content) if self._content else empty_notes()
+
+
+class UsernoteWriter(object):
+    """
+    Buffer of usernotes, written to the usernotes wiki page together as one revision
+
+    The page is edited based on the revision the notes were added to. If the page was edited in
+    the meantime reddit refuses the edit, then the notes are added to the new revision and the
+    edit is retried, so notes written by others are never overwritten.
+    """
+
+    def __init__(self, get_subreddit, logger, cache=None, max_retries=5):
+        self._get_subreddit = get_subreddit
+        self._logger = logger
+        self._cache = cache
+        self._max_retries = max_retries
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, username, text, moderator, link="", warning="none"):
+        """ Queue a note on username, written by the next flush """
+        note = Note(username, text, moderator, compress_link(link or ""),
+                    warning if warning in WARNINGS else "none", int(time.time()))
+        with self._lock:
+            self._pending.append(note)
+
+    def pending(self, username):
+        """ Get queued notes on username, newest first """
+        with self._lock:
+            return [note for note in reversed(self._pending) if note.username.lower() == username.lower()]
+
+    def _read(self):
+        """ Get (revision id, notes) of the usernotes page, revision id is None if there is no page yet """
+        if self._cache is not None:
+            return self._cache.current()
+        import prawcore
+        page = self._get_subreddit().wiki[PAGE_NAME]
+        try:
+            return page.revision_id, decode(page.content_md)
+        except prawcore.exceptions.NotFound:
+            return None, empty_notes()
+
+    def _write(self, revision_id, notes, reason):
+        subreddit = self._get_subreddit()
+        if revision_id is None:
+            subreddit.wiki.create(PAGE_NAME, encode(notes), reason)
+            # Only visible to mods, like pages created by Toolbox
+            subreddit.wiki[PAGE_NAME].mod.update(False, permlevel=2)
+        else:
+            subreddit.wiki[PAGE_NAME].edit(encode(notes), reason, previous=revision_id)
+
+    @staticmethod
+    def _reason(notes):
+        usernames = sorted({note.username for note in notes})
+        if len(notes) == 1:
+            return "create new note on user {}".format(usernames[0])
+        return "create {} new notes on users {}".format(len(notes), ", ".join(usernames))
+
+    @metrics.staged("usernotes_flush")
+    def flush(self):
+        """ Write all queued notes as one revision of the usernotes page, notes are kept queued if it fails """
+        import prawcore
+        with self._flush_lock:
+            with self._lock:
+                pending = list(self._pending)
+            if not pending:
+                return
+            for _ in range(self._max_retries):
+                revision_id, notes = self._read()
+                for note in pending:
+                    add_note(notes, note)
+                try:
+                    self._write(revision_id, notes, self._reason(pending))
+                except prawcore.exceptions.Conflict:
+                    metrics.ITEMS.inc(kind="usernotes_write", result="conflict")
+                    self._logger.warning("Usernotes page was edited while writing {} notes, retrying"
+                                         .format(len(pending)))
+                    continue
+                if self._cache is not None:
+                    self._cache.invalidate()
+                with self._lock:
+                    # Notes queued while writing stay queued
+                    del self._pending[:len(pending)]
+                metrics.ITEMS.inc(kind="usernotes_write", result="written")
+                self._logger.info("Wrote {} usernotes".format(len(pending)))
+                return
+            self._logger.error("Could not write {} usernotes after {} attempts, keeping them queued"
+                               .format(len(pending), self._max_retries))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+""" Microbenchmark of submission title classification """
+
+import os
+import re
+import sys
+import json
+import random
+import argparse
+from time import perf_counter
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from common import DictConfigParser  # noqa: E402
+from classifier import TitleClassifier, PERSONAL, NONPERSONAL  # noqa: E402
+
+
+def legacy_classify(config, post_categories, locations, title):
+    """ Classification as done by PostChecker before the precompiled classifier """
+    if re.search(config["trade_post_format"], title):
+        if "trade_post_format_strict" in config:
+            if not re.match(config["trade_post_format_strict"], title):
+                return ("invalid", "title", False)
+        location, have, want = re.search(config["trade_post_format"], title).groups()
+        if "-" in location:
+            primary, secondary = location.split("-", 1)
+        else:
+            primary = "OTHER"
+            secondary = location
+        if primary not in locations or secondary not in locations[primary]:
+            return ("invalid", "location", False)
+        timestamp_check = False
+        post_category = config["default_category"]
+        for category, category_prop in post_categories["personal"].items():
+            if "want" in category_prop:
+                if re.search(category_prop["want"].replace("\\\\", "\\"), want, re.IGNORECASE):
+                    post_category = category
+                    timestamp_check = category_prop["timestamp_check"]
+            if "have" in category_prop:
+                if re.search(category_prop["have"].replace("\\\\", "\\"), have, re.IGNORECASE):
+                    post_category = category
+                    timestamp_check = category_prop["timestamp_check"]
+        return (PERSONAL, post_category, timestamp_check)
+    if re.search(config["informational_post_format"], title):
+        tag = re.search(config["informational_post_format"], title).group(1)
+        for category, category_prop in post_categories["nonpersonal"].items():
+            if tag == category_prop["tag"]:
+                return (NONPERSONAL, category, False)
+        return ("invalid", "tag", False)
+    return ("invalid", "title", False)
+
+
+def generate_titles(count, post_categories, locations, seed=0):
+    """ Generate a corpus of plausible titles, valid and invalid """
+    rng = random.Random(seed)
+    location_tags = ["{}-{}".format(primary, secondary)
+                     for primary, secondaries in locations.items() for secondary in secondaries]
+    location_tags += ["XX-YY", "USA", "EU-XX"]
+    tags = [prop["tag"] for prop in post_categories["nonpersonal"].values()] + ["WTS", "Question"]
+    items = ["GMK Olivia", "Leopold FC660M", "Zealios 67g", "HHKB Pro 2", "SA Carbon", "Tofu 65",
+             "Holy Pandas", "DSA Granite", "Novatouch", "Model M"]
+    wants = ["PayPal", "Cash", "$120", "Trade", "Google Wallet", "Local cash", "offers"]
+    titles = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.75:
+            have = ", ".join(rng.sample(items, rng.randint(1, 3)))
+            want = rng.choice(wants + [rng.choice(items)])
+            if rng.random() < 0.2:
+                have, want = want, have
+            titles.append("[{}] [H] {} [W] {}".format(rng.choice(location_tags), have, want))
+        elif kind < 0.95:
+            titles.append("[{}] {}".format(rng.choice(tags), rng.choice(items)))
+        else:
+            titles.append("Selling my {} cheap".format(rng.choice(items)))
+    return titles
+
+
+def load_config():
+    config = DictConfigParser()
+    for name in ("config.cfg", "config.cfg.sample"):
+        path = os.path.join(ROOT_DIR, name)
+        if os.path.exists(path):
+            config.read(path)
+            break
+    return config["post_check"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark title classification")
+    parser.add_argument("-n", dest="count", type=int, default=100000, help="Number of titles")
+    args = parser.parse_args()
+
+    config = load_config()
+    with open(os.path.join(ROOT_DIR, "submission_categories.json")) as category_file:
+        post_categories = json.load(category_file)
+    with open(os.path.join(ROOT_DIR, "locations.json")) as locations_file:
+        locations = json.load(locations_file)
+
+    titles = generate_titles(args.count, post_categories, locations)
+
+    start = perf_counter()
+    legacy = [legacy_classify(config, post_categories, locations, title) for title in titles]
+    legacy_time = perf_counter() - start
+
+    start = perf_counter()
+    classifier = TitleClassifier(config, post_categories, locations)
+    verdicts = [classifier.classify(title) for title in titles]
+    compiled_time = perf_counter() - start
+
+    mismatches = 0
+    for old, verdict in zip(legacy, verdicts):
+        new = (verdict.kind, verdict.category if verdict.kind != "invalid" else verdict.bad_part,
+               verdict.timestamp_check)
+        if old != new:
+            mismatches += 1
+
+    print("Titles:     {}".format(len(titles)))
+    print("Legacy:     {:.0f} classifications/sec".format(len(titles) / legacy_time))
+    print("Compiled:   {:.0f} classifications/sec (incl. build)".format(len(titles) / compiled_time))
+    print("Speedup:    {:.1f}x".format(legacy_time / compiled_time))
+    print("Mismatches: {}".format(mismatches))
+
+
+if __name__ == "__main__":
+    main()
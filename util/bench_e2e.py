@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of post checking and trade flairing against a fake Reddit API
+
+  posts   replays a day of submissions through post_check.PostCheckRunner, polling as the day goes by
+  thread  runs flair.py on a trade confirmation thread, with mod PMs for some of the trades
+  record  records a fixtures file from live reddit with the login in config.cfg (read only)
+
+The scenarios run on synthetic fixtures unless a fixtures file (written by record, or by --save) is given.
+The bot runs in a temporary directory with its own config.cfg pointing praw at util/fake_reddit.py.
+"""
+
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import tempfile
+from time import perf_counter, time
+from collections import Counter
+from configparser import RawConfigParser
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from bench_classifier import generate_titles  # noqa: E402
+from fake_reddit import FakeReddit, FakeRedditServer, empty_usernotes, record  # noqa: E402
+
+DAY = 24 * 3600
+
+
+def _load_json(name):
+    with open(os.path.join(ROOT_DIR, name)) as json_file:
+        return json.load(json_file)
+
+
+def generate_users(fake, rng, count, start):
+    """ Add count users, most with some trades and old enough accounts, returns their names """
+    names = []
+    for index in range(count):
+        age_days = rng.choice([rng.randint(0, 13), rng.randint(14, 3000), rng.randint(14, 3000)])
+        names.append(fake.add_user("trader{}".format(index), rng.randint(0, 5000), rng.randint(0, 20000),
+                                   start - age_days * DAY))
+        if rng.random() < 0.6:
+            fake.set_flair(names[-1], None, "i-{}".format(rng.randint(1, 60)))
+    return names
+
+
+def generate_day(fake, count, users, seed=0):
+    """ Add count submissions spread over the last day, returns their creation time range """
+    rng = random.Random(seed)
+    start = time() - DAY
+    names = generate_users(fake, rng, users, start)
+    titles = generate_titles(count, _load_json("submission_categories.json"), _load_json("locations.json"), seed)
+    for index, title in enumerate(titles):
+        selftext = "Prices include shipping.\n\nMore pictures on request."
+        if rng.random() < 0.8:
+            selftext = "Timestamp: https://imgur.com/a/{:07d}\n\n".format(rng.randint(0, 9999999)) + selftext
+        fake.add_submission(rng.choice(names), title, selftext, start + index * DAY / count)
+    return start, start + DAY
+
+
+def generate_thread(fake, count, users, messages, seed=0):
+    """ Add a trade confirmation thread with count top level comments and mod PMs, returns its id """
+    rng = random.Random(seed)
+    start = time() - 30 * DAY
+    names = generate_users(fake, rng, users, time())
+    link_id = fake.add_submission(fake.username, "Confirmed Trade Thread", "Confirm your trades below.", start)
+    link_fullname = "t3_" + link_id
+    new_accounts = []
+    for index in range(count):
+        created = start + index * 30 * DAY / count
+        user, partner = rng.sample(names, 2)
+        kind = rng.random()
+        if kind < 0.03:
+            fake.add_comment(link_fullname, user, "Traded with {}".format(partner), created)
+        elif kind < 0.05:
+            comment_id = fake.add_comment(link_fullname, user, "Traded with /u/{}".format(user), created)
+            fake.add_comment("t1_" + comment_id, user, "Confirmed", created + 60)
+        elif kind < 0.1:
+            # Confirmed by an account too new to be flaired automatically
+            partner = fake.add_user("newtrader{}".format(index), 1, 1, time() - rng.randint(0, 13) * DAY)
+            comment_id = fake.add_comment(link_fullname, user, "Traded with /u/{}".format(partner), created)
+            fake.add_comment("t1_" + comment_id, partner, "Confirmed", created + 60)
+            new_accounts.append(comment_id)
+        else:
+            comment_id = fake.add_comment(link_fullname, user, "Traded with /u/{}".format(partner), created)
+            fake.add_comment("t1_" + comment_id, partner, "Confirmed, thanks!", created + rng.randint(60, 86400))
+    # Trades with new accounts verified by a mod
+    moderator = fake.add_user("swapmod", 1000, 1000, start - 1000 * DAY)
+    fake.moderators.append(moderator)
+    for comment_id in rng.sample(new_accounts, min(messages, len(new_accounts))):
+        fake.add_message(moderator, "https://www.reddit.com/r/{}/comments/{}/confirmed_trade_thread/{}/"
+                         .format(fake.subreddit, link_id, comment_id), "Trade confirmation", start + 30 * DAY)
+    fake.meta["trade_link_id"] = link_id
+    return link_id
+
+
+def write_config(path, server_url, fake, workers):
+    """ Write a config.cfg based on config.cfg.sample for the bot to run against the fake API """
+    config = RawConfigParser()
+    config.read(os.path.join(ROOT_DIR, "config.cfg.sample"))
+    config["login"].update({"username": fake.username, "password": "password", "client_id": "client_id",
+                            "client_secret": "client_secret", "oauth_url": server_url, "reddit_url": server_url,
+                            "check_for_updates": "False"})
+    config["subreddit"].update({"uri": fake.subreddit, "name": fake.subreddit, "rate_budget_file": ""})
+    config["logging"].update({"sentry": "", "log_file": "actions.log"})
+    config["trade"].update({"link_id": fake.meta.get("trade_link_id", ""), "user_db": "user.db"})
+    config["post_check"].update({"workers": str(workers)})
+    config["metrics"].update({"textfile_dir": "", "port": "0"})
+    with open(path, "w") as config_file:
+        config.write(config_file)
+
+
+class Bench(object):
+    """ Runs the bot against a fake API in a temporary directory """
+
+    def __init__(self, fake, workers=1):
+        self.fake = fake
+        self._workers = workers
+        self._server = None
+        self._old_cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp(prefix="bench_e2e_")
+
+    def __enter__(self):
+        if "usernotes" not in self.fake.wiki:
+            self.fake.set_wiki("usernotes", empty_usernotes())
+        self._server = FakeRedditServer(self.fake).start()
+        for name in ("submission_categories.json", "locations.json"):
+            shutil.copy(os.path.join(ROOT_DIR, name), self.work_dir)
+        write_config(os.path.join(self.work_dir, "config.cfg"), self._server.url, self.fake, self._workers)
+        # The scripts keep their log, databases and checkpoints in the working directory
+        os.chdir(self.work_dir)
+        return self
+
+    def __exit__(self, *exc_info):
+        os.chdir(self._old_cwd)
+        self._server.stop()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def subreddit(self, logger):
+        from common import SubRedditMod
+        return SubRedditMod(logger, os.path.join(self.work_dir, "config.cfg"))
+
+
+def run_posts(fake, start, end, step, workers):
+    """ Poll for new posts every step seconds of the day, returns the number of posts checked """
+    with Bench(fake, workers) as bench:
+        # Imported in the working directory, the loggers open their log file on import
+        import post_check
+        from metrics import ITEMS
+
+        with open("post_check.checkpoint", "w") as checkpoint_file:
+            checkpoint_file.write("t3_0 {}\n".format(start - 1))
+        fake.now = start
+        runner = post_check.PostCheckRunner(bench.subreddit(post_check.LOGGER))
+        polls = 0
+        while fake.now < end:
+            fake.now = min(fake.now + step, end)
+            runner.poll()
+            polls += 1
+        checked = sum(count for (kind, _), count in ITEMS.values().items() if kind == "post")
+        return checked, "{} polls".format(polls)
+
+
+def run_thread(fake, link_id):
+    """ Run flair.py on the thread, returns the number of trades handled """
+    with Bench(fake) as bench:
+        import flair
+        from metrics import ITEMS
+
+        flair.run(bench.subreddit(flair.LOGGER), link_id, full=True)
+        trades = ITEMS.get(kind="trade_confirmation", result="completed")
+        pending = ITEMS.get(kind="trade_confirmation", result="pending")
+        return trades + pending, "{} completed, {} pending, {} mod PMs".format(
+            trades, pending, ITEMS.get(kind="mod_message", result="received"))
+
+
+def run_record(args):
+    """ Record fixtures from live reddit, only reading """
+    config_path = os.path.abspath(args.config)
+    output = os.path.abspath(args.output)
+    # Run in a temporary directory, the mod roster, user db and log of the bot are left alone
+    work_dir = tempfile.mkdtemp(prefix="bench_e2e_")
+    os.chdir(work_dir)
+    try:
+        from log_conf import LoggerManager
+        from common import SubRedditMod
+
+        subreddit = SubRedditMod(LoggerManager().getLogger("bench_e2e"), config_path)
+        fake = FakeReddit(subreddit.config["subreddit"]["uri"], subreddit.username)
+        record(subreddit.praw_h._core, fake)
+        posts = list(subreddit.get_new(limit=args.posts))
+        if args.thread:
+            subreddit.get_all_comments(args.thread)
+            fake.meta["trade_link_id"] = args.thread
+        list(subreddit.subreddit.flair(limit=None))
+        subreddit.mod_roster.refresh()
+        if args.profiles:
+            for author in {post.author.name for post in posts if post.author}:
+                subreddit.get_profile(subreddit.praw_h.redditor(author))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    fake.save(output)
+    print("Recorded {} submissions, {} comments, {} users and {} flairs to {}".format(
+        len(fake.submissions), len(fake.comments), len(fake.users), len(fake.flair), output))
+
+
+# What the throughput of each scenario is counted in
+UNITS = {"posts": "posts", "thread": "confirmations"}
+
+
+def report(fake, name, elapsed, items, details):
+    from metrics import API_CALLS
+
+    calls = sum(fake.calls.values())
+    print("Scenario:   {} ({})".format(name, details))
+    print("Elapsed:    {:.1f}s, {:.1f} {}/s".format(elapsed, items / elapsed, UNITS[name]))
+    print("API calls:  {} ({:.2f} per {})".format(calls, float(calls) / items if items else 0, UNITS[name][:-1]))
+    for (method, endpoint), count in fake.calls.most_common():
+        print("  {:<5} {:<22} {:>8}".format(method, endpoint, count))
+    print("API calls by stage:")
+    by_stage = Counter()
+    for (stage, _), count in API_CALLS.values().items():
+        by_stage[stage] += count
+    for stage, count in by_stage.most_common():
+        print("  {:<28} {:>8}".format(stage, count))
+    print("Writes:")
+    for kind, count in Counter(write["kind"] for write in fake.writes).most_common():
+        print("  {:<28} {:>8}".format(kind, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark against a fake Reddit API")
+    subparsers = parser.add_subparsers(dest="scenario")
+    subparsers.required = True
+
+    posts = subparsers.add_parser("posts", help="Replay a day of submissions through post_check")
+    posts.add_argument("-n", dest="count", type=int, default=10000, help="Number of submissions")
+    posts.add_argument("-u", "--users", type=int, default=3000, help="Number of distinct authors")
+    posts.add_argument("-s", "--step", type=int, default=300, help="Seconds of the day between polls")
+    posts.add_argument("-w", "--workers", type=int, default=1, help="post_check workers")
+
+    thread = subparsers.add_parser("thread", help="Run flair.py on a trade confirmation thread")
+    thread.add_argument("-n", dest="count", type=int, default=5000, help="Number of confirmation comments")
+    thread.add_argument("-u", "--users", type=int, default=2000, help="Number of distinct users")
+    thread.add_argument("-m", "--messages", type=int, default=20, help="Number of mod PMs")
+
+    for scenario in (posts, thread):
+        scenario.add_argument("-f", "--fixtures", help="Run on a fixtures file instead of synthetic fixtures")
+        scenario.add_argument("--save", help="Save the fixtures before running")
+        scenario.add_argument("--writes", help="Save the writes made by the bot to this file")
+        scenario.add_argument("--seed", type=int, default=0)
+
+    recorder = subparsers.add_parser("record", help="Record fixtures from live reddit")
+    recorder.add_argument("-o", dest="output", required=True, help="Fixtures file to write")
+    recorder.add_argument("-c", "--config", default=os.path.join(ROOT_DIR, "config.cfg"))
+    recorder.add_argument("-n", dest="posts", type=int, default=1000, help="Number of newest submissions")
+    recorder.add_argument("-t", "--thread", help="Id of a trade confirmation thread to record")
+    recorder.add_argument("-p", "--profiles", action="store_true", help="Record profiles of the submitters")
+
+    args = parser.parse_args()
+    if args.scenario == "record":
+        run_record(args)
+        return
+
+    fake = FakeReddit.load(args.fixtures) if args.fixtures else FakeReddit()
+    if args.scenario == "posts":
+        if args.fixtures:
+            created = [data["created_utc"] for data in fake.submissions.values()]
+            start, end = min(created), max(created)
+        else:
+            start, end = generate_day(fake, args.count, args.users, args.seed)
+    else:
+        link_id = fake.meta.get("trade_link_id")
+        if not args.fixtures:
+            link_id = generate_thread(fake, args.count, args.users, args.messages, args.seed)
+        if not link_id:
+            parser.error("The fixtures have no trade thread, record them with --thread")
+    if args.save:
+        fake.save(args.save)
+
+    begin = perf_counter()
+    if args.scenario == "posts":
+        items, details = run_posts(fake, start, end, args.step, args.workers)
+    else:
+        items, details = run_thread(fake, link_id)
+    elapsed = perf_counter() - begin
+
+    report(fake, args.scenario, elapsed, items, details)
+    if args.writes:
+        with open(args.writes, "w") as writes_file:
+            json.dump(fake.writes, writes_file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,694 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Reddit API, for running the bot offline against recorded or synthetic fixtures
+
+Serves the endpoints the bot uses (submission and comment listings, comment trees with MoreComments,
+the inbox, flair and wiki pages) and keeps the writes made to it (replies, removals, reports, flair,
+wiki edits). praw is pointed at it with oauth_url and reddit_url in the login section of config.cfg.
+
+Fixtures are JSON files holding the things, flair, inbox and wiki pages, see FakeReddit.save. They are
+generated by util/bench_e2e.py or recorded from live reddit with record().
+"""
+
+import re
+import csv
+import sys
+import json
+import time
+import zlib
+import base64
+import argparse
+import traceback
+import itertools
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+# Max comments in a comment tree response, the rest is left to MoreComments
+TREE_LIMIT = 500
+# Max comments returned by the morechildren endpoint
+MORECHILDREN_LIMIT = 100
+# Replies nested deeper than this are left to "continue this thread"
+MAX_DEPTH = 8
+# Max items of a listing page, and of a flair list page
+LISTING_LIMIT = 100
+FLAIRLIST_LIMIT = 1000
+
+
+def to_base36(number):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    while number:
+        number, digit = divmod(number, 36)
+        result = digits[digit] + result
+    return result or "0"
+
+
+def empty_usernotes():
+    """ Content of a usernotes wiki page without notes (Toolbox format) """
+    blob = base64.b64encode(zlib.compress(b"{}")).decode("utf-8")
+    return json.dumps({"ver": 6, "constants": {"users": [], "warnings": []}, "blob": blob})
+
+
+def _next_id(ids, start):
+    return max([start - 1] + [int(thing_id, 36) for thing_id in ids]) + 1
+
+
+def _listing(children, after=None, before=None):
+    return {"kind": "Listing", "data": {"children": children, "after": after, "before": before}}
+
+
+class FakeReddit(object):
+    """
+    State of the fake API: things, flair, inbox and wiki pages, and the calls and writes made to it
+
+    Things created after now are left out of the listings, so a recorded or generated day can be
+    replayed by moving now forward. None shows everything.
+    """
+
+    def __init__(self, subreddit="fakeswap", username="swapbot", moderators=None):
+        self.subreddit = subreddit
+        self.username = username
+        self.moderators = list(moderators or [username])
+        self.now = None
+        self.meta = {}
+        self.submissions = {}
+        self.comments = {}
+        self.users = {}
+        self.messages = {}
+        self.flair = {}
+        self.wiki = {}
+        self.calls = Counter()
+        self.writes = []
+        # Remaining requests reported in the rate limit headers, high enough to never be waited for
+        self.ratelimit_remaining = 100000000
+        self._children = {}
+        self._sorted = {}
+        self._lock = threading.RLock()
+        # Same lengths as reddit ids, some scripts parse links expecting them
+        self._submission_ids = itertools.count(int("100000", 36))
+        self._comment_ids = itertools.count(int("1000000", 36))
+        self._message_ids = itertools.count(int("100000", 36))
+        self._revision_ids = itertools.count(1)
+
+    def _time(self):
+        return self.now if self.now is not None else time.time()
+
+    def _visible(self, data):
+        return self.now is None or data["created_utc"] <= self.now
+
+    # Fixtures
+
+    def add_user(self, name, link_karma=1, comment_karma=1, created_utc=None, **fields):
+        data = {"name": name, "id": to_base36(len(self.users) + 1000), "link_karma": link_karma,
+                "comment_karma": comment_karma,
+                "created_utc": created_utc if created_utc is not None else self._time()}
+        data.update(fields)
+        self.users[name.lower()] = data
+        return name
+
+    def add_submission(self, author, title, selftext="", created_utc=None, **fields):
+        """ Add a self post, returns its id """
+        submission_id = to_base36(next(self._submission_ids))
+        data = {"id": submission_id, "name": "t3_" + submission_id, "author": author, "title": title,
+                "selftext": selftext, "created_utc": created_utc if created_utc is not None else self._time(),
+                "subreddit": self.subreddit, "is_self": True, "num_comments": 0,
+                "permalink": "/r/{}/comments/{}/_/".format(self.subreddit, submission_id),
+                "url": "https://www.reddit.com/r/{}/comments/{}/_/".format(self.subreddit, submission_id),
+                "author_flair_text": None, "author_flair_css_class": None,
+                "link_flair_text": None, "link_flair_css_class": None,
+                "removed": False, "banned_by": None, "mod_reports": [], "user_reports": [],
+                "distinguished": None, "stickied": False}
+        data.update(fields)
+        self._store_submission(data)
+        return submission_id
+
+    def add_comment(self, parent_fullname, author, body, created_utc=None, **fields):
+        """ Add a comment replying to parent_fullname (submission or comment), returns its id """
+        if parent_fullname.startswith("t3_"):
+            link_id = parent_fullname
+        else:
+            link_id = self.comments[parent_fullname[3:]]["link_id"]
+        comment_id = to_base36(next(self._comment_ids))
+        data = {"id": comment_id, "name": "t1_" + comment_id, "author": author, "body": body,
+                "created_utc": created_utc if created_utc is not None else self._time(),
+                "parent_id": parent_fullname, "link_id": link_id, "subreddit": self.subreddit,
+                "permalink": "/r/{}/comments/{}/_/{}/".format(self.subreddit, link_id[3:], comment_id),
+                "author_flair_text": None, "author_flair_css_class": None,
+                "removed": False, "banned_by": None, "mod_reports": [], "user_reports": [],
+                "distinguished": None, "stickied": False, "edited": False}
+        data.update(fields)
+        self._store_comment(data)
+        return comment_id
+
+    def edit_comment(self, comment_id, body, edited_utc=None):
+        """ Edit the body of a comment, like its author """
+        data = self.comments[comment_id]
+        data["body"] = body
+        data["edited"] = edited_utc if edited_utc is not None else self._time()
+
+    def add_message(self, author, body, subject="", created_utc=None):
+        """ Add an unread private message to the bot, returns its id """
+        message_id = to_base36(next(self._message_ids))
+        self.messages[message_id] = {
+            "id": message_id, "name": "t4_" + message_id, "author": author, "dest": self.username,
+            "subject": subject, "body": body, "created_utc": created_utc if created_utc is not None else self._time(),
+            "was_comment": False, "new": True, "replies": "", "subreddit": None, "parent_id": None,
+            "first_message": None, "first_message_name": None, "context": "", "distinguished": None}
+        return message_id
+
+    def set_flair(self, name, text=None, css_class=None):
+        self.flair[name.lower()] = {"user": name, "flair_text": text, "flair_css_class": css_class}
+
+    def set_wiki(self, page, content, author=None):
+        """ Add a revision of a wiki page, returns the revision id """
+        revision_id = "{:08x}-0000-0000-0000-000000000000".format(next(self._revision_ids))
+        self.wiki.setdefault(page, []).append({"id": revision_id, "content_md": content,
+                                               "author": author or self.username, "timestamp": self._time()})
+        return revision_id
+
+    def _store_submission(self, data):
+        self.submissions[data["id"]] = data
+        self._sorted.pop("submissions", None)
+
+    def _store_comment(self, data):
+        self.comments[data["id"]] = data
+        # dict as an ordered set, threads have thousands of top level comments
+        self._children.setdefault(data["parent_id"], {})[data["id"]] = None
+        self._sorted.pop("comments", None)
+
+    def ingest(self, path, response):
+        """ Store the things in a response of live reddit to path as fixtures """
+        with self._lock:
+            match = re.match(r"r/[^/]+/wiki/(.+)$", path.strip("/"))
+            if match and isinstance(response, dict) and "content_md" in response.get("data", {}):
+                self.set_wiki(match.group(1), response["data"]["content_md"])
+            elif path.strip("/").endswith("about/moderators") and isinstance(response, dict):
+                self.moderators = [moderator["name"] for moderator in response["data"]["children"]]
+            else:
+                self._ingest(response)
+
+    def _ingest(self, value):
+        if isinstance(value, list):
+            for item in value:
+                self._ingest(item)
+            return
+        if not isinstance(value, dict):
+            return
+        kind = value.get("kind")
+        data = value.get("data")
+        if kind == "t3":
+            self._store_submission(dict(data))
+        elif kind == "t1":
+            replies = data.get("replies")
+            self._store_comment(dict(data, replies=""))
+            self._ingest(replies)
+        elif kind == "t2":
+            self.users[data["name"].lower()] = dict(data)
+        elif kind == "Listing":
+            self._ingest(data["children"])
+        elif "users" in value:
+            for flair in value["users"]:
+                self.set_flair(flair["user"], flair.get("flair_text"), flair.get("flair_css_class"))
+        elif "json" in value:
+            self._ingest(value["json"].get("data", {}).get("things", []))
+
+    def save(self, path):
+        with self._lock:
+            fixtures = {"subreddit": self.subreddit, "username": self.username, "moderators": self.moderators,
+                        "meta": self.meta, "users": list(self.users.values()),
+                        "submissions": list(self.submissions.values()), "comments": list(self.comments.values()),
+                        "messages": list(self.messages.values()), "flair": list(self.flair.values()),
+                        "wiki": self.wiki}
+        with open(path, "w") as fixtures_file:
+            json.dump(fixtures, fixtures_file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as fixtures_file:
+            fixtures = json.load(fixtures_file)
+        fake = cls(fixtures["subreddit"], fixtures["username"], fixtures["moderators"])
+        fake.meta = fixtures.get("meta", {})
+        for user in fixtures["users"]:
+            fake.users[user["name"].lower()] = user
+        for submission in fixtures["submissions"]:
+            fake._store_submission(submission)
+        # Saved in the order they were added, parents before their replies
+        for comment in fixtures["comments"]:
+            fake._store_comment(comment)
+        for message in fixtures["messages"]:
+            fake.messages[message["id"]] = message
+        for flair in fixtures["flair"]:
+            fake.set_flair(flair["user"], flair["flair_text"], flair["flair_css_class"])
+        fake.wiki = fixtures.get("wiki", {})
+        # Things added later must not take the ids of loaded ones
+        fake._submission_ids = itertools.count(_next_id(fake.submissions, int("100000", 36)))
+        fake._comment_ids = itertools.count(_next_id(fake.comments, int("1000000", 36)))
+        fake._message_ids = itertools.count(_next_id(fake.messages, int("100000", 36)))
+        fake._revision_ids = itertools.count(sum(len(revisions) for revisions in fake.wiki.values()) + 1)
+        return fake
+
+    def stats(self):
+        """ Get calls by endpoint and writes by kind """
+        with self._lock:
+            return {"calls": {" ".join(key): count for key, count in sorted(self.calls.items())},
+                    "writes": dict(Counter(write["kind"] for write in self.writes))}
+
+    # Requests
+
+    def handle(self, method, path, params):
+        """ Handle a request, returns (status, response) """
+        path = path.strip("/")
+        for route_method, pattern, name in ROUTES:
+            if route_method != method:
+                continue
+            match = re.match(pattern + "$", path)
+            if match:
+                with self._lock:
+                    self.calls[(method, name)] += 1
+                    return getattr(self, name)(params, **match.groupdict())
+        with self._lock:
+            self.calls[(method, "unknown")] += 1
+        return 404, {"message": "Not Found", "error": 404}
+
+    def _record(self, kind, **fields):
+        fields["kind"] = kind
+        fields["time"] = self._time()
+        self.writes.append(fields)
+
+    def _render(self, data):
+        """ Data of a thing with the current flair of its author """
+        data = dict(data)
+        flair = self.flair.get((data.get("author") or "").lower())
+        if flair is not None:
+            data["author_flair_text"] = flair["flair_text"]
+            data["author_flair_css_class"] = flair["flair_css_class"]
+        return data
+
+    def _thing(self, fullname):
+        kind, thing_id = fullname.split("_", 1)
+        things = {"t1": self.comments, "t3": self.submissions, "t4": self.messages}.get(kind, {})
+        return things.get(thing_id)
+
+    def _newest_first(self, kind):
+        if kind not in self._sorted:
+            things = self.submissions if kind == "submissions" else self.comments
+            self._sorted[kind] = sorted(things.values(), key=lambda data: data["created_utc"], reverse=True)
+        return self._sorted[kind]
+
+    @staticmethod
+    def _page(items, params, limit=LISTING_LIMIT):
+        """ Get page of items (newest first) selected by the after, before and limit params """
+        limit = min(int(params.get("limit") or 25), limit)
+        fullnames = [item["name"] for item in items]
+        if params.get("after"):
+            if params["after"] not in fullnames:
+                return [], None
+            start = fullnames.index(params["after"]) + 1
+            page = items[start:start + limit]
+            more = start + limit < len(items)
+        elif params.get("before"):
+            if params["before"] not in fullnames:
+                return [], None
+            end = fullnames.index(params["before"])
+            page = items[max(end - limit, 0):end]
+            more = False
+        else:
+            page = items[:limit]
+            more = limit < len(items)
+        return page, page[-1]["name"] if page and more else None
+
+    def _tree(self, parent_fullname, budget, depth):
+        """ Nested replies to parent_fullname, with MoreComments for what does not fit in budget """
+        ids = list(self._children.get(parent_fullname, ()))
+        if ids and depth >= MAX_DEPTH:
+            # Continue this thread
+            return [{"kind": "more", "data": {"count": 0, "name": "t1__", "id": "_", "parent_id": parent_fullname,
+                                              "depth": depth, "children": []}}]
+        things = []
+        for index, comment_id in enumerate(ids):
+            if budget[0] <= 0:
+                things.append(self._more(parent_fullname, ids[index:], depth))
+                break
+            budget[0] -= 1
+            data = self._render(self.comments[comment_id])
+            replies = self._tree(data["name"], budget, depth + 1)
+            data["replies"] = _listing(replies) if replies else ""
+            data["depth"] = depth
+            things.append({"kind": "t1", "data": data})
+        return things
+
+    def _flat(self, parent_fullname, ids, budget, things):
+        """ Flat list of comments ids and their replies as returned by morechildren, parents first """
+        for index, comment_id in enumerate(ids):
+            if budget[0] <= 0:
+                things.append(self._more(parent_fullname, ids[index:], 0))
+                return
+            budget[0] -= 1
+            data = self._render(self.comments[comment_id])
+            data["replies"] = ""
+            things.append({"kind": "t1", "data": data})
+            self._flat(data["name"], list(self._children.get(data["name"], ())), budget, things)
+
+    @staticmethod
+    def _more(parent_fullname, ids, depth):
+        return {"kind": "more", "data": {"count": len(ids), "name": "t1_" + ids[0], "id": ids[0],
+                                         "parent_id": parent_fullname, "depth": depth, "children": ids}}
+
+    def access_token(self, params):
+        return 200, {"access_token": "fake-token", "token_type": "bearer", "expires_in": 86400, "scope": "*"}
+
+    def subreddit_new(self, params, subreddit):
+        submissions = [data for data in self._newest_first("submissions") if self._visible(data)]
+        page, after = self._page(submissions, params)
+        return 200, _listing([{"kind": "t3", "data": self._render(data)} for data in page], after)
+
+    def subreddit_comments(self, params, subreddit):
+        comments = [data for data in self._newest_first("comments") if self._visible(data)]
+        page, after = self._page(comments, params)
+        return 200, _listing([{"kind": "t1", "data": dict(self._render(data), replies="")} for data in page], after)
+
+    def info(self, params):
+        things = []
+        for fullname in (params.get("id") or "").split(","):
+            data = self._thing(fullname) if "_" in fullname else None
+            if data is not None:
+                things.append({"kind": fullname[:2], "data": dict(self._render(data), replies="")})
+        return 200, _listing(things)
+
+    def submission_comments(self, params, link_id, comment_id=None):
+        submission = self.submissions.get(link_id)
+        if submission is None:
+            return 404, {"message": "Not Found", "error": 404}
+        budget = [min(int(params.get("limit") or TREE_LIMIT), TREE_LIMIT)]
+        if comment_id is None:
+            tree = self._tree(submission["name"], budget, 0)
+        else:
+            comment = self.comments.get(comment_id)
+            if comment is None:
+                tree = []
+            else:
+                data = self._render(comment)
+                replies = self._tree(data["name"], budget, 1)
+                data["replies"] = _listing(replies) if replies else ""
+                tree = [{"kind": "t1", "data": data}]
+        submission = dict(self._render(submission), num_comments=len(self.comments))
+        return 200, [_listing([{"kind": "t3", "data": submission}]), _listing(tree)]
+
+    def morechildren(self, params):
+        by_parent = {}
+        for comment_id in (params.get("children") or "").split(","):
+            if comment_id in self.comments:
+                by_parent.setdefault(self.comments[comment_id]["parent_id"], []).append(comment_id)
+        budget = [MORECHILDREN_LIMIT]
+        things = []
+        for parent_fullname, ids in by_parent.items():
+            self._flat(parent_fullname, ids, budget, things)
+        return 200, {"json": {"errors": [], "data": {"things": things}}}
+
+    def user_about(self, params, name):
+        user = self.users.get(name.lower())
+        if user is None:
+            return 404, {"message": "Not Found", "error": 404}
+        return 200, {"kind": "t2", "data": user}
+
+    def moderators_list(self, params, subreddit):
+        children = [{"name": name, "id": "t2_" + to_base36(index + 1), "date": 0, "mod_permissions": ["all"]}
+                    for index, name in enumerate(self.moderators)]
+        return 200, {"kind": "UserList", "data": {"children": children, "after": None, "before": None}}
+
+    def unread(self, params):
+        messages = sorted((data for data in self.messages.values() if data["new"] and self._visible(data)),
+                          key=lambda data: data["created_utc"], reverse=True)
+        page, after = self._page(messages, params)
+        return 200, _listing([{"kind": "t4", "data": data} for data in page], after)
+
+    def read_message(self, params):
+        for fullname in (params.get("id") or "").split(","):
+            message = self.messages.get(fullname.split("_", 1)[-1])
+            if message is not None:
+                message["new"] = False
+                self._record("read_message", id=message["id"])
+        return 200, {}
+
+    def comment(self, params):
+        parent_fullname = params["thing_id"]
+        if parent_fullname.startswith("t4_"):
+            parent = self.messages[parent_fullname[3:]]
+            message_id = to_base36(next(self._message_ids))
+            data = dict(parent, id=message_id, name="t4_" + message_id, author=self.username, dest=parent["author"],
+                        body=params["text"], parent_id=parent_fullname, new=False, created_utc=self._time())
+            self._record("message_reply", parent_id=parent_fullname, to=parent["author"], body=params["text"])
+            return 200, {"json": {"errors": [], "data": {"things": [{"kind": "t4", "data": data}]}}}
+        if self._thing(parent_fullname) is None:
+            return 200, {"json": {"errors": [["DELETED_COMMENT", "that comment has been deleted", "parent"]]}}
+        comment_id = self.add_comment(parent_fullname, self.username, params["text"], self._time())
+        self._record("reply", id=comment_id, parent_id=parent_fullname, body=params["text"])
+        return 200, {"json": {"errors": [], "data": {"things": [{"kind": "t1",
+                                                                 "data": self.comments[comment_id]}]}}}
+
+    def distinguish(self, params):
+        data = self._thing(params["id"])
+        if data is not None:
+            data["distinguished"] = "moderator" if params.get("how") == "yes" else None
+        self._record("distinguish", id=params["id"], how=params.get("how"))
+        return 200, {"json": {"errors": []}}
+
+    def remove(self, params):
+        data = self._thing(params["id"])
+        if data is not None:
+            data["removed"] = True
+            data["banned_by"] = self.username
+        self._record("remove", id=params["id"], spam=params.get("spam"))
+        return 200, {}
+
+    def approve(self, params):
+        data = self._thing(params["id"])
+        if data is not None:
+            data.update(removed=False, banned_by=None, mod_reports=[])
+        self._record("approve", id=params["id"])
+        return 200, {}
+
+    def report(self, params):
+        data = self._thing(params["id"])
+        if data is not None:
+            data["mod_reports"] = data["mod_reports"] + [[params.get("reason"), self.username]]
+        self._record("report", id=params["id"], reason=params.get("reason"))
+        return 200, {"json": {"errors": []}}
+
+    def set_flair_single(self, params, subreddit):
+        if params.get("link"):
+            data = self._thing(params["link"])
+            if data is not None:
+                data.update(link_flair_text=params.get("text"), link_flair_css_class=params.get("css_class"))
+            self._record("link_flair", id=params["link"], text=params.get("text"), css_class=params.get("css_class"))
+        else:
+            self.set_flair(params["name"], params.get("text"), params.get("css_class"))
+            self._record("user_flair", user=params["name"], text=params.get("text"),
+                         css_class=params.get("css_class"))
+        return 200, {"json": {"errors": []}}
+
+    def flaircsv(self, params, subreddit):
+        results = []
+        for user, text, css_class in csv.reader(params.get("flair_csv", "").splitlines()):
+            self.set_flair(user, text or None, css_class or None)
+            self._record("user_flair", user=user, text=text, css_class=css_class)
+            results.append({"ok": True, "status": "added flair for user " + user, "warnings": {}, "errors": {}})
+        return 200, results
+
+    def flairlist(self, params, subreddit):
+        names = sorted(self.flair)
+        start = names.index(params["after"].lower()) + 1 if params.get("after") in self.flair else 0
+        limit = min(int(params.get("limit") or FLAIRLIST_LIMIT), FLAIRLIST_LIMIT)
+        page = names[start:start + limit]
+        response = {"users": [dict(self.flair[name]) for name in page]}
+        if start + limit < len(names):
+            response["next"] = page[-1]
+        return 200, response
+
+    def wiki_page(self, params, subreddit, page):
+        revisions = self.wiki.get(page)
+        if not revisions:
+            return 404, {"message": "Not Found", "error": 404, "reason": "PAGE_NOT_CREATED"}
+        revision = revisions[-1]
+        if params.get("v"):
+            revision = next((item for item in revisions if item["id"] == params["v"]), None)
+            if revision is None:
+                return 404, {"message": "Not Found", "error": 404}
+        return 200, {"kind": "wikipage", "data": {
+            "content_md": revision["content_md"], "content_html": "", "revision_id": revision["id"],
+            "revision_date": revision["timestamp"], "may_revise": True,
+            "revision_by": {"kind": "t2", "data": {"name": revision["author"]}}}}
+
+    def wiki_revisions(self, params, subreddit, page):
+        revisions = self.wiki.get(page)
+        if not revisions:
+            return 404, {"message": "Not Found", "error": 404, "reason": "PAGE_NOT_CREATED"}
+        limit = min(int(params.get("limit") or LISTING_LIMIT), LISTING_LIMIT)
+        newest_first = revisions[::-1]
+        start = next((index + 1 for index, revision in enumerate(newest_first)
+                      if "WikiRevision_" + revision["id"] == params.get("after")), 0)
+        page_revisions = newest_first[start:start + limit]
+        children = [{"id": revision["id"], "page": page, "timestamp": revision["timestamp"], "reason": None,
+                     "revision_hidden": False, "author": {"kind": "t2", "data": {"name": revision["author"]}}}
+                    for revision in page_revisions]
+        after = "WikiRevision_" + page_revisions[-1]["id"] if start + limit < len(newest_first) else None
+        return 200, _listing(children, after)
+
+    def wiki_edit(self, params, subreddit):
+        page = params["page"]
+        revisions = self.wiki.get(page)
+        previous = params.get("previous")
+        if previous and revisions and revisions[-1]["id"] != previous:
+            # Edited since the revision the change is based on, reddit answers with the current content
+            return 409, {"message": "Conflict", "error": 409, "reason": "EDIT_CONFLICT",
+                         "newcontent": revisions[-1]["content_md"], "newrevision": revisions[-1]["id"]}
+        revision_id = self.set_wiki(page, params.get("content", ""))
+        self._record("wiki_edit", page=page, revision_id=revision_id, reason=params.get("reason"))
+        return 200, {}
+
+    def wiki_settings(self, params, subreddit, page):
+        self._record("wiki_settings", page=page, listed=params.get("listed"), permlevel=params.get("permlevel"))
+        return 200, {"kind": "wikipagesettings", "data": {"listed": params.get("listed") == "True",
+                                                          "permlevel": int(params.get("permlevel") or 0),
+                                                          "editors": []}}
+
+
+# (method, path pattern, FakeReddit method handling it)
+ROUTES = [
+    ("POST", r"api/v1/access_token", "access_token"),
+    ("GET", r"r/(?P<subreddit>[^/]+)/new", "subreddit_new"),
+    ("GET", r"r/(?P<subreddit>[^/]+)/comments", "subreddit_comments"),
+    ("GET", r"r/(?P<subreddit>[^/]+)/about/moderators", "moderators_list"),
+    ("GET", r"r/(?P<subreddit>[^/]+)/api/flairlist", "flairlist"),
+    ("POST", r"r/(?P<subreddit>[^/]+)/api/flaircsv", "flaircsv"),
+    ("POST", r"r/(?P<subreddit>[^/]+)/api/flair", "set_flair_single"),
+    ("POST", r"r/(?P<subreddit>[^/]+)/api/wiki/edit", "wiki_edit"),
+    ("POST", r"r/(?P<subreddit>[^/]+)/wiki/settings/(?P<page>.+)", "wiki_settings"),
+    ("GET", r"r/(?P<subreddit>[^/]+)/wiki/revisions/(?P<page>.+)", "wiki_revisions"),
+    ("GET", r"r/(?P<subreddit>[^/]+)/wiki/(?P<page>.+)", "wiki_page"),
+    ("GET", r"api/info", "info"),
+    ("GET", r"(?:r/[^/]+/)?comments/(?P<link_id>\w+)(?:/[^/]*/(?P<comment_id>\w+))?(?:/[^/]*)?", "submission_comments"),
+    ("POST", r"api/morechildren", "morechildren"),
+    ("GET", r"user/(?P<name>[^/]+)/about", "user_about"),
+    ("GET", r"message/unread", "unread"),
+    ("POST", r"api/read_message", "read_message"),
+    ("POST", r"api/comment", "comment"),
+    ("POST", r"api/distinguish", "distinguish"),
+    ("POST", r"api/remove", "remove"),
+    ("POST", r"api/approve", "approve"),
+    ("POST", r"api/report", "report"),
+]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep alive, like reddit, without waiting for acks between the headers and the body
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    fake = None
+
+    def _respond(self, status, response):
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("x-ratelimit-remaining", str(self.fake.ratelimit_remaining))
+        self.send_header("x-ratelimit-used", "0")
+        self.send_header("x-ratelimit-reset", "600")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method, body=""):
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query, keep_blank_values=True))
+        params.update(parse_qsl(body, keep_blank_values=True))
+        if url.path.strip("/") == "_fake/stats":
+            self._respond(200, self.fake.stats())
+            return
+        try:
+            status, response = self.fake.handle(method, url.path, params)
+        except Exception:
+            # Requests the fake does not handle well enough, shown instead of failing in the client
+            traceback.print_exc()
+            status, response = 500, {"message": "Internal Server Error", "error": 500}
+        self._respond(status, response)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self._handle("POST", self.rfile.read(length).decode("utf-8"))
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeRedditServer(object):
+    """ HTTP server for a FakeReddit, serving both the www and oauth hosts of reddit """
+
+    def __init__(self, fake, host="127.0.0.1", port=0):
+        self.fake = fake
+        handler = type("FakeRedditHandler", (_Handler,), {"fake": fake})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        """ Serve in a background thread """
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-reddit")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def record(core, fake):
+    """
+    Store the things in every response to a prawcore session (praw_h._core) in fake
+
+    Only read while recording, morechildren is requested with POST as well.
+    """
+    request = core.request
+
+    def recording_request(method, path, *args, **kwargs):
+        response = request(method, path, *args, **kwargs)
+        fake.ingest(path, response)
+        return response
+
+    core.request = recording_request
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake Reddit API from a fixtures file")
+    parser.add_argument("fixtures", help="Fixtures file, as written by util/bench_e2e.py")
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("-w", "--writes", help="Write the writes made to the API to this file on exit")
+    args = parser.parse_args()
+
+    server = FakeRedditServer(FakeReddit.load(args.fixtures), port=args.port)
+    print("Serving {} (set oauth_url and reddit_url in the login section of config.cfg)".format(server.url))
+    try:
+        server.start()
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+    if args.writes:
+        with open(args.writes, "w") as writes_file:
+            json.dump(server.fake.writes, writes_file, indent=1)
+    json.dump(server.fake.stats(), sys.stdout, indent=1)
+    print()
+
+
+if __name__ == "__main__":
+    main()
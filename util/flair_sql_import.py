@@ -3,9 +3,10 @@
 import sys, os
 import json
 import argparse
-import sqlite3 as lite
+import sqlite3
 
-con = None
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from user_db import UserDB
 
 def extant_file(x):
     if not os.path.exists(x):
@@ -18,29 +19,16 @@ def main():
     args = parser.parse_args()
 
     try:
-        con = lite.connect('user.db')
-    except lite.Error as e:
+        user_db = UserDB('user.db')
+    except sqlite3.Error as e:
         print("Error %s:" % e.args[0])
         sys.exit(1)
 
-    curs = con.cursor()
-
-    curs.execute('''CREATE TABLE IF NOT EXISTS user (
-username TEXT PRIMARY KEY NOT NULL ,
-flair_text TEXT,
-flair_css_class TEXT,
-last_created timestamp,
-last_id TEXT DEFAULT ''
-)''')
-
     flair_json = json.load(open(args.filename))
 
-    curs.executemany('INSERT INTO flair (username, flair_text, flair_css_class) VALUES (:user, :flair_text, :flair_css_class)', flair_json)
-
-    con.commit()
+    user_db.import_flairs(flair_json)
 
-    if con:
-        con.close()
+    user_db.close()
 
 if __name__ == "__main__":
     main()
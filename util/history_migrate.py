@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+""" Migrate per-user submission history directories into the segment history store """
+
+import os
+import sys
+import argparse
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from history_store import HistoryStore  # noqa: E402
+
+
+def iter_legacy_history(history_dir):
+    """ Yield (author, post_id, mtime, path) for each file in the old <author>/<post_id> layout """
+    for author in sorted(os.listdir(history_dir)):
+        user_path = os.path.join(history_dir, author)
+        if not os.path.isdir(user_path):
+            continue
+        for post_id in os.listdir(user_path):
+            path = os.path.join(user_path, post_id)
+            if os.path.isfile(path):
+                yield author, post_id, os.path.getmtime(path), path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate user submission history into the history store")
+    parser.add_argument("history_dir", help="user_history_dir from config.cfg")
+    parser.add_argument("--delete", action="store_true", help="Delete old files after migrating them")
+    args = parser.parse_args()
+
+    store = HistoryStore(args.history_dir)
+    # Store oldest first so the segments keep the original order
+    entries = sorted(iter_legacy_history(args.history_dir), key=lambda entry: entry[2])
+    for count, (author, post_id, mtime, path) in enumerate(entries, 1):
+        with open(path) as history_file:
+            title = history_file.readline().rstrip("\n")
+            body = history_file.read()
+        # The old layout did not keep the creation time, the file modification time is close enough
+        store.append(post_id, author, mtime, title, body, commit=False)
+        if count % 1000 == 0:
+            store.commit()
+            print("Migrated {} of {} submissions".format(count, len(entries)))
+    store.close()
+    print("Migrated {} submissions".format(len(entries)))
+
+    if args.delete:
+        for _, _, _, path in entries:
+            os.remove(path)
+        for author in {entry[0] for entry in entries}:
+            user_path = os.path.join(args.history_dir, author)
+            if not os.listdir(user_path):
+                os.rmdir(user_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+""" Report import time of the bot scripts (python -X importtime) and compare it against a stored baseline """
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+from statistics import median
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(ROOT_DIR, "util", "import_baseline.json")
+
+MODULES = ["log_conf", "common", "flair", "heatware", "post_check",
+           "monthly_trade_post", "monthly_price_post", "bot_daemon"]
+# Dependencies that should only be imported once they are needed
+HEAVY_MODULES = ["praw", "prawcore", "requests", "sentry_sdk"]
+
+
+def measure(module, work_dir):
+    """ Import module in a fresh interpreter, returns (cumulative microseconds, heavy modules imported) """
+    env = dict(os.environ, PYTHONPATH=ROOT_DIR)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            cwd=work_dir, env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    cumulative = None
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        if cumulative_us.strip() == "cumulative":
+            continue
+        imported.add(name.strip())
+        if name.strip() == module and not name[1:].startswith(" "):
+            cumulative = int(cumulative_us)
+    return cumulative, sorted(imported.intersection(HEAVY_MODULES))
+
+
+def report(runs):
+    """ Median import time and heavy imports of each module """
+    results = {}
+    # Run outside the repository, importing the scripts creates actions.log in the working directory
+    with tempfile.TemporaryDirectory() as work_dir:
+        for module in MODULES:
+            measurements = [measure(module, work_dir) for _ in range(runs)]
+            results[module] = {"cumulative_us": int(median(cumulative for cumulative, _ in measurements)),
+                               "heavy": measurements[-1][1]}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Get regressions against the baseline, as printable lines """
+    regressions = []
+    for module, result in results.items():
+        if module not in baseline:
+            continue
+        new_heavy = set(result["heavy"]) - set(baseline[module]["heavy"])
+        if new_heavy:
+            regressions.append("{} now imports {}".format(module, ", ".join(sorted(new_heavy))))
+        if result["cumulative_us"] > baseline[module]["cumulative_us"] * (1 + tolerance):
+            regressions.append("{} takes {:.1f}ms to import, baseline {:.1f}ms".format(
+                module, result["cumulative_us"] / 1000.0, baseline[module]["cumulative_us"] / 1000.0))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report import time of the bot scripts")
+    parser.add_argument("-n", dest="runs", type=int, default=5, help="Imports per module, the median is used")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.5,
+                        help="Allowed slowdown against the baseline (0.5 = 50%%)")
+    parser.add_argument("--update", action="store_true", help="Store the results as the new baseline")
+    args = parser.parse_args()
+
+    results = report(args.runs)
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as baseline_file:
+            baseline = json.load(baseline_file)["modules"]
+
+    print("{:<20} {:>10} {:>10}  {}".format("module", "ms", "baseline", "heavy imports"))
+    for module, result in results.items():
+        baseline_ms = baseline[module]["cumulative_us"] / 1000.0 if module in baseline else float("nan")
+        heavy = ", ".join(result["heavy"]) or "-"
+        print("{:<20} {:>10.1f} {:>10.1f}  {}".format(module, result["cumulative_us"] / 1000.0, baseline_ms, heavy))
+
+    if args.update:
+        with open(BASELINE_PATH, "w") as baseline_file:
+            json.dump({"python": sys.version.split()[0], "modules": results}, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print("Baseline updated")
+        return
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION: " + regression)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
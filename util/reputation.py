@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+""" Report trade reputation from the flair ledger in the user db, without using the reddit API """
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from user_db import UserDB  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report trade reputation")
+    parser.add_argument("users", nargs="*", help="Users to report, top traders if none are given")
+    parser.add_argument("-d", "--db", dest="db", default="user.db", help="User db")
+    parser.add_argument("-n", "--top", dest="top", type=int, default=10, help="Number of top traders")
+    args = parser.parse_args()
+
+    user_db = UserDB(args.db)
+    synced = user_db.get_meta("flair_synced_utc")
+    if synced is None:
+        print("Warning: flair ledger has never been synced (run flair.py -s)")
+
+    if args.users:
+        for user in args.users:
+            flair = user_db.get_flair(user)
+            if flair is None:
+                print("{}: unknown".format(user))
+            elif flair[0] is None:
+                print("{}: {}".format(user, flair[1]))
+            else:
+                print("{}: {} trade(s)".format(user, flair[0]))
+    else:
+        for user, trade_count in user_db.get_top_traders(args.top):
+            print("{}: {} trade(s)".format(user, trade_count))
+
+
+if __name__ == "__main__":
+    main()